@@ -0,0 +1,110 @@
+"""Read/write contention benchmark for the configured database (manage.py db-bench)."""
+import time
+import threading
+from datetime import datetime
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, select, func, and_, or_
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.stats import percentile
+from server.models import db
+
+def _summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+    return {
+        'ops': len(latencies),
+        'ops_per_second': round(len(latencies) / seconds, 1),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None
+    }
+
+def run_benchmark(app, seconds=5.0, readers=4, writers=2, seed_rows=1000):
+    """
+    Measure read/write contention on the configured database.
+
+    Readers page through a scratch table the way /files does (keyset order on
+    created_at, id); writers mimic uploads with a short transaction that inserts
+    a row and updates another. Lock and busy errors are counted, not raised.
+    The scratch table is dropped afterwards.
+
+    Returns:
+        dict with the backend settings and 'read'/'write' latency summaries
+    """
+    bench = Table('_db_bench', MetaData(),
+                  Column('id', Integer, primary_key=True),
+                  Column('payload', String(64)),
+                  Column('created_at', DateTime, nullable=False),
+                  Column('touched', Integer, nullable=False, default=0))
+
+    with app.app_context():
+        engine = db.engine
+        bench.drop(engine, checkfirst=True)
+        bench.create(engine)
+        with engine.begin() as connection:
+            connection.execute(bench.insert(), [{'payload': f'seed-{i}', 'created_at': datetime.now(), 'touched': 0}
+                                                for i in range(seed_rows)])
+
+        stop = threading.Event()
+        samples = {'read': [], 'write': []}  # one {'latencies', 'errors'} record per thread
+
+        def reader(record):
+            cursor = (datetime.min, 0)
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    with engine.connect() as connection:
+                        rows = connection.execute(
+                            select(bench.c.id, bench.c.created_at)
+                            .where(or_(bench.c.created_at > cursor[0],
+                                       and_(bench.c.created_at == cursor[0], bench.c.id > cursor[1])))
+                            .order_by(bench.c.created_at, bench.c.id).limit(50)).fetchall()
+                    cursor = (rows[-1].created_at, rows[-1].id) if rows else (datetime.min, 0)
+                    record['latencies'].append(time.perf_counter() - started)
+                except OperationalError:
+                    record['errors'] += 1
+
+        def writer(record, number):
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    with engine.begin() as connection:
+                        connection.execute(bench.insert(), {'payload': f'writer-{number}',
+                                                            'created_at': datetime.now(), 'touched': 0})
+                        connection.execute(bench.update().where(bench.c.id == (number % seed_rows) + 1)
+                                           .values(touched=bench.c.touched + 1))
+                    record['latencies'].append(time.perf_counter() - started)
+                except OperationalError:
+                    record['errors'] += 1
+
+        def spawn(kind, target, *args):
+            record = {'latencies': [], 'errors': 0}
+            samples[kind].append(record)
+            return threading.Thread(target=target, args=(record, *args), daemon=True)
+
+        threads = ([spawn('read', reader) for _ in range(readers)] +
+                   [spawn('write', writer, i) for i in range(writers)])
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        settings = {'backend': engine.dialect.name, 'pool': type(engine.pool).__name__,
+                    'readers': readers, 'writers': writers, 'seconds': round(elapsed, 2)}
+        if engine.dialect.name == 'sqlite':
+            with engine.connect() as connection:
+                settings['journal_mode'] = connection.exec_driver_sql('PRAGMA journal_mode').scalar()
+                settings['synchronous'] = connection.exec_driver_sql('PRAGMA synchronous').scalar()
+                settings['busy_timeout'] = connection.exec_driver_sql('PRAGMA busy_timeout').scalar()
+        with engine.connect() as connection:
+            settings['rows_written'] = connection.execute(select(func.count()).select_from(bench)).scalar() - seed_rows
+        bench.drop(engine)
+
+    summaries = {kind: _summarize([latency for record in records for latency in record['latencies']],
+                                  sum(record['errors'] for record in records), elapsed)
+                 for kind, records in samples.items()}
+    return dict(settings, **summaries)
@@ -0,0 +1,159 @@
+"""
+Offline fixtures for the micro-benchmarks: a throwaway app on a temporary
+SQLite database, RSA key pairs cached on disk between runs and a stand-in for
+the Tor control port.
+"""
+import os
+import json
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from server.app import create_app
+from server.config import Config
+from server.models import db, RSAKey, UploadedFile
+
+# Generated key pairs are kept here, so only the first run pays for RSA key generation
+CACHE_DIR = os.environ.get('WHISTLEDROP_BENCH_CACHE') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+
+def cached_keypairs(count):
+    """
+    Return count (private PEM, public PEM) pairs, generating only the ones not cached yet.
+    """
+    from journalist.crypto import generate_rsa_keypairs
+
+    path = os.path.join(CACHE_DIR, 'rsa_keys.json')
+    keypairs = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            keypairs = [tuple(pair) for pair in json.load(f)]
+
+    if len(keypairs) < count:
+        keypairs.extend(generate_rsa_keypairs(count - len(keypairs)))
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(keypairs, f)
+        os.replace(temp_path, path)
+    return keypairs[:count]
+
+class FakeController:
+    """
+    Minimal stand-in for stem's Controller: accepts every call and hands out
+    made-up onion addresses, so startup code runs without a Tor daemon.
+    """
+
+    def __init__(self):
+        self.services = []
+
+    @classmethod
+    def from_port(cls, port=9051):
+        return cls()
+
+    def authenticate(self, *args, **kwargs):
+        pass
+
+    def get_version(self):
+        return 'fake'
+
+    def list_ephemeral_hidden_services(self):
+        return list(self.services)
+
+    def remove_ephemeral_hidden_service(self, service_id):
+        if service_id in self.services:
+            self.services.remove(service_id)
+
+    def create_ephemeral_hidden_service(self, ports, **kwargs):
+        service_id = f"benchmark{len(self.services):047d}"[:56]
+        self.services.append(service_id)
+        return SimpleNamespace(service_id=service_id)
+
+    def signal(self, signal):
+        pass
+
+    def close(self):
+        pass
+
+@contextmanager
+def fake_tor():
+    """Route TorService through FakeController for the duration of the block."""
+    from server import tor_service
+
+    original = tor_service.Controller
+    tor_service.Controller = FakeController
+    try:
+        yield
+    finally:
+        tor_service.Controller = original
+
+@contextmanager
+def bench_app(**settings):
+    """
+    A fresh app on an empty temporary SQLite database and blob store.
+
+    Keyword arguments override config settings. Background key pool threads
+    are off unless enabled through the settings.
+    """
+    workdir = tempfile.mkdtemp(prefix='whistledrop-bench-')
+    database_uri = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    config = type('BenchConfig', (Config,), dict({
+        'SECRET_KEY': 'benchmark',
+        'SQLALCHEMY_DATABASE_URI': database_uri,
+        'DATABASE_URI': database_uri,
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'HIDDEN_SERVICE_DIR': os.path.join(workdir, 'hidden_service'),
+        'USE_TOR': False,
+        'GENERATE_TEST_KEYS': False,
+        'RSA_PUBLIC_KEYS_FILE': None,
+        'KEY_PREPARE_QUEUE_SIZE': 0,
+        'KEY_STATS_RECONCILE_INTERVAL': 0,
+        'MAX_CONTENT_LENGTH': None
+    }, **settings))
+
+    app = create_app(config)
+    try:
+        with app.app_context():
+            db.create_all()
+        yield app
+    finally:
+        app.extensions['key_pool'].shutdown()
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def seed_keys(app, public_keys=None, count=0, used=0):
+    """
+    Insert public keys in one statement.
+
+    public_keys are inserted as given; count adds placeholder keys, which is
+    enough for code that never parses them (claims, listings). The first used
+    keys are marked as used.
+    """
+    rows = [{'public_key': public_key} for public_key in public_keys or ()]
+    rows.extend({'public_key': f'benchmark-key-{i}'} for i in range(count))
+    now = datetime.now()
+    for i, row in enumerate(rows):
+        row.update(is_used=i < used, used_at=now if i < used else None, created_at=now)
+    with app.app_context():
+        db.session.execute(RSAKey.__table__.insert(), rows)
+        db.session.commit()
+    return len(rows)
+
+def seed_files(app, count, batch_size=10000):
+    """Insert count file rows (with their used keys), uploaded one minute apart."""
+    seed_keys(app, count=count, used=count)
+    start = datetime.now() - timedelta(minutes=count)
+    with app.app_context():
+        for first in range(0, count, batch_size):
+            db.session.execute(UploadedFile.__table__.insert(), [{
+                'filename': f'document-{i}.pdf',
+                'aes_key': b'\0' * 256,
+                'key_id': i + 1,
+                'created_at': start + timedelta(minutes=i),
+                'blob_ref': f'{i:064x}',
+                'blob_size': 1024
+            } for i in range(first, min(first + batch_size, count))])
+        db.session.commit()
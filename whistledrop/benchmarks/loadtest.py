@@ -0,0 +1,391 @@
+"""Load generator for manage.py loadtest: simulated whistleblowers and journalists against a live server."""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+import uuid
+import requests
+from contextlib import contextmanager
+from datetime import datetime
+from benchmarks.stats import percentile
+
+logger = logging.getLogger(__name__)
+
+# Bytes handed to the socket per read of a throttled upload body
+TRANSFER_CHUNK_SIZE = 16 * 1024
+
+# Seconds the local server gets to come up (includes key import and database setup)
+STARTUP_TIMEOUT = 120
+
+# Public keys for local test servers are kept here between runs; their private halves are discarded
+KEY_CACHE = os.path.join(tempfile.gettempdir(), 'whistledrop-loadtest-keys.json')
+
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+
+def parse_size(text):
+    """Parse a byte count such as '512', '64k' or '2m'."""
+    text = str(text).strip().lower().rstrip('ib')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+def size_distribution(spec, max_size=None):
+    """
+    Build a file size sampler from a spec.
+
+    fixed:SIZE        every file has SIZE bytes
+    uniform:MIN-MAX   sizes spread evenly between MIN and MAX
+    lognormal:MEDIAN  mostly small files with a long tail of large ones (sigma 1)
+
+    Returns:
+        function taking a random.Random and returning a size in bytes
+    """
+    kind, _, argument = spec.partition(':')
+    if kind == 'fixed':
+        size = parse_size(argument)
+        sample = lambda rng: size
+    elif kind == 'uniform':
+        low, high = (parse_size(part) for part in argument.split('-', 1))
+        sample = lambda rng: rng.randint(low, high)
+    elif kind == 'lognormal':
+        median = parse_size(argument)
+        sample = lambda rng: int(rng.lognormvariate(0, 1) * median)
+    else:
+        raise ValueError(f"Unknown size distribution: {spec}")
+
+    if max_size:
+        return lambda rng: max(1, min(sample(rng), max_size))
+    return lambda rng: max(1, sample(rng))
+
+class Throttle:
+    """Paces a transfer to a bandwidth in bytes per second (None = unlimited)."""
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.started = time.monotonic()
+        self.transferred = 0
+
+    def add(self, size):
+        self.transferred += size
+        if self.bandwidth:
+            delay = self.started + self.transferred / self.bandwidth - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+class ThrottledBody:
+    """File-like upload body sent at a limited bandwidth; len() gives requests its Content-Length."""
+
+    def __init__(self, parts, bandwidth):
+        self.parts = parts
+        self.size = sum(len(part) for part in parts)
+        self.throttle = Throttle(bandwidth)
+        self._part = 0
+        self._offset = 0
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        size = TRANSFER_CHUNK_SIZE if size is None or size < 0 else min(size, TRANSFER_CHUNK_SIZE)
+        while self._part < len(self.parts) and self._offset >= len(self.parts[self._part]):
+            self._part += 1
+            self._offset = 0
+        if self._part == len(self.parts):
+            return b''
+        chunk = self.parts[self._part][self._offset:self._offset + size]
+        self._offset += len(chunk)
+        self.throttle.add(len(chunk))
+        return chunk
+
+def multipart_upload(filename, payload, bandwidth):
+    """Encode a file as the multipart form /upload_file expects. Returns (body, content type)."""
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+    tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return ThrottledBody([head, payload, tail], bandwidth), f'multipart/form-data; boundary={boundary}'
+
+class Recorder:
+    """Thread-safe latency, byte and error counts for one kind of operation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = {}
+        self.bytes = 0
+
+    def success(self, latency, size=0):
+        with self._lock:
+            self.latencies.append(latency)
+            self.bytes += size
+
+    def error(self, kind):
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self, elapsed):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            errors = dict(self.errors)
+            transferred = self.bytes
+        attempts = len(latencies) + sum(errors.values())
+        return {
+            'ok': len(latencies),
+            'errors': errors,
+            'error_rate': round(sum(errors.values()) / attempts, 4) if attempts else 0.0,
+            'ops_per_second': round(len(latencies) / elapsed, 2),
+            'bytes_per_second': round(transferred / elapsed),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1) if latencies else None
+        }
+
+def _error_kind(response):
+    if response.status_code == 503:
+        return 'busy'
+    if 300 <= response.status_code < 400:
+        return 'rejected'  # The upload form redirects back with a flash message
+    return f'http_{response.status_code}'
+
+def _submitter(url, stop, recorder, sizes, bandwidth, latency, think_time, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    while not stop.is_set():
+        payload = os.urandom(sizes(rng))
+        body, content_type = multipart_upload(f'loadtest-{seed}.pdf', payload, bandwidth)
+        time.sleep(latency)
+        started = time.perf_counter()
+        try:
+            response = session.post(f'{url}/upload_file', data=body, allow_redirects=False,
+                                    headers={'Content-Type': content_type})
+            if response.status_code == 200:
+                recorder.success(time.perf_counter() - started, len(payload))
+            else:
+                recorder.error(_error_kind(response))
+        except requests.RequestException:
+            recorder.error('connection')
+        if think_time:
+            stop.wait(rng.expovariate(1 / think_time))
+
+def _retriever(url, stop, list_recorder, retrieve_recorder, bandwidth, latency, poll_interval, since):
+    session = requests.Session()
+    seen = set()
+    while not stop.is_set():
+        # Poll for files uploaded since the newest one seen, page by page, then pull the new ones
+        new_ids = []
+        params = {'since': since, 'limit': 100}
+        while not stop.is_set():
+            time.sleep(latency)
+            started = time.perf_counter()
+            try:
+                response = session.get(f'{url}/files', params=params)
+                if response.status_code != 200:
+                    list_recorder.error(_error_kind(response))
+                    break
+                page = response.json()
+                list_recorder.success(time.perf_counter() - started, len(response.content))
+            except (requests.RequestException, ValueError):
+                list_recorder.error('connection')
+                break
+            for file in page['files']:
+                if file['id'] not in seen:
+                    seen.add(file['id'])
+                    new_ids.append(file['id'])
+                since = max(since, file['created_at'])
+            if not page['next']:
+                break
+            params = dict(params, after=page['next'])
+
+        for file_id in new_ids:
+            if stop.is_set():
+                break
+            time.sleep(latency)
+            started = time.perf_counter()
+            try:
+                with session.get(f'{url}/retrieve/{file_id}', stream=True) as response:
+                    if response.status_code != 200:
+                        retrieve_recorder.error(_error_kind(response))
+                        continue
+                    throttle = Throttle(bandwidth)
+                    size = 0
+                    for chunk in response.iter_content(TRANSFER_CHUNK_SIZE):
+                        size += len(chunk)
+                        throttle.add(len(chunk))
+                retrieve_recorder.success(time.perf_counter() - started, size)
+            except requests.RequestException:
+                retrieve_recorder.error('connection')
+
+        stop.wait(poll_interval)
+
+def _key_status(url):
+    try:
+        return requests.get(f'{url}/keys/status', timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+def _monitor_keys(url, stop, samples, interval, started):
+    while True:
+        status = _key_status(url)
+        if status and 'available' in status:
+            samples.append((time.perf_counter() - started, status['available']))
+        if stop.wait(interval):
+            return
+
+def run_loadtest(url, submitters=8, retrievers=2, duration=30.0, sizes='lognormal:256k', max_size=None,
+                 bandwidth=None, latency=0.0, think_time=0.0, poll_interval=2.0, seed=None):
+    """
+    Drive a running server with concurrent submitters and retrievers.
+
+    Submitters upload random files back to back (sizes drawn from the sizes
+    spec) at the given client bandwidth in bytes per second, adding latency
+    seconds before every request to mimic a Tor circuit. Retrievers poll /files
+    for new files and pull each through /retrieve. Key availability is sampled
+    during the run to measure how fast the key pool drains.
+
+    Returns:
+        dict with the settings, per-operation summaries and the key pool drain
+    """
+    sample_size = size_distribution(sizes, max_size)
+    seed = seed if seed is not None else random.randrange(1 << 30)
+    recorders = {'upload': Recorder(), 'list': Recorder(), 'retrieve': Recorder()}
+    stop = threading.Event()
+
+    # Retrievers only pull files uploaded during the run (timestamps are the server's local time)
+    since = datetime.now().isoformat()
+
+    samples = []
+    started = time.perf_counter()
+    monitor = threading.Thread(target=_monitor_keys, args=(url, stop, samples, max(1.0, duration / 20), started),
+                               daemon=True)
+    threads = [threading.Thread(target=_submitter, daemon=True,
+                                args=(url, stop, recorders['upload'], sample_size, bandwidth, latency,
+                                      think_time, seed + i))
+               for i in range(submitters)]
+    threads += [threading.Thread(target=_retriever, daemon=True,
+                                 args=(url, stop, recorders['list'], recorders['retrieve'], bandwidth, latency,
+                                       poll_interval, since))
+                for _ in range(retrievers)]
+
+    monitor.start()
+    for thread in threads:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    monitor.join()
+
+    final = _key_status(url)
+    if final and 'available' in final:
+        samples.append((elapsed, final['available']))
+    keys = {'available_start': samples[0][1] if samples else None,
+            'available_end': samples[-1][1] if samples else None,
+            'drained_per_minute': None, 'exhausted_after_s': None}
+    if len(samples) >= 2:
+        keys['drained_per_minute'] = round((samples[0][1] - samples[-1][1]) / (samples[-1][0] - samples[0][0]) * 60, 1)
+        keys['exhausted_after_s'] = next((round(t, 1) for t, available in samples if available == 0), None)
+
+    result = {
+        'url': url, 'submitters': submitters, 'retrievers': retrievers, 'seconds': round(elapsed, 1),
+        'sizes': sizes, 'bandwidth': bandwidth, 'latency': latency, 'seed': seed
+    }
+    result.update({kind: recorder.summary(elapsed) for kind, recorder in recorders.items()})
+    result['keys'] = keys
+    return result
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _wait_until_ready(url, process, timeout=STARTUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {process.returncode}")
+        try:
+            if requests.get(f'{url}/status', timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server did not come up within {timeout} seconds")
+
+def _test_public_keys(count):
+    """Return count public keys, generating only the ones not in KEY_CACHE yet."""
+    from journalist.crypto import generate_rsa_keypairs
+
+    public_keys = []
+    if os.path.exists(KEY_CACHE):
+        with open(KEY_CACHE, 'r') as f:
+            public_keys = json.load(f)
+    if len(public_keys) < count:
+        logger.info(f"Generating {count - len(public_keys)} RSA keys for the load test")
+        public_keys.extend(public_key for _, public_key in generate_rsa_keypairs(count - len(public_keys)))
+        temp_path = f"{KEY_CACHE}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(public_keys, f)
+        os.replace(temp_path, KEY_CACHE)
+    return public_keys[:count]
+
+@contextmanager
+def local_server(keys=200, workers=2, threads=4, database_uri=None, env=None):
+    """
+    Start `manage.py serve` on a free local port with its own database and blob store.
+
+    The server gets keys public keys (imported on startup) and runs
+    without Tor. Unless database_uri is given, it uses a temporary SQLite
+    database that is removed afterwards along with the uploads.
+
+    Yields:
+        the server's base URL
+    """
+    workdir = tempfile.mkdtemp(prefix='whistledrop-loadtest-')
+    key_file = os.path.join(workdir, 'public_keys.json')
+    with open(key_file, 'w') as f:
+        json.dump({'public_keys': _test_public_keys(keys)}, f)
+
+    port = _free_port()
+    server_env = dict(os.environ, **{
+        'DATABASE_URI': database_uri or f"sqlite:///{os.path.join(workdir, 'loadtest.db')}",
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'SECRET_KEY_FILE': os.path.join(workdir, 'secret_key'),
+        'RSA_PUBLIC_KEYS_FILE': key_file,
+        'GENERATE_TEST_KEYS': 'false',
+        'USE_TOR': 'false',
+        'DEBUG': 'false',
+        'HOST': '127.0.0.1',
+        'PORT': str(port),
+        'KEY_STATS_MAX_AGE': '1',  # Key counts are cached per worker; keep the consumption samples current
+        'METRICS_PORT': '0'  # A metrics port inherited from the environment may already be taken
+    }, **(env or {}))
+    manage = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manage.py')
+    log_path = os.path.join(workdir, 'server.log')
+    url = f'http://127.0.0.1:{port}'
+
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, manage, 'serve', '--workers', str(workers), '--threads', str(threads)],
+                                   env=server_env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        _wait_until_ready(url, process)
+        logger.info(f"Load test server running at {url} ({workers} workers x {threads} threads)")
+        yield url
+    except Exception:
+        with open(log_path, 'r') as log:
+            logger.error(f"Server log:\n{log.read()[-4000:]}")
+        raise
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the crypto, storage and key-pool hot paths.
+
+Runs fully offline (temporary SQLite databases, cached RSA keys, fake Tor
+controller) and writes the results as JSON. Each metric records its unit and
+whether higher or lower is better, so a run can be compared against a stored
+baseline.
+
+Usage (from the whistledrop directory):
+    python -m benchmarks.micro --quick
+    python -m benchmarks.micro --output results.json --save-baseline
+    python -m benchmarks.micro --baseline benchmarks/baseline.json --tolerance 0.2
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.fixtures import bench_app, cached_keypairs, fake_tor, seed_keys, seed_files
+from benchmarks.stats import percentile
+from server.app import prepare_server
+from server.crypto import CIPHER_MODES, COMPRESSION_ZLIB, encrypt_file, generate_aes_key
+from server.keypool import claim_key
+from journalist.crypto import decrypt_file
+from werkzeug.test import EnvironBuilder
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+KIB = 1024
+MIB = 1024 * 1024
+
+# (full run, --quick run)
+CRYPTO_SIZES = ([64 * KIB, MIB, 16 * MIB], [64 * KIB, MIB])
+UPLOAD_SIZES = ([64 * KIB, MIB, 16 * MIB], [64 * KIB, MIB])
+POOL_SIZES = ([1000, 10000, 100000], [1000, 10000])
+ROW_COUNTS = ([1000, 10000, 100000], [1000, 10000])
+
+def _size_label(size):
+    return f"{size // MIB}MiB" if size >= MIB else f"{size // KIB}KiB"
+
+def _metric(value, unit, better):
+    return {'value': round(value, 3), 'unit': unit, 'better': better}
+
+def _best_time(fn, repeat):
+    """Fastest of repeat runs of fn(), in seconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_crypto(sizes, repeat):
+    """Encryption (server) and decryption (journalist) throughput per cipher mode and file size, with and without zlib."""
+    metrics = {}
+    aes_key = generate_aes_key()
+    for size in sizes:
+        data = os.urandom(size)
+        for name, mode in CIPHER_MODES.items():
+            envelope = encrypt_file(data, aes_key, key_id=1, mode=mode)
+            encrypt = _best_time(lambda: encrypt_file(data, aes_key, key_id=1, mode=mode), repeat)
+            decrypt = _best_time(lambda: decrypt_file(envelope, aes_key), repeat)
+            metrics[f'crypto.encrypt.{name}.{_size_label(size)}'] = _metric(size / MIB / encrypt, 'MiB/s', 'higher')
+            metrics[f'crypto.decrypt.{name}.{_size_label(size)}'] = _metric(size / MIB / decrypt, 'MiB/s', 'higher')
+        
+        # zlib before encryption, on text that compresses well
+        text = _text(size)
+        envelope = encrypt_file(text, aes_key, key_id=1, compression=COMPRESSION_ZLIB)
+        encrypt = _best_time(lambda: encrypt_file(text, aes_key, key_id=1, compression=COMPRESSION_ZLIB), repeat)
+        decrypt = _best_time(lambda: decrypt_file(envelope, aes_key), repeat)
+        metrics[f'crypto.encrypt.zlib.{_size_label(size)}'] = _metric(size / MIB / encrypt, 'MiB/s', 'higher')
+        metrics[f'crypto.decrypt.zlib.{_size_label(size)}'] = _metric(size / MIB / decrypt, 'MiB/s', 'higher')
+        metrics[f'crypto.zlib_ratio.{_size_label(size)}'] = _metric(size / len(envelope), 'x', 'higher')
+    return metrics
+
+def _text(size):
+    """Document-like text of size bytes (CSV rows with varying numbers)."""
+    rows = []
+    length = 0
+    i = 0
+    while length < size:
+        row = f"{i};Zahlung an Konto {i * 7919 % 100003:06d};{i * 104729 % 99991 / 100:.2f} EUR;freigegeben\n".encode()
+        rows.append(row)
+        length += len(row)
+        i += 1
+    return b''.join(rows)[:size]
+
+def bench_upload_memory(sizes, repeat):
+    """
+    Peak Python memory allocated while /upload_file handles one upload.
+
+    The request body is built before measuring, so only what the upload path
+    itself holds (parsing, encryption, storage) is counted.
+    """
+    metrics = {}
+    keypairs = cached_keypairs(len(sizes) * repeat)
+    with bench_app() as app:
+        seed_keys(app, public_keys=[public_key for _, public_key in keypairs])
+        client = app.test_client()
+        for size in sizes:
+            data = os.urandom(size)
+            peaks = []
+            for _ in range(repeat):
+                environ = EnvironBuilder(path='/upload_file', method='POST',
+                                         data={'file': (io.BytesIO(data), 'benchmark.pdf')}).get_environ()
+                tracemalloc.start()
+                baseline = tracemalloc.get_traced_memory()[0]
+                response = client.open(environ)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                if response.status_code != 200:
+                    raise RuntimeError(f"Upload failed with status {response.status_code}")
+                peaks.append(peak - baseline)
+            metrics[f'upload.peak_memory.{_size_label(size)}'] = _metric(min(peaks) / KIB, 'KiB', 'lower')
+    return metrics
+
+def bench_key_claims(pool_sizes, claims):
+    """Latency of the atomic key claim against pools of different sizes, 90% of them used."""
+    metrics = {}
+    for pool_size in pool_sizes:
+        with bench_app() as app:
+            seed_keys(app, count=pool_size, used=pool_size * 9 // 10)
+            latencies = []
+            with app.app_context():
+                for _ in range(min(claims, pool_size // 10)):
+                    started = time.perf_counter()
+                    claimed = claim_key()
+                    latencies.append(time.perf_counter() - started)
+                    if claimed is None:
+                        raise RuntimeError("Key pool ran empty during the benchmark")
+            latencies.sort()
+            metrics[f'keys.claim.p50.pool_{pool_size}'] = _metric(percentile(latencies, 50) * 1000, 'ms', 'lower')
+            metrics[f'keys.claim.p95.pool_{pool_size}'] = _metric(percentile(latencies, 95) * 1000, 'ms', 'lower')
+    return metrics
+
+def bench_listing(row_counts, requests, page_size=100):
+    """Latency of /files for the first page and for a page halfway through the listing."""
+    metrics = {}
+    for row_count in row_counts:
+        with bench_app() as app:
+            seed_files(app, row_count)
+            client = app.test_client()
+
+            # Cursor of the page in the middle of the listing
+            cursor = None
+            for _ in range(row_count // page_size // 2):
+                cursor = client.get('/files', query_string={'limit': page_size, 'after': cursor}).json['next']
+
+            for name, query in (('first_page', {'limit': page_size}),
+                                ('middle_page', {'limit': page_size, 'after': cursor})):
+                latencies = []
+                for _ in range(requests):
+                    started = time.perf_counter()
+                    response = client.get('/files', query_string=query)
+                    latencies.append(time.perf_counter() - started)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"/files failed with status {response.status_code}")
+                latencies.sort()
+                metrics[f'files.list.{name}.p50.rows_{row_count}'] = _metric(percentile(latencies, 50) * 1000, 'ms', 'lower')
+    return metrics
+
+def bench_startup(repeat):
+    """App creation and one-time server setup (database, Tor hidden service via the fake controller)."""
+    created = []
+    prepared = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with bench_app(USE_TOR=True) as app:
+            created.append(time.perf_counter() - started)
+            seed_keys(app, count=100)
+            with fake_tor():
+                started = time.perf_counter()
+                tor_service = prepare_server(app)
+                prepared.append(time.perf_counter() - started)
+            if tor_service is None:
+                raise RuntimeError("Hidden service setup failed with the fake Tor controller")
+            tor_service.close()
+    return {
+        'startup.create_app': _metric(min(created) * 1000, 'ms', 'lower'),
+        'startup.prepare_server': _metric(min(prepared) * 1000, 'ms', 'lower')
+    }
+
+SUITES = {
+    'crypto': lambda quick, repeat: bench_crypto(CRYPTO_SIZES[quick], repeat),
+    'memory': lambda quick, repeat: bench_upload_memory(UPLOAD_SIZES[quick], repeat),
+    'keys': lambda quick, repeat: bench_key_claims(POOL_SIZES[quick], claims=200),
+    'listing': lambda quick, repeat: bench_listing(ROW_COUNTS[quick], requests=20 * repeat),
+    'startup': lambda quick, repeat: bench_startup(repeat)
+}
+
+def run(suites, quick=False, repeat=3):
+    """Run the selected suites and return the results document."""
+    metrics = {}
+    for name in suites:
+        started = time.perf_counter()
+        metrics.update(SUITES[name](quick, repeat))
+        print(f"{name}: done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'quick': quick,
+            'repeat': repeat
+        },
+        'metrics': metrics
+    }
+
+def compare(results, baseline, tolerance):
+    """
+    Compare a run against a baseline.
+
+    Returns:
+        list of (metric, baseline value, current value, relative change, regressed)
+        for the metrics present in both
+    """
+    rows = []
+    for name, current in sorted(results['metrics'].items()):
+        previous = baseline['metrics'].get(name)
+        if not previous or not previous['value']:
+            continue
+        change = (current['value'] - previous['value']) / previous['value']
+        worse = -change if current['better'] == 'higher' else change
+        rows.append((name, previous['value'], current['value'], change, worse > tolerance))
+    return rows
+
+def print_results(results, comparison=None):
+    """Print the metrics, with the change against the baseline if there is one."""
+    changes = {row[0]: row for row in comparison or ()}
+    print(f"\n{'metric':<48}{'value':>12} {'unit':<6}{'baseline':>12}{'change':>9}")
+    for name, metric in sorted(results['metrics'].items()):
+        line = f"{name:<48}{metric['value']:>12} {metric['unit']:<6}"
+        if name in changes:
+            _, previous, _, change, regressed = changes[name]
+            line += f"{previous:>12}{change:>+9.1%}{'  REGRESSION' if regressed else ''}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='WhistleDrop micro-benchmarks')
+    parser.add_argument('--suite', action='append', choices=sorted(SUITES), help='Suite to run (repeatable; default: all)')
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes and pools for a fast check')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions per measurement (default: 3)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help=f'Compare against this results file (default: {DEFAULT_BASELINE} if it exists)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Relative change counted as a regression (default: 0.25)')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run as the baseline')
+    args = parser.parse_args()
+
+    if args.baseline and not args.save_baseline and not os.path.exists(args.baseline):
+        parser.error(f"baseline not found: {args.baseline}")
+
+    # Per-request log lines would dominate the output
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = run(args.suite or list(SUITES), quick=args.quick, repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    baseline_path = args.baseline or DEFAULT_BASELINE
+    comparison = None
+    if not args.save_baseline and os.path.exists(baseline_path):
+        with open(baseline_path, 'r') as f:
+            comparison = compare(results, json.load(f), args.tolerance)
+
+    print_results(results, comparison)
+
+    if args.save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved baseline to {baseline_path}")
+    elif comparison and any(row[4] for row in comparison):
+        print(f"\n{sum(row[4] for row in comparison)} metrics regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
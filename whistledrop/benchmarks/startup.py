@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Startup-time benchmark for the management CLI and the server.
+
+Runs each scenario in a fresh interpreter with `python -X importtime`, reports
+the median wall time and which packages the import time went to, and fails if
+a scenario imports a package it is meant to leave alone (e.g. `manage.py --help`
+pulling in SQLAlchemy).
+
+Usage (from the whistledrop directory):
+    python benchmarks/startup.py
+    python benchmarks/startup.py --repeat 10 --top 15 --json
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy dependencies that only commands touching the database or crypto may load
+HEAVY = ['flask', 'sqlalchemy', 'flask_sqlalchemy', 'Crypto', 'stem', 'gunicorn']
+
+# (name, interpreter arguments, packages that must not be imported)
+SCENARIOS = [
+    ('manage --help', ['manage.py', '--help'], HEAVY),
+    ('manage (no command)', ['manage.py'], HEAVY),
+    ('import server.app', ['-c', 'import server.app'], ['sqlalchemy', 'Crypto', 'stem']),
+    ('create_app()', ['-c', 'from server.app import create_app; create_app()'], ['stem', 'gunicorn']),
+]
+
+def parse_importtime(stderr):
+    """
+    Parse `-X importtime` output.
+
+    Returns:
+        list of (module, self_us, cumulative_us, depth) in import order
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+def breakdown(modules, top):
+    """Sum the self time of each top-level package; return the largest ones in milliseconds."""
+    totals = defaultdict(int)
+    for name, self_us, _, _ in modules:
+        totals[name.split('.')[0]] += self_us
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [(package, round(us / 1000, 1)) for package, us in ranked]
+
+def run_scenario(args, repeat):
+    """Run one scenario repeat times. Returns (wall times in seconds, modules of the last run)."""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    walls = []
+    stderr = ''
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', *args], cwd=ROOT, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        walls.append(time.perf_counter() - started)
+        stderr = result.stderr
+    return walls, parse_importtime(stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure CLI and server startup time')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario (default: 5)')
+    parser.add_argument('--top', type=int, default=10, help='Packages listed per scenario (default: 10)')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for name, scenario_args, forbidden in SCENARIOS:
+        walls, modules = run_scenario(scenario_args, args.repeat)
+        loaded = {module.split('.')[0] for module, _, _, _ in modules}
+        results.append({
+            'scenario': name,
+            'wall_ms': round(statistics.median(walls) * 1000, 1),
+            'import_ms': round(sum(m[1] for m in modules) / 1000, 1),
+            'modules': len(modules),
+            'packages': breakdown(modules, args.top),
+            'unexpected': sorted(loaded.intersection(forbidden))
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"\n===== {result['scenario']} =====")
+            print(f"wall (median):  {result['wall_ms']} ms")
+            print(f"import time:    {result['import_ms']} ms ({result['modules']} modules)")
+            for package, ms in result['packages']:
+                print(f"  {package:<24}{ms:>8} ms")
+            if result['unexpected']:
+                print(f"UNEXPECTED IMPORTS: {', '.join(result['unexpected'])}")
+
+    if any(result['unexpected'] for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
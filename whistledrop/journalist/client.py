@@ -5,7 +5,13 @@ import argparse
 import requests
 import logging
 import base64
-from .crypto import decrypt_with_rsa
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from urllib.parse import unquote
+from .crypto import decrypt_to_path
+from .keyring import KeyRing
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad
 import json
@@ -13,99 +19,251 @@ import json
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('journalist.client')
 
+# Downloads are written to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Files requested per /files page, and pages whose ETag is remembered for revalidation
+FILES_PAGE_SIZE = 100
+MAX_CACHED_PAGES = 64
+
+# Records which files a sync has already retrieved, stored in the output directory
+MANIFEST_NAME = '.whistledrop-manifest.json'
+
+def _metadata_from_headers(headers):
+    """Extract file metadata from the X-WhistleDrop-* headers of a download response."""
+    return {
+        'id': int(headers['X-WhistleDrop-File-Id']),
+        'key_id': int(headers['X-WhistleDrop-Key-Id']),
+        'filename': unquote(headers['X-WhistleDrop-Filename']),
+        'created_at': headers.get('X-WhistleDrop-Created-At'),
+        'wrapped_key': base64.b64decode(headers['X-WhistleDrop-Wrapped-Key']),
+        'digest': headers['X-WhistleDrop-Digest'],
+        'format': headers.get('X-WhistleDrop-Format', 'envelope'),
+        'submission_id': int(headers['X-WhistleDrop-Submission-Id']) if headers.get('X-WhistleDrop-Submission-Id') else None
+    }
+
+def _sha256_file(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Compute the SHA-256 hex digest of a file without reading it all at once."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Key ring of a decryption worker process, set up once by _init_decrypt_worker
+_worker_keyring = None
+
+def _init_decrypt_worker(keys):
+    """Give a decryption worker process its own key ring."""
+    global _worker_keyring
+    _worker_keyring = KeyRing(keys)
+
+def _decrypt_job(encrypted_path, output_path, key_id, wrapped_key):
+    """Unwrap the AES key and decrypt one downloaded payload (runs in a worker process)."""
+    aes_key = _worker_keyring.unwrap(key_id, wrapped_key)
+    if aes_key is None:
+        return False
+    # Files are already spread across processes, so each one is decrypted sequentially
+    if not decrypt_to_path(encrypted_path, output_path, aes_key, workers=1):
+        return False
+    os.remove(encrypted_path)
+    return True
+
+def _load_manifest(path):
+    """Load a sync manifest, or return an empty one."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _save_manifest(path, manifest):
+    """Write a sync manifest atomically."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, path)
+
 class JournalistClient:
-    def __init__(self, server_url, keys_file=None):
+    def __init__(self, server_url, keys_file=None, max_connections=8):
         """
         Initialize the journalist client.
         
         Args:
             server_url: The URL of the WhistleDrop server
             keys_file: Path to file containing private RSA keys
+            max_connections: Connections kept open to the server for reuse
         """
         self.server_url = server_url.rstrip('/')
-        self.keys = {}
+        self.keyring = KeyRing()
+        self._page_cache = OrderedDict()  # /files query -> (ETag, page) for conditional requests, least recently used first
+        
+        # One session for all requests so connections (and Tor circuits) are reused
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         
         # Load keys if provided
         if keys_file and os.path.exists(keys_file):
             try:
-                with open(keys_file, 'r') as f:
-                    self.keys = json.load(f)
-                logger.info(f"Loaded {len(self.keys)} keys from {keys_file}")
+                self.keyring = KeyRing.from_file(keys_file)
+                logger.info(f"Loaded {len(self.keyring)} keys from {keys_file}")
             except Exception as e:
                 logger.error(f"Error loading keys from {keys_file}: {e}")
     
-    def list_files(self):
+    def iter_files(self, since=None, page_size=FILES_PAGE_SIZE):
+        """
+        Iterate over the files available on the server, fetching pages lazily.
+        
+        Args:
+            since: Only list files uploaded at or after this ISO timestamp
+            page_size: Number of files requested per page
+            
+        Yields:
+            dict: File metadata (id, filename, key_id, created_at)
+        """
+        params = {'limit': page_size}
+        if since:
+            params['since'] = since
+        
+        while True:
+            page = self._get_files_page(params)
+            yield from page['files']
+            
+            if not page.get('next'):
+                return
+            params = dict(params, after=page['next'])
+    
+    def _get_files_page(self, params):
+        """Fetch one page of /files, revalidating previously seen pages by ETag."""
+        cache_key = tuple(sorted(params.items()))
+        headers = {}
+        if cache_key in self._page_cache:
+            self._page_cache.move_to_end(cache_key)
+            headers['If-None-Match'] = self._page_cache[cache_key][0]
+        
+        response = self.session.get(f"{self.server_url}/files", params=params, headers=headers)
+        if response.status_code == 304:
+            return self._page_cache[cache_key][1]
+        if response.status_code != 200:
+            raise RuntimeError(f"Error listing files: {response.status_code} {response.text}")
+        
+        page = response.json()
+        if 'files' not in page:
+            raise RuntimeError("Unexpected response format")
+        if response.headers.get('ETag'):
+            self._page_cache[cache_key] = (response.headers['ETag'], page)
+            self._page_cache.move_to_end(cache_key)
+            while len(self._page_cache) > MAX_CACHED_PAGES:
+                self._page_cache.popitem(last=False)
+        return page
+    
+    def list_files(self, since=None):
         """List all available files on the server."""
         try:
-            response = requests.get(f"{self.server_url}/files")
-            if response.status_code == 200:
-                files = response.json()
-                if 'files' in files and 'total' in files:
-                    print(f"Found {files['total']} files on the server:")
+            total = 0
+            for file in self.iter_files(since=since):
+                if total == 0:
                     print("-" * 50)
-                    
-                    for file in files['files']:
-                        print(f"ID: {file['id']}")
-                        print(f"Filename: {file['filename']}")
-                        print(f"Uploaded: {file['created_at']}")
-                        print("-" * 50)
-                        
-                    return True
-                else:
-                    logger.error("Unexpected response format")
-                    return False
-            else:
-                logger.error(f"Error listing files: {response.status_code} {response.text}")
-                return False
+                print(f"ID: {file['id']}")
+                print(f"Filename: {file['filename']}")
+                print(f"Uploaded: {file['created_at']}")
+                if file.get('submission_id') is not None:
+                    print(f"Submission: {file['submission_id']}")
+                print("-" * 50)
+                total += 1
+            
+            print(f"Found {total} files on the server.")
+            return True
+        except RuntimeError as e:
+            logger.error(str(e))
+            return False
         except Exception as e:
             logger.error(f"Error connecting to server: {e}")
             return False
     
+    def download_file(self, file_id, path, chunk_size=DOWNLOAD_CHUNK_SIZE, retry=True):
+        """
+        Stream the encrypted payload of a file to disk.
+        
+        If path already holds part of the payload from an interrupted download,
+        only the missing bytes are requested with a Range header. The result is
+        checked against the server's SHA-256 digest.
+        
+        Args:
+            file_id: ID of the file on the server
+            path: Where to store the encrypted payload
+            chunk_size: Bytes written per chunk
+            retry: Restart from scratch once if the digest does not match
+            
+        Returns:
+            dict: File metadata and wrapped AES key from the response headers
+        """
+        url = f"{self.server_url}/download/{file_id}"
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+        
+        response = self.session.get(url, headers=headers, stream=True)
+        with response:
+            if response.status_code == 416:
+                # Nothing left to fetch; the partial file is already complete
+                mode = None
+            elif response.status_code == 206:
+                mode = 'ab'
+            elif response.status_code == 200:
+                mode = 'wb'
+            else:
+                raise RuntimeError(f"Error downloading file {file_id}: {response.status_code} {response.text}")
+            
+            if mode:
+                with open(path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                metadata = _metadata_from_headers(response.headers)
+        
+        if mode is None:
+            metadata = _metadata_from_headers(self.session.head(url).headers)
+        
+        if _sha256_file(path, chunk_size) != metadata['digest']:
+            os.remove(path)
+            if retry:
+                logger.warning(f"Digest mismatch for file {file_id}, downloading again")
+                return self.download_file(file_id, path, chunk_size, retry=False)
+            raise RuntimeError(f"Digest mismatch for file {file_id}")
+        
+        return metadata
+    
     def retrieve_file(self, file_id, output_path):
         """Retrieve and decrypt a file from the server."""
-        if not self.keys:
+        if not len(self.keyring):
             logger.error("No keys loaded. Cannot decrypt files.")
             return False
             
         try:
-            # Get the encrypted file from the server
-            response = requests.get(f"{self.server_url}/retrieve/{file_id}")
-            if response.status_code != 200:
-                logger.error(f"Error retrieving file {file_id}: {response.status_code} {response.text}")
-                return False
-                
-            file_data = response.json()
-            logger.info(f"Retrieved file: {file_data['filename']}")
+            # Stream the encrypted file to disk next to the output; an interrupted
+            # download is resumed on the next attempt
+            encrypted_path = f"{output_path}.download"
+            metadata = self.download_file(file_id, encrypted_path)
+            logger.info(f"Retrieved file: {metadata['filename']}")
             
             # Find the right key for decryption
-            key_id = str(file_data.get('key_id'))
-            if key_id not in self.keys:
+            key_id = metadata['key_id']
+            if key_id not in self.keyring:
                 logger.error(f"No matching private key found for key_id {key_id}")
                 return False
-                
-            private_key = self.keys[key_id]
             
             # Decrypt the AES key using the private RSA key
-            encrypted_aes_key = base64.b64decode(file_data['encrypted_aes_key'])
-            aes_key = decrypt_with_rsa(encrypted_aes_key, private_key)
-            
-            # Debug the encrypted_data format
-            logger.info(f"Encrypted data type: {type(file_data['encrypted_data'])}")
-            logger.info(f"Encrypted data preview: {str(file_data['encrypted_data'])[:50]}...")
-            
-            # Use the decrypt_file function directly from journalist.crypto
-            from journalist.crypto import decrypt_file
-            data = decrypt_file(file_data['encrypted_data'], aes_key)
+            aes_key = self.keyring.unwrap(key_id, metadata['wrapped_key'])
+            if aes_key is None:
+                return False
             
-            if not data:
+            # Decrypt chunk by chunk; output_path only appears once decryption succeeded
+            if not decrypt_to_path(encrypted_path, output_path, aes_key):
                 logger.error("Failed to decrypt the file")
                 return False
-            
-            # Save the decrypted file
-            with open(output_path, 'wb') as f:
-                f.write(data)
+            os.remove(encrypted_path)
                 
-            logger.info(f"File {file_data['filename']} successfully decrypted and saved to {output_path}")
+            logger.info(f"File {metadata['filename']} successfully decrypted and saved to {output_path}")
             return True
             
         except Exception as e:
@@ -114,10 +272,178 @@ class JournalistClient:
             traceback.print_exc()
             return False
     
+    def retrieve_submission(self, submission_id, output_dir, download_workers=4):
+        """
+        Retrieve and decrypt every file of a submission.
+        
+        The wrapped AES keys of all files come in one request and are unwrapped
+        together with the submission's single RSA key; the payloads are then
+        downloaded (resumably) and decrypted on a bounded thread pool.
+        
+        Args:
+            submission_id: ID of the submission on the server
+            output_dir: Directory for the decrypted files
+            download_workers: Number of concurrent downloads
+            
+        Returns:
+            bool: True if every file of the submission was retrieved
+        """
+        if not len(self.keyring):
+            logger.error("No keys loaded. Cannot decrypt files.")
+            return False
+        
+        try:
+            response = self.session.get(f"{self.server_url}/submissions/{submission_id}")
+            if response.status_code != 200:
+                logger.error(f"Error retrieving submission {submission_id}: {response.status_code} {response.text}")
+                return False
+            submission = response.json()
+        except Exception as e:
+            logger.error(f"Error connecting to server: {e}")
+            return False
+        
+        key_id = submission['key_id']
+        if key_id not in self.keyring:
+            logger.error(f"No matching private key found for key_id {key_id}")
+            return False
+        
+        files = submission['files']
+        aes_keys = self.keyring.unwrap_many(key_id, [base64.b64decode(file['encrypted_aes_key']) for file in files])
+        os.makedirs(output_dir, exist_ok=True)
+        
+        def retrieve(file, aes_key):
+            if aes_key is None:
+                return None
+            output_path = os.path.join(output_dir, f"{file['id']}_{os.path.basename(file['filename'])}")
+            encrypted_path = f"{output_path}.download"
+            self.download_file(file['id'], encrypted_path)
+            if not decrypt_to_path(encrypted_path, output_path, aes_key):
+                return None
+            os.remove(encrypted_path)
+            return output_path
+        
+        completed = 0
+        with ThreadPoolExecutor(max_workers=download_workers) as downloads:
+            futures = {downloads.submit(retrieve, file, aes_key): file for file, aes_key in zip(files, aes_keys)}
+            for future, file in futures.items():
+                try:
+                    output_path = future.result()
+                except Exception as e:
+                    logger.error(f"Retrieval of file {file['id']} failed: {e}")
+                    output_path = None
+                if output_path:
+                    completed += 1
+                    print(f"[{completed}/{len(files)}] Decrypted {file['filename']} -> {output_path}")
+                else:
+                    logger.error(f"Failed to retrieve file {file['id']} of submission {submission_id}")
+        
+        print(f"Retrieved {completed} of {len(files)} files of submission {submission_id}")
+        return completed == len(files)
+    
+    def sync(self, output_dir, download_workers=4, decrypt_workers=None):
+        """
+        Retrieve and decrypt every file not yet present in output_dir.
+        
+        Downloads run on a bounded thread pool sharing this client's session;
+        decryption runs on a process pool so RSA and AES work uses all cores.
+        Finished files are recorded in a manifest in output_dir, and interrupted
+        downloads are resumed, so running sync again continues where it stopped.
+        
+        Args:
+            output_dir: Directory for the decrypted files and the manifest
+            download_workers: Number of concurrent downloads
+            decrypt_workers: Number of decryption processes (CPU count if None)
+            
+        Returns:
+            bool: True if every pending file was retrieved
+        """
+        if not len(self.keyring):
+            logger.error("No keys loaded. Cannot decrypt files.")
+            return False
+        
+        partial_dir = os.path.join(output_dir, '.partial')
+        os.makedirs(partial_dir, exist_ok=True)
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        manifest = _load_manifest(manifest_path)
+        
+        try:
+            files = [file for file in self.iter_files() if str(file['id']) not in manifest]
+        except Exception as e:
+            logger.error(f"Error listing files: {e}")
+            return False
+        
+        total = len(files)
+        print(f"{len(manifest)} files already retrieved, {total} to fetch")
+        if not total:
+            return True
+        
+        failed = 0
+        downloaded = 0
+        completed = 0
+        jobs = {}
+        with ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+                ProcessPoolExecutor(max_workers=decrypt_workers, initializer=_init_decrypt_worker,
+                                    initargs=(self.keyring.export(),)) as decryptions:
+            for file in files:
+                encrypted_path = os.path.join(partial_dir, f"{file['id']}.download")
+                future = downloads.submit(self.download_file, file['id'], encrypted_path)
+                jobs[future] = ('download', file, encrypted_path)
+            
+            pending = set(jobs)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, file, encrypted_path = jobs.pop(future)
+                    
+                    if stage == 'download':
+                        try:
+                            metadata = future.result()
+                        except Exception as e:
+                            failed += 1
+                            logger.error(f"Download of file {file['id']} failed: {e}")
+                            continue
+                        
+                        if metadata['key_id'] not in self.keyring:
+                            failed += 1
+                            logger.error(f"No matching private key found for key_id {metadata['key_id']}")
+                            continue
+                        
+                        downloaded += 1
+                        size = os.path.getsize(encrypted_path)
+                        print(f"[{downloaded}/{total}] Downloaded file {file['id']} ({size} bytes)")
+                        output_path = os.path.join(output_dir, f"{file['id']}_{os.path.basename(file['filename'])}")
+                        decrypt_future = decryptions.submit(_decrypt_job, encrypted_path, output_path,
+                                                            metadata['key_id'], metadata['wrapped_key'])
+                        jobs[decrypt_future] = ('decrypt', dict(file, output=output_path, digest=metadata['digest']), encrypted_path)
+                        pending.add(decrypt_future)
+                    
+                    else:
+                        try:
+                            ok = future.result()
+                        except Exception as e:
+                            logger.error(f"Decryption of file {file['id']} failed: {e}")
+                            ok = False
+                        if not ok:
+                            failed += 1
+                            continue
+                        
+                        completed += 1
+                        manifest[str(file['id'])] = {
+                            'filename': file['filename'],
+                            'output': file['output'],
+                            'digest': file['digest'],
+                            'retrieved_at': datetime.now().isoformat()
+                        }
+                        _save_manifest(manifest_path, manifest)
+                        print(f"[{completed}/{total}] Decrypted {file['filename']} -> {file['output']}")
+        
+        print(f"Retrieved {completed} of {total} files, {failed} failed")
+        return failed == 0
+    
     def check_server_status(self):
         """Check the status of the WhistleDrop server."""
         try:
-            response = requests.get(f"{self.server_url}/status")
+            response = self.session.get(f"{self.server_url}/status")
             if response.status_code == 200:
                 status = response.json()
                 print("Server Status:")
@@ -147,6 +473,7 @@ def main():
     list_parser = subparsers.add_parser('list', help='List available files')
     server_arg(list_parser)
     keys_arg(list_parser)
+    list_parser.add_argument('--since', help='Only list files uploaded at or after this ISO timestamp')
     
     # Retrieve command
     retrieve_parser = subparsers.add_parser('retrieve', help='Retrieve and decrypt a file')
@@ -155,6 +482,22 @@ def main():
     retrieve_parser.add_argument('--file-id', required=True, type=int, help='ID of the file to retrieve')
     retrieve_parser.add_argument('--output', required=True, help='Output path for decrypted file')
     
+    # Retrieve submission command
+    submission_parser = subparsers.add_parser('retrieve-submission', help='Retrieve and decrypt all files of a submission')
+    server_arg(submission_parser)
+    keys_arg(submission_parser)
+    submission_parser.add_argument('--submission-id', required=True, type=int, help='ID of the submission to retrieve')
+    submission_parser.add_argument('--output-dir', required=True, help='Directory for decrypted files')
+    submission_parser.add_argument('--download-workers', type=int, default=4, help='Concurrent downloads (default: 4)')
+    
+    # Sync command
+    sync_parser = subparsers.add_parser('sync', aliases=['retrieve-all'], help='Retrieve and decrypt all new files')
+    server_arg(sync_parser)
+    keys_arg(sync_parser)
+    sync_parser.add_argument('--output-dir', required=True, help='Directory for decrypted files')
+    sync_parser.add_argument('--download-workers', type=int, default=4, help='Concurrent downloads (default: 4)')
+    sync_parser.add_argument('--decrypt-workers', type=int, default=None, help='Decryption processes (default: CPU count)')
+    
     # Status command
     status_parser = subparsers.add_parser('status', help='Check server status')
     server_arg(status_parser)
@@ -166,13 +509,19 @@ def main():
         return 1
     
     # Initialize client
-    client = JournalistClient(args.server, args.keys if hasattr(args, 'keys') else None)
+    max_connections = getattr(args, 'download_workers', None) or 8
+    client = JournalistClient(args.server, args.keys if hasattr(args, 'keys') else None,
+                              max_connections=max_connections)
     
     # Execute the requested command
     if args.command == 'list':
-        return 0 if client.list_files() else 1
+        return 0 if client.list_files(since=args.since) else 1
     elif args.command == 'retrieve':
         return 0 if client.retrieve_file(args.file_id, args.output) else 1
+    elif args.command == 'retrieve-submission':
+        return 0 if client.retrieve_submission(args.submission_id, args.output_dir, args.download_workers) else 1
+    elif args.command in ('sync', 'retrieve-all'):
+        return 0 if client.sync(args.output_dir, args.download_workers, args.decrypt_workers) else 1
     elif args.command == 'status':
         return 0 if client.check_server_status() else 1
     else:
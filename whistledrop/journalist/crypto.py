@@ -2,11 +2,46 @@ from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.Random import get_random_bytes
 import base64
+import io
 import json
 import logging
+import os
+import struct
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 logger = logging.getLogger(__name__)
 
+# Binary envelope written by the server: magic, format version, cipher mode,
+# compression, IV length and key id, followed by the IV and the raw ciphertext
+ENVELOPE_MAGIC = b'WDRP'
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct('>4sBBBBI')
+MODE_AES_CBC = 1
+MODE_AES_GCM_STREAM = 2
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+# AES-GCM STREAM mode: fixed-size segments, each with its own tag. The IV field
+# holds the nonce prefix and the segment size; a segment's nonce is
+# prefix || segment index || last-segment flag and the header is authenticated
+# with every segment
+STREAM_PARAMS = struct.Struct('>7sI')
+STREAM_TAG_SIZE = 16
+
+# Ciphertext is read and decrypted in chunks of this size (a multiple of the AES block size)
+DECRYPT_CHUNK_SIZE = 64 * 1024
+
+# Segments decrypted per task when a STREAM payload is decrypted in parallel
+SEGMENTS_PER_TASK = 16
+
+# Largest plaintext a compressed payload may inflate to (default of every decrypt
+# function); far above what the server accepts per upload, far below what a
+# decompression bomb expands to
+MAX_DECOMPRESSED_SIZE = 1024 ** 3
+
 def generate_rsa_keypair(bits=2048):
     """
     Generate a new RSA key pair.
@@ -153,12 +188,142 @@ def decrypt_aes_key_with_rsa(encrypted_aes_key, private_key_str):
     encrypted_key = base64.b64decode(encrypted_aes_key)
     return decrypt_with_rsa(encrypted_key, private_key_str)
 
-def decrypt_file(encrypted_data_json, aes_key):
+def parse_envelope(data):
+    """
+    Parse a binary envelope.
+    
+    Args:
+        data: The envelope as bytes
+        
+    Returns:
+        tuple: (header, ciphertext) where header is a dict of the header fields
+    """
+    if len(data) < ENVELOPE_HEADER.size:
+        raise ValueError("Data too short for an envelope header")
+    magic, version, mode, compression, iv_length, key_id = ENVELOPE_HEADER.unpack_from(data)
+    if magic != ENVELOPE_MAGIC:
+        raise ValueError("Not a WhistleDrop envelope")
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported envelope version {version}")
+    header_size = ENVELOPE_HEADER.size + iv_length
+    if len(data) < header_size:
+        raise ValueError("Truncated envelope header")
+    header = {
+        'version': version,
+        'mode': mode,
+        'compression': compression,
+        'key_id': key_id,
+        'iv': bytes(data[ENVELOPE_HEADER.size:header_size]),
+        'header_size': header_size,
+        'raw': bytes(data[:header_size])
+    }
+    if mode == MODE_AES_GCM_STREAM:
+        if iv_length != STREAM_PARAMS.size:
+            raise ValueError("Invalid stream parameters in envelope header")
+        header['nonce_prefix'], header['segment_size'] = STREAM_PARAMS.unpack(header['iv'])
+    return header, data[header_size:]
+
+def _read_envelope_header(source):
+    """Read and parse the envelope header at the current position of a binary file object."""
+    prefix = source.read(ENVELOPE_HEADER.size)
+    if len(prefix) < ENVELOPE_HEADER.size or prefix[:4] != ENVELOPE_MAGIC:
+        return None, prefix
+    iv_length = ENVELOPE_HEADER.unpack_from(prefix)[4]
+    header, _ = parse_envelope(prefix + source.read(iv_length))
+    return header, None
+
+def _read_full(source, size):
+    """Read size bytes from source, fewer only at the end of the file."""
+    data = source.read(size)
+    while data and len(data) < size:
+        more = source.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def _open_segment(aes_key, header, index, last, segment):
+    """
+    Decrypt and authenticate one AES-GCM STREAM segment.
+    
+    Raises:
+        ValueError: If the segment was modified, truncated, reordered or is
+                    not where the last segment was expected
+    """
+    from Crypto.Cipher import AES
+    
+    if len(segment) < STREAM_TAG_SIZE:
+        raise ValueError(f"Segment {index} is truncated")
+    nonce = header['nonce_prefix'] + struct.pack('>IB', index, 1 if last else 0)
+    cipher = AES.new(aes_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(header['raw'])
+    try:
+        return cipher.decrypt_and_verify(segment[:-STREAM_TAG_SIZE], segment[-STREAM_TAG_SIZE:])
+    except ValueError:
+        raise ValueError(f"Segment {index} failed authentication")
+
+class _Inflater:
+    """
+    Writable wrapper that decompresses zlib data on its way to destination.
+    
+    Output is produced in bounded pieces, so a small, highly compressed
+    ciphertext cannot expand into one huge buffer. With a limit, ValueError
+    is raised as soon as the output grows beyond limit bytes.
+    """
+    
+    def __init__(self, destination, max_length=DECRYPT_CHUNK_SIZE, limit=None):
+        self.destination = destination
+        self.max_length = max_length
+        self.limit = limit
+        self._decompressor = zlib.decompressobj()
+        self._total = 0
+    
+    def write(self, data):
+        written = 0
+        while data:
+            written += self._emit(self._decompressor.decompress(data, self.max_length))
+            data = self._decompressor.unconsumed_tail
+        return written
+    
+    def finish(self):
+        """Flush the remaining output and check that the compressed stream ended cleanly."""
+        written = self._emit(self._decompressor.flush())
+        if not self._decompressor.eof or self._decompressor.unused_data:
+            raise ValueError("Compressed payload is truncated or has trailing data")
+        return written
+    
+    def _emit(self, piece):
+        self._total += len(piece)
+        if self.limit is not None and self._total > self.limit:
+            raise ValueError(f"Decompressed payload exceeds {self.limit} bytes")
+        return self.destination.write(piece)
+
+def _decompressing(header, destination, max_size=None):
+    """
+    Wrap destination so the plaintext is decompressed according to the envelope header,
+    to at most max_size bytes (default MAX_DECOMPRESSED_SIZE).
+    """
+    if header['compression'] == COMPRESSION_ZLIB:
+        return _Inflater(destination, limit=MAX_DECOMPRESSED_SIZE if max_size is None else max_size)
+    if header['compression'] != COMPRESSION_NONE:
+        raise ValueError(f"Unsupported compression in envelope: {header['compression']}")
+    return destination
+
+def _finish(destination):
+    return destination.finish() if isinstance(destination, _Inflater) else 0
+
+def _segment_count(header, payload_size):
+    """Number of segments in a STREAM payload of payload_size bytes (after the header)."""
+    stored = header['segment_size'] + STREAM_TAG_SIZE
+    return max(1, -(-payload_size // stored))
+
+def decrypt_file(encrypted_data, aes_key):
     """
     Decrypt a file using an AES key.
     
     Args:
-        encrypted_data_json: JSON string or dict containing IV and ciphertext
+        encrypted_data: Binary envelope (bytes), or a legacy JSON string/dict
+                        containing IV and ciphertext
         aes_key: The AES key (bytes)
         
     Returns:
@@ -168,24 +333,51 @@ def decrypt_file(encrypted_data_json, aes_key):
     from Crypto.Util.Padding import unpad
     
     try:
-        # Try to parse as JSON if it's a string
-        if isinstance(encrypted_data_json, str):
-            try:
-                encrypted_data = json.loads(encrypted_data_json)
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse encrypted_data as JSON: {e}")
-                logger.error(f"Data preview: {encrypted_data_json[:50]}...")
+        if isinstance(encrypted_data, (bytes, bytearray)) and encrypted_data[:4] == ENVELOPE_MAGIC:
+            header, ciphertext = parse_envelope(encrypted_data)
+            if header['compression'] not in (COMPRESSION_NONE, COMPRESSION_ZLIB):
+                logger.error(f"Unsupported compression in envelope: {header['compression']}")
+                return None
+            if header['mode'] == MODE_AES_GCM_STREAM:
+                stored = header['segment_size'] + STREAM_TAG_SIZE
+                count = _segment_count(header, len(ciphertext))
+                data = b''.join(_open_segment(aes_key, header, index, index == count - 1,
+                                              ciphertext[index * stored:(index + 1) * stored])
+                                for index in range(count))
+            elif header['mode'] == MODE_AES_CBC:
+                cipher = AES.new(aes_key, AES.MODE_CBC, header['iv'])
+                data = unpad(cipher.decrypt(ciphertext), AES.block_size)
+            else:
+                logger.error(f"Unsupported cipher mode in envelope: {header['mode']}")
                 return None
-        else:
-            encrypted_data = encrypted_data_json
-            
-        # Extract IV and ciphertext
-        if 'iv' not in encrypted_data or 'ciphertext' not in encrypted_data:
-            logger.error(f"Missing required fields in encrypted_data: {encrypted_data.keys()}")
-            return None
             
-        iv = base64.b64decode(encrypted_data['iv'])
-        ciphertext = base64.b64decode(encrypted_data['ciphertext'])
+            # Payloads compressed before encryption are inflated transparently, up to a size limit
+            if header['compression'] == COMPRESSION_ZLIB:
+                inflated = io.BytesIO()
+                inflater = _Inflater(inflated, limit=MAX_DECOMPRESSED_SIZE)
+                inflater.write(data)
+                inflater.finish()
+                return inflated.getvalue()
+            return data
+        else:
+            # Legacy format: JSON document with base64-encoded IV and ciphertext
+            if isinstance(encrypted_data, (bytes, bytearray)):
+                encrypted_data = encrypted_data.decode('utf-8')
+            if isinstance(encrypted_data, str):
+                try:
+                    encrypted_data = json.loads(encrypted_data)
+                except json.JSONDecodeError as e:
+                    logger.error(f"Failed to parse encrypted_data as JSON: {e}")
+                    logger.error(f"Data preview: {encrypted_data[:50]}...")
+                    return None
+                
+            # Extract IV and ciphertext
+            if 'iv' not in encrypted_data or 'ciphertext' not in encrypted_data:
+                logger.error(f"Missing required fields in encrypted_data: {encrypted_data.keys()}")
+                return None
+                
+            iv = base64.b64decode(encrypted_data['iv'])
+            ciphertext = base64.b64decode(encrypted_data['ciphertext'])
         
         # Create a cipher object and decrypt
         cipher = AES.new(aes_key, AES.MODE_CBC, iv)
@@ -201,6 +393,167 @@ def decrypt_file(encrypted_data_json, aes_key):
         traceback.print_exc()
         return None
 
+def decrypt_stream(source, destination, aes_key, chunk_size=DECRYPT_CHUNK_SIZE, max_size=None):
+    """
+    Decrypt an envelope from a readable file object into a writable one.
+    
+    Only one chunk is held in memory at a time. In CBC mode the last cipher block
+    is kept back until the end of the input so the padding can be checked and
+    removed; in AES-GCM STREAM mode each segment is authenticated before its
+    plaintext is written. Compressed payloads are decompressed on the fly.
+    Legacy JSON payloads cannot be streamed and are decrypted in memory.
+    
+    Args:
+        source: Readable binary file object positioned at the start of the payload
+        destination: Writable binary file object for the plaintext
+        aes_key: The AES key (bytes)
+        chunk_size: Bytes read per chunk (multiple of the AES block size)
+        max_size: Largest plaintext a compressed payload may inflate to
+                  (default MAX_DECOMPRESSED_SIZE)
+        
+    Returns:
+        int: Number of plaintext bytes written
+        
+    Raises:
+        ValueError: If the payload is malformed, the padding is invalid, a
+                    segment fails authentication or the decompression fails
+                    or exceeds max_size
+    """
+    header, prefix = _read_envelope_header(source)
+    if header is None:
+        data = decrypt_file(prefix + source.read(), aes_key)
+        if data is None:
+            raise ValueError("Could not decrypt legacy payload")
+        return destination.write(data)
+    
+    destination = _decompressing(header, destination, max_size)
+    if header['mode'] == MODE_AES_GCM_STREAM:
+        written = _decrypt_segments(source, destination, aes_key, header)
+    elif header['mode'] == MODE_AES_CBC:
+        written = _decrypt_cbc(source, destination, aes_key, header, chunk_size)
+    else:
+        raise ValueError(f"Unsupported cipher mode in envelope: {header['mode']}")
+    return written + _finish(destination)
+
+def _decrypt_cbc(source, destination, aes_key, header, chunk_size):
+    """Decrypt a CBC payload chunk by chunk, keeping back the last block for the padding."""
+    from Crypto.Cipher import AES
+    from Crypto.Util.Padding import unpad
+    
+    cipher = AES.new(aes_key, AES.MODE_CBC, header['iv'])
+    written = 0
+    pending = b''  # ciphertext not yet decrypted, always ends with the last block seen so far
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        # Decrypt all whole blocks except the last one, which may carry the padding
+        ready = len(pending) - len(pending) % AES.block_size
+        if ready == len(pending):
+            ready -= AES.block_size
+        if ready > 0:
+            written += destination.write(cipher.decrypt(pending[:ready]))
+            pending = pending[ready:]
+    
+    if len(pending) != AES.block_size:
+        raise ValueError("Ciphertext length is not a multiple of the AES block size")
+    written += destination.write(unpad(cipher.decrypt(pending), AES.block_size))
+    return written
+
+def _decrypt_segments(source, destination, aes_key, header):
+    """Decrypt STREAM segments one after another, reading one segment ahead to find the last."""
+    stored = header['segment_size'] + STREAM_TAG_SIZE
+    written = 0
+    index = 0
+    segment = _read_full(source, stored)
+    while True:
+        following = _read_full(source, stored) if len(segment) == stored else b''
+        last = not following
+        written += destination.write(_open_segment(aes_key, header, index, last, segment))
+        if last:
+            return written
+        segment = following
+        index += 1
+
+def _decrypt_segment_range(encrypted_path, aes_key, header, first, count, total):
+    """Decrypt segments first..first+count-1 of a STREAM payload file (runs in a worker thread)."""
+    stored = header['segment_size'] + STREAM_TAG_SIZE
+    with open(encrypted_path, 'rb') as f:
+        f.seek(header['header_size'] + first * stored)
+        data = f.read(count * stored)
+    return b''.join(_open_segment(aes_key, header, index, index == total - 1,
+                                  data[(index - first) * stored:(index - first + 1) * stored])
+                    for index in range(first, first + count))
+
+def _decrypt_segments_parallel(encrypted_path, destination, aes_key, header, workers, max_size=None):
+    """
+    Decrypt a STREAM payload file with several threads.
+    
+    Segments sit at fixed offsets, so ranges of them are decrypted independently
+    (PyCryptodome releases the GIL while it encrypts). Results are written in
+    order, and only a bounded number of ranges is in flight at once; compressed
+    payloads are decompressed as the ranges are written.
+    """
+    total = _segment_count(header, os.path.getsize(encrypted_path) - header['header_size'])
+    ranges = [(first, min(SEGMENTS_PER_TASK, total - first)) for first in range(0, total, SEGMENTS_PER_TASK)]
+    workers = workers or os.cpu_count() or 1
+    destination = _decompressing(header, destination, max_size)
+    written = 0
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for first, count in ranges:
+            in_flight.append(executor.submit(_decrypt_segment_range, encrypted_path, aes_key,
+                                             header, first, count, total))
+            if len(in_flight) >= 2 * workers:
+                written += destination.write(in_flight.popleft().result())
+        while in_flight:
+            written += destination.write(in_flight.popleft().result())
+    return written + _finish(destination)
+
+def decrypt_to_path(encrypted_path, output_path, aes_key, chunk_size=DECRYPT_CHUNK_SIZE, workers=None, max_size=None):
+    """
+    Decrypt an encrypted payload file into output_path with constant memory.
+    
+    The plaintext is written to a temporary file next to output_path, which is
+    renamed into place only after the whole payload decrypted successfully, so
+    output_path never holds a partial or unverified file.
+    
+    Args:
+        encrypted_path: Path to the encrypted payload
+        output_path: Path for the decrypted file
+        aes_key: The AES key (bytes)
+        chunk_size: Bytes read per chunk
+        workers: Threads used for AES-GCM STREAM payloads (default: CPU count,
+                 1 decrypts sequentially)
+        max_size: Largest plaintext a compressed payload may inflate to
+                  (default MAX_DECOMPRESSED_SIZE)
+        
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    directory = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.decrypt-', suffix='.part')
+    try:
+        with open(encrypted_path, 'rb') as source, os.fdopen(fd, 'wb') as destination:
+            header, _ = _read_envelope_header(source)
+            source.seek(0)
+            if (header and header['mode'] == MODE_AES_GCM_STREAM and workers != 1
+                    and os.path.getsize(encrypted_path) > SEGMENTS_PER_TASK * header['segment_size']):
+                _decrypt_segments_parallel(encrypted_path, destination, aes_key, header, workers, max_size)
+            else:
+                decrypt_stream(source, destination, aes_key, chunk_size, max_size)
+            destination.flush()
+            os.fsync(destination.fileno())
+        os.replace(temp_path, output_path)
+        return True
+    except Exception as e:
+        logger.error(f"Error decrypting {encrypted_path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
 def format_keypair_for_json(private_key, public_key, key_id):
     """
     Format a key pair for storage in a JSON file.
@@ -219,22 +572,46 @@ def format_keypair_for_json(private_key, public_key, key_id):
         'public_key': public_key.decode('utf-8')
     }
 
-def create_keypair_json(count=10, output_path=None):
+def _generate_keypair_pem(bits):
+    """Generate one RSA key pair as PEM strings (runs in a worker process)."""
+    key = RSA.generate(bits)
+    return key.export_key().decode('utf-8'), key.publickey().export_key().decode('utf-8')
+
+def generate_rsa_keypairs(count, bits=2048, workers=None):
+    """
+    Generate RSA key pairs in parallel on a process pool.
+    
+    Args:
+        count: Number of key pairs to generate
+        bits: Key size in bits (default: 2048)
+        workers: Number of worker processes (default: CPU count)
+        
+    Yields:
+        tuple: (private_key, public_key) as PEM strings, as soon as each is ready
+    """
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(_generate_keypair_pem, bits) for _ in range(count)]
+        for future in as_completed(futures):
+            yield future.result()
+
+def create_keypair_json(count=10, output_path=None, workers=None):
     """
     Create multiple RSA key pairs and save them to a JSON file.
     
     Args:
         count: Number of key pairs to generate
         output_path: Path to save the JSON file
+        workers: Number of worker processes (default: CPU count)
         
     Returns:
         dict: A dictionary containing all key pairs
     """
     key_pairs = {}
-    for i in range(1, count + 1):
-        private_key, public_key = generate_rsa_keypair()
-        if private_key and public_key:
-            key_pairs[str(i)] = private_key.decode('utf-8')
+    try:
+        for i, (private_key, _) in enumerate(generate_rsa_keypairs(count, workers=workers), start=1):
+            key_pairs[str(i)] = private_key
+    except Exception as e:
+        logger.error(f"Error generating RSA key pairs: {e}")
     
     if output_path and key_pairs:
         try:
@@ -244,4 +621,4 @@ def create_keypair_json(count=10, output_path=None):
         except Exception as e:
             logger.error(f"Error saving key pairs to {output_path}: {e}")
     
-    return key_pairs
\ No newline at end of file
+    return key_pairs
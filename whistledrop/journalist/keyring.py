@@ -0,0 +1,126 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+
+logger = logging.getLogger(__name__)
+
+# Number of parsed private keys kept in memory at once
+DEFAULT_CACHE_SIZE = 256
+
+class KeyRing:
+    """
+    The journalist's private RSA keys, parsed on first use and cached.
+
+    Parsing a PEM key (and the CRT precomputation that comes with it) is done once
+    per key; the resulting PKCS1_OAEP cipher objects are kept in an LRU cache so a
+    bulk run pays the setup cost once per key instead of once per file.
+    """
+
+    def __init__(self, keys=None, max_cached=DEFAULT_CACHE_SIZE):
+        """
+        Initialize the key ring.
+
+        Args:
+            keys: Mapping of key ID to private key PEM string
+            max_cached: Maximum number of parsed keys kept in memory
+        """
+        self._pem = {str(key_id): pem for key_id, pem in (keys or {}).items()}
+        self._ciphers = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_cached = max_cached
+
+    @classmethod
+    def from_file(cls, path, max_cached=DEFAULT_CACHE_SIZE):
+        """Load a key ring from a keys.json file (key ID -> private key PEM)."""
+        with open(path, 'r') as f:
+            return cls(json.load(f), max_cached=max_cached)
+
+    def __len__(self):
+        return len(self._pem)
+
+    def __contains__(self, key_id):
+        return str(key_id) in self._pem
+
+    def export(self):
+        """Return the key ID -> PEM mapping, e.g. to build a key ring in another process."""
+        return dict(self._pem)
+
+    def pem(self, key_id):
+        """Return the PEM string of a key, or None if it is not in the ring."""
+        return self._pem.get(str(key_id))
+
+    def cipher(self, key_id):
+        """
+        Return a PKCS1_OAEP cipher for a private key, parsing it on first use.
+
+        Args:
+            key_id: ID of the key
+
+        Returns:
+            The cipher object
+
+        Raises:
+            KeyError: If the key is not in the ring
+        """
+        key_id = str(key_id)
+        with self._lock:
+            cipher = self._ciphers.get(key_id)
+            if cipher is not None:
+                self._ciphers.move_to_end(key_id)
+                return cipher
+
+        # Parse outside the lock so other keys can be served meanwhile
+        cipher = PKCS1_OAEP.new(RSA.import_key(self._pem[key_id]))
+
+        with self._lock:
+            self._ciphers[key_id] = cipher
+            self._ciphers.move_to_end(key_id)
+            while len(self._ciphers) > self.max_cached:
+                self._ciphers.popitem(last=False)
+        return cipher
+
+    def unwrap(self, key_id, wrapped_key):
+        """
+        Decrypt a wrapped AES key with the private key key_id.
+
+        Args:
+            key_id: ID of the RSA key the AES key was wrapped with
+            wrapped_key: The RSA-encrypted AES key (bytes)
+
+        Returns:
+            bytes: The AES key, or None on failure
+        """
+        try:
+            return self.cipher(key_id).decrypt(wrapped_key)
+        except Exception as e:
+            logger.error(f"Error unwrapping AES key with key {key_id}: {e}")
+            return None
+
+    def unwrap_many(self, key_id, wrapped_keys):
+        """
+        Decrypt several wrapped AES keys that share the same RSA key.
+
+        Args:
+            key_id: ID of the RSA key
+            wrapped_keys: Iterable of RSA-encrypted AES keys (bytes)
+
+        Returns:
+            list: The AES keys, with None for any that failed
+        """
+        try:
+            cipher = self.cipher(key_id)
+        except Exception as e:
+            logger.error(f"Error loading key {key_id}: {e}")
+            return [None for _ in wrapped_keys]
+
+        aes_keys = []
+        for wrapped_key in wrapped_keys:
+            try:
+                aes_keys.append(cipher.decrypt(wrapped_key))
+            except Exception as e:
+                logger.error(f"Error unwrapping AES key with key {key_id}: {e}")
+                aes_keys.append(None)
+        return aes_keys
@@ -4,11 +4,9 @@ import sys
 import argparse
 import logging
 import json
-from server.app import create_app
-from server.db_init import init_db, check_keys_available  # Remove add_test_keys
-from server.models import db, RSAKey, UploadedFile
-from journalist.crypto import create_keypair_json, generate_rsa_keypair
-from Crypto.PublicKey import RSA
+import shutil
+import tempfile
+from contextlib import contextmanager
 from datetime import datetime
 
 # Setup logging
@@ -18,12 +16,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger('manage')
 
-app = create_app()
+# Private keys of the generated key pairs, for the journalists
+KEYS_FILE = 'keys.json'
+
+# Flask, SQLAlchemy and PyCryptodome are imported by the commands that need them,
+# so `--help` and argument errors return immediately
+_app = None
+
+def get_app():
+    """Build the app on first use and reuse it for the rest of the command."""
+    global _app
+    if _app is None:
+        from server.app import create_app
+        _app = create_app()
+    return _app
 
 def init_database(args):
     """Initialize the database with tables."""
+    from server.models import db
+    from server.db_init import upgrade_schema
+    from server.keyimport import backfill_fingerprints
+    
+    app = get_app()
     with app.app_context():
         db.create_all()
+        upgrade_schema(app)
+        backfill_fingerprints(app)
         logger.info("Database tables created successfully.")
         
         if args.with_keys:
@@ -32,93 +50,161 @@ def init_database(args):
 
 def status(args):
     """Show the current status of the database and keys."""
+    from server.reporting import status_report, write_json, write_text
+    from server.db_init import upgrade_schema
+    
+    app = get_app()
+    # Databases from older versions lack columns the report queries
+    upgrade_schema(app)
     with app.app_context():
-        total_keys = RSAKey.query.count()
-        available_keys = RSAKey.query.filter_by(is_used=False).count()
-        total_files = UploadedFile.query.count()
-        
-        print("\n=== WhistleDrop Status ===")
-        print(f"Database status: {'OK' if db else 'Not connected'}")
-        print(f"Total RSA keys: {total_keys}")
-        print(f"Available keys: {available_keys}")
-        print(f"Used keys: {total_keys - available_keys}")
-        print(f"Uploaded files: {total_files}")
+        report = status_report(period=args.period, window_days=args.window_days, include_keys=args.keys)
+        private_keys = _count_private_keys(KEYS_FILE)
         
-        if total_keys == 0:
-            print("\nWARNING: No RSA keys in database. Run 'python manage.py generate' to add keys.")
-        elif available_keys == 0:
-            print("\nWARNING: No available RSA keys! Uploads will fail until keys are added.")
+        if args.json:
+            report['private_keys_file'] = private_keys
+            write_json(report, sys.stdout)
+            return
         
-        print("\nKey usage:")
-        used_keys = RSAKey.query.filter_by(is_used=True).all()
-        for key in used_keys:
-            file = UploadedFile.query.filter_by(key_id=key.id).first()
-            if file:
-                print(f"  Key ID {key.id}: Used for file '{file.filename}' on {file.created_at}")
-            else:
-                print(f"  Key ID {key.id}: Marked as used but no file found")
+        write_text(report, sys.stdout)
         
         # Check if keys.json exists and contains keys
-        if os.path.exists('keys.json'):
-            try:
-                with open('keys.json', 'r') as f:
-                    private_keys = json.load(f)
-                print(f"\nPrivate keys in keys.json: {len(private_keys)}")
-            except:
-                print("\nERROR: keys.json exists but could not be parsed")
-        else:
+        if private_keys is None:
             print("\nWARNING: No keys.json file found. Journalists will not be able to decrypt files.")
+        elif private_keys < 0:
+            print("\nERROR: keys.json exists but could not be parsed")
+        else:
+            print(f"\nPrivate keys in keys.json: {private_keys}")
+
+def _count_private_keys(path):
+    """Number of private keys in a key file; None if it does not exist, -1 if it cannot be parsed."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return len(json.load(f))
+    except (OSError, ValueError):
+        return -1
 
 def generate_keys(args):
-    """Generate new RSA test keys and save them to keys.json."""
-    # Generate key pairs and save to keys.json
-    key_pairs = create_keypair_json(count=args.count, output_path="keys.json")
-    logger.info(f"Generated {len(key_pairs)} RSA key pairs and saved private keys to keys.json")
+    """Generate new RSA key pairs in parallel and add the private keys to keys.json."""
+    from server.models import db, RSAKey
+    from server.keyimport import public_key_fingerprint
+    from journalist.crypto import generate_rsa_keypairs
+    
+    count = args.count
+    workers = getattr(args, 'workers', None)
     
-    # Update database with public keys
+    app = get_app()
     with app.app_context():
-        # Delete existing keys if requested
-        if args.reset:
-            RSAKey.query.delete()
-            db.session.commit()
-            logger.info("Cleared existing RSA keys from database")
-        
-        # Add new keys to database
-        added_keys = 0
-        for key_id, private_key in key_pairs.items():
-            # Extract public key from private key
-            key = RSA.import_key(private_key)
-            public_key = key.publickey().export_key().decode('utf-8')
+        # Private keys are staged in a private temporary file as they arrive; it is removed whatever happens
+        fd, staged_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(KEYS_FILE)), prefix='.keys-', suffix='.tmp')
+        try:
+            created_at = datetime.now()
+            rows = []
+            progress_step = max(1, count // 20)
+            with os.fdopen(fd, 'w') as f:
+                for i, (private_key, public_key) in enumerate(generate_rsa_keypairs(count, workers=workers)):
+                    fingerprint = public_key_fingerprint(public_key)
+                    f.write(json.dumps([fingerprint, private_key]) + "\n")
+                    rows.append({'public_key': public_key, 'fingerprint': fingerprint,
+                                 'is_used': False, 'created_at': created_at})
+                    
+                    if (i + 1) % progress_step == 0 or i + 1 == count:
+                        logger.info(f"Generated {i + 1}/{count} RSA key pairs")
             
-            # Add to database
-            new_key = RSAKey(public_key=public_key, is_used=False)
-            db.session.add(new_key)
-            added_keys += 1
-        
-        db.session.commit()
-        logger.info(f"Added {added_keys} public keys to database")
-        
-        # Now update keys.json with actual database IDs
-        keys = RSAKey.query.all()
-        updated_keys = {}
-        
-        for i, key in enumerate(keys[-args.count:]):  # Only process the new keys
-            if str(i+1) in key_pairs:
-                private_key = key_pairs[str(i+1)]
-                # Save with actual database ID
-                updated_keys[str(key.id)] = private_key
+            with _locked(f"{KEYS_FILE}.lock"):
+                # Delete existing keys if requested; their private keys stay in a backup of keys.json
+                if args.reset:
+                    RSAKey.query.delete()
+                    if os.path.exists(KEYS_FILE):
+                        backup = f"{KEYS_FILE}.{datetime.now():%Y%m%d%H%M%S}.bak"
+                        shutil.copy2(KEYS_FILE, backup)
+                        logger.info(f"Copied the previous {KEYS_FILE} to {backup}")
+                    logger.info("Cleared existing RSA keys from database")
+                
+                # The database assigns the IDs within this transaction, so a concurrent
+                # generate or import-keys cannot end up with the same ones
+                if rows:
+                    db.session.execute(RSAKey.__table__.insert(), rows)
+                ids = _ids_by_fingerprint([row['fingerprint'] for row in rows])
+                
+                # keys.json is written before the public keys are committed, so no key can
+                # be handed out for uploads without its private key having been saved
+                _add_private_keys(KEYS_FILE, staged_path, ids, merge=not args.reset)
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
         
-        # Overwrite keys.json with updated IDs
-        with open("keys.json", 'w') as f:
-            json.dump(updated_keys, f, indent=2)
-        
-        logger.info(f"Updated keys.json with {len(updated_keys)} keys (IDs matched to database)")
+        logger.info(f"Added {len(rows)} public keys to database")
+        if rows:
+            logger.info(f"Saved {len(rows)} private keys to {KEYS_FILE} (IDs {min(ids.values())}-{max(ids.values())})")
         
         # Return the number of keys added
-        return added_keys
+        return len(rows)
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive lock on path (created if missing) for the duration of the block."""
+    import fcntl
+    
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _ids_by_fingerprint(fingerprints, batch_size=500):
+    """Database IDs of the keys with the given fingerprints, as fingerprint -> ID."""
+    from server.models import db, RSAKey
+    
+    ids = {}
+    for first in range(0, len(fingerprints), batch_size):
+        batch = fingerprints[first:first + batch_size]
+        ids.update((fingerprint, key_id) for key_id, fingerprint in
+                   db.session.query(RSAKey.id, RSAKey.fingerprint).filter(RSAKey.fingerprint.in_(batch)))
+    return ids
+
+def _add_private_keys(path, staged_path, ids, merge=True):
+    """
+    Write staged (fingerprint, private key) lines into the key file under their database IDs.
+    
+    With merge, keys already in the file are kept; if an ID already holds a
+    different private key, nothing is written and RuntimeError is raised.
+    """
+    keys = {}
+    if merge and os.path.exists(path):
+        with open(path, 'r') as f:
+            keys = json.load(f)
+    
+    with open(staged_path, 'r') as f:
+        for line in f:
+            fingerprint, private_key = json.loads(line)
+            key_id = str(ids[fingerprint])
+            if keys.get(key_id, private_key) != private_key:
+                raise RuntimeError(f"{path} already holds a different private key for ID {key_id}")
+            keys[key_id] = private_key
+    
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.keys-', suffix='.new')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(keys, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 def reset_database(args):
     """Reset the database by dropping all tables and recreating them."""
+    from server.models import db
+    
+    app = get_app()
     with app.app_context():
         if args.confirm:
             db.drop_all()
@@ -128,14 +214,19 @@ def reset_database(args):
             
             if args.with_keys:
                 count = args.count if hasattr(args, 'count') else 5
-                generate_keys(argparse.Namespace(count=count, reset=False))
+                generate_keys(argparse.Namespace(count=count, reset=True))  # The old keys.json no longer matches the emptied key table
         else:
             logger.warning("Database reset canceled. Use --confirm to proceed.")
 
 def list_files(args):
     """List all files in the database."""
+    from server.models import db, UploadedFile, FILE_METADATA_COLUMNS
+    from server.db_init import upgrade_schema
+    
+    app = get_app()
+    upgrade_schema(app)
     with app.app_context():
-        files = UploadedFile.query.all()
+        files = db.session.query(*FILE_METADATA_COLUMNS).order_by(UploadedFile.id).all()
         
         if not files:
             print("No files found in the database.")
@@ -147,23 +238,194 @@ def list_files(args):
             print(f"Filename: {file.filename}")
             print(f"Uploaded: {file.created_at}")
             print(f"Key ID: {file.key_id}")
+            if file.submission_id is not None:
+                print(f"Submission: {file.submission_id}")
             print("-" * 30)
 
 def clear_files(args):
     """Remove all uploaded files from the database."""
+    from server.models import db, RSAKey, Submission, UploadedFile
+    from server.storage import get_blob_store
+    
+    app = get_app()
     with app.app_context():
         if args.confirm:
             count = UploadedFile.query.count()
+            blob_refs = [row.blob_ref for row in db.session.query(UploadedFile.blob_ref).filter(UploadedFile.blob_ref.isnot(None))]
             UploadedFile.query.delete()
+            Submission.query.delete()
             
             # Reset used status on keys
-            RSAKey.query.filter_by(is_used=True).update({RSAKey.is_used: False, RSAKey.used_at: None})
+            RSAKey.query.filter_by(is_used=True).update({RSAKey.is_used: False, RSAKey.used_at: None, RSAKey.lease_owner: None})
             
             db.session.commit()
+            
+            store = get_blob_store()
+            for blob_ref in blob_refs:
+                store.delete(blob_ref)
             logger.info(f"Removed {count} files from database and reset key usage.")
         else:
             logger.warning("File purge canceled. Use --confirm to proceed.")
 
+def migrate_envelopes(args):
+    """Convert legacy JSON payloads into binary envelopes (no decryption needed)."""
+    from server.crypto import is_legacy_blob, legacy_blob_to_envelope
+    from server.storage import get_blob_store, load_payload
+    from server.models import db, UploadedFile
+    from server.db_init import upgrade_schema
+    
+    app = get_app()
+    with app.app_context():
+        upgrade_schema(app)
+        store = get_blob_store()
+        file_ids = [row.id for row in db.session.query(UploadedFile.id).order_by(UploadedFile.id)]
+        converted = 0
+        
+        for file_id in file_ids:
+            file = db.session.get(UploadedFile, file_id)
+            payload = load_payload(file)
+            if not is_legacy_blob(payload):
+                continue
+            
+            envelope = legacy_blob_to_envelope(payload, file.key_id)
+            if file.blob_ref:
+                with store.writer() as blob:
+                    blob.write(envelope)
+                    blob_info = blob.commit()
+                old_ref = file.blob_ref
+                file.blob_ref = blob_info.ref
+                file.blob_size = blob_info.size
+                file.blob_digest = blob_info.digest
+                db.session.commit()
+                store.delete(old_ref)
+            else:
+                file.encrypted_data = envelope
+            converted += 1
+            
+            # Commit in small batches so only a few payloads are held at once
+            if converted % args.batch_size == 0:
+                db.session.commit()
+                db.session.expunge_all()
+        
+        db.session.commit()
+        logger.info(f"Converted {converted} of {len(file_ids)} files to the binary envelope format.")
+
+def migrate_blobs(args):
+    """Move payloads stored inline in the database into the blob store."""
+    from server.storage import get_blob_store
+    from server.models import db, UploadedFile
+    from server.db_init import upgrade_schema
+    
+    app = get_app()
+    with app.app_context():
+        upgrade_schema(app)
+        store = get_blob_store()
+        file_ids = [row.id for row in db.session.query(UploadedFile.id)
+                    .filter(UploadedFile.blob_ref.is_(None), UploadedFile.encrypted_data.isnot(None))
+                    .order_by(UploadedFile.id)]
+        moved = 0
+        
+        for file_id in file_ids:
+            file = db.session.get(UploadedFile, file_id)
+            with store.writer() as blob:
+                blob.write(file.encrypted_data)
+                blob_info = blob.commit()
+            
+            file.blob_ref = blob_info.ref
+            file.blob_size = blob_info.size
+            file.blob_digest = blob_info.digest
+            file.encrypted_data = None
+            moved += 1
+            
+            # Commit in small batches so only a few payloads are held at once
+            if moved % args.batch_size == 0:
+                db.session.commit()
+                db.session.expunge_all()
+        
+        db.session.commit()
+        logger.info(f"Moved {moved} payloads from the database into the blob store.")
+        
+        if args.vacuum and db.engine.dialect.name == 'sqlite':
+            with db.engine.connect() as connection:
+                connection.execute(db.text('VACUUM'))
+            logger.info("Database file compacted.")
+
+def import_key_file(args):
+    """Bulk import public keys from a JSON list or PEM bundle."""
+    if not os.path.exists(args.file):
+        logger.error(f"Key file not found: {args.file}")
+        sys.exit(1)
+    
+    from server.db_init import upgrade_schema
+    from server.keyimport import import_keys
+    
+    app = get_app()
+    upgrade_schema(app)
+    result = import_keys(app, args.file, batch_size=args.batch_size, workers=args.workers)
+    print(f"Imported:   {result.imported}")
+    print(f"Duplicates: {result.duplicates}")
+    print(f"Invalid:    {result.invalid}")
+
+def db_bench(args):
+    """Measure read/write contention on the configured database."""
+    from server.db_init import upgrade_schema
+    from benchmarks.dbbench import run_benchmark
+    
+    app = get_app()
+    upgrade_schema(app)
+    result = run_benchmark(app, seconds=args.seconds, readers=args.readers, writers=args.writers)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    
+    print("\n===== Database Benchmark =====")
+    for setting in ('backend', 'pool', 'journal_mode', 'synchronous', 'busy_timeout', 'readers', 'writers', 'seconds'):
+        if setting in result:
+            print(f"{setting + ':':<15}{result[setting]}")
+    print(f"\n{'':<8}{'ops':>8}{'ops/s':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind in ('read', 'write'):
+        r = result[kind]
+        print(f"{kind:<8}{r['ops']:>8}{r['ops_per_second']:>10}{r['errors']:>8}"
+              f"{str(r['p50_ms']):>10}{str(r['p95_ms']):>10}{str(r['p99_ms']):>10}")
+
+def loadtest(args):
+    """Run concurrent submitters and retrievers against a local (or given) server."""
+    from benchmarks.loadtest import local_server, parse_size, run_loadtest
+    
+    options = dict(submitters=args.submitters, retrievers=args.retrievers, duration=args.duration,
+                   sizes=args.sizes, max_size=parse_size(args.max_size),
+                   bandwidth=parse_size(args.bandwidth) if args.bandwidth else None,
+                   latency=args.latency, think_time=args.think_time, poll_interval=args.poll_interval, seed=args.seed)
+    if args.url:
+        result = run_loadtest(args.url.rstrip('/'), **options)
+    else:
+        with local_server(keys=args.keys, workers=args.workers, threads=args.threads) as url:
+            result = run_loadtest(url, **options)
+    
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    
+    print("\n===== Load Test =====")
+    for setting in ('url', 'submitters', 'retrievers', 'seconds', 'sizes', 'bandwidth', 'latency', 'seed'):
+        print(f"{setting + ':':<15}{result[setting]}")
+    print(f"\n{'':<10}{'ok':>7}{'ops/s':>9}{'KiB/s':>10}{'err %':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  errors")
+    for kind in ('upload', 'list', 'retrieve'):
+        r = result[kind]
+        errors = ', '.join(f"{name}={count}" for name, count in sorted(r['errors'].items())) or '-'
+        print(f"{kind:<10}{r['ok']:>7}{r['ops_per_second']:>9}{r['bytes_per_second'] // 1024:>10}"
+              f"{r['error_rate'] * 100:>8.1f}{str(r['p50_ms']):>10}{str(r['p95_ms']):>10}{str(r['p99_ms']):>10}  {errors}")
+    keys = result['keys']
+    print(f"\nKeys available: {keys['available_start']} -> {keys['available_end']} "
+          f"({keys['drained_per_minute']} per minute)")
+    if keys['exhausted_after_s'] is not None:
+        print(f"WARNING: Key pool ran empty after {keys['exhausted_after_s']} seconds")
+
+def serve(args):
+    """Run the production server (gunicorn) with database setup and Tor done once in the master."""
+    from server.serve import run
+    run(workers=args.workers, threads=args.threads)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='WhistleDrop Management Tool')
     subparsers = parser.add_subparsers(dest='command', help='Command to run')
@@ -176,12 +438,17 @@ if __name__ == '__main__':
     
     # status command
     status_parser = subparsers.add_parser('status', help='Show database and key status')
+    status_parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    status_parser.add_argument('--period', choices=['day', 'week'], default='day', help='Group upload counts by day or week (default: day)')
+    status_parser.add_argument('--window-days', type=int, default=7, help='Days of key usage the exhaustion projection is based on (default: 7)')
+    status_parser.add_argument('--keys', action='store_true', help='Also list the file each used key was used for')
     status_parser.set_defaults(func=status)
     
     # generate command
     generate_parser = subparsers.add_parser('generate', help='Generate RSA key pairs')
     generate_parser.add_argument('--count', type=int, default=5, help='Number of keys to generate (default: 5)')
     generate_parser.add_argument('--reset', action='store_true', help='Clear existing keys before adding new ones')
+    generate_parser.add_argument('--workers', type=int, default=None, help='Key generation processes (default: CPU count)')
     generate_parser.set_defaults(func=generate_keys)
     
     # reset command
@@ -200,6 +467,57 @@ if __name__ == '__main__':
     clear_parser.add_argument('--confirm', action='store_true', help='Confirm file removal')
     clear_parser.set_defaults(func=clear_files)
     
+    # db-bench command
+    bench_parser = subparsers.add_parser('db-bench', help='Measure read/write contention on the configured database')
+    bench_parser.add_argument('--seconds', type=float, default=5.0, help='Duration of the run (default: 5)')
+    bench_parser.add_argument('--readers', type=int, default=4, help='Concurrent reader threads (default: 4)')
+    bench_parser.add_argument('--writers', type=int, default=2, help='Concurrent writer threads (default: 2)')
+    bench_parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    bench_parser.set_defaults(func=db_bench)
+    
+    # serve command
+    serve_parser = subparsers.add_parser('serve', help='Run the production server with multiple workers')
+    serve_parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: SERVER_WORKERS)')
+    serve_parser.add_argument('--threads', type=int, default=None, help='Threads per worker (default: SERVER_THREADS)')
+    serve_parser.set_defaults(func=serve)
+    
+    # loadtest command
+    loadtest_parser = subparsers.add_parser('loadtest', help='Run concurrent uploads and retrievals against a local server')
+    loadtest_parser.add_argument('--submitters', type=int, default=8, help='Concurrent simulated whistleblowers (default: 8)')
+    loadtest_parser.add_argument('--retrievers', type=int, default=2, help='Concurrent simulated journalists (default: 2)')
+    loadtest_parser.add_argument('--duration', type=float, default=30.0, help='Seconds to generate load (default: 30)')
+    loadtest_parser.add_argument('--sizes', default='lognormal:256k', help='File sizes: fixed:SIZE, uniform:MIN-MAX or lognormal:MEDIAN (default: lognormal:256k)')
+    loadtest_parser.add_argument('--max-size', default='8m', help='Upper bound for file sizes (default: 8m)')
+    loadtest_parser.add_argument('--bandwidth', help='Per-client bandwidth, e.g. 64k for 64 KiB/s (default: unlimited)')
+    loadtest_parser.add_argument('--latency', type=float, default=0.0, help='Seconds added before every request, e.g. 0.5 for Tor (default: 0)')
+    loadtest_parser.add_argument('--think-time', type=float, default=0.0, help='Mean seconds a submitter waits between uploads (default: 0)')
+    loadtest_parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds between /files polls of a retriever (default: 2)')
+    loadtest_parser.add_argument('--seed', type=int, default=None, help='Random seed for file sizes')
+    loadtest_parser.add_argument('--keys', type=int, default=200, help='RSA keys for the local server (default: 200)')
+    loadtest_parser.add_argument('--workers', type=int, default=2, help='Worker processes of the local server (default: 2)')
+    loadtest_parser.add_argument('--threads', type=int, default=4, help='Threads per worker of the local server (default: 4)')
+    loadtest_parser.add_argument('--url', help='Test this running server instead of starting one')
+    loadtest_parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    loadtest_parser.set_defaults(func=loadtest)
+    
+    # import-keys command
+    import_parser = subparsers.add_parser('import-keys', help='Bulk import public keys from a JSON list or PEM bundle')
+    import_parser.add_argument('file', help='Key file to import')
+    import_parser.add_argument('--batch-size', type=int, default=1000, help='Keys inserted per transaction (default: 1000)')
+    import_parser.add_argument('--workers', type=int, default=None, help='Validation processes (default: CPU count)')
+    import_parser.set_defaults(func=import_key_file)
+    
+    # migrate-envelopes command
+    envelope_parser = subparsers.add_parser('migrate-envelopes', help='Convert legacy JSON payloads to binary envelopes')
+    envelope_parser.add_argument('--batch-size', type=int, default=50, help='Files converted per transaction (default: 50)')
+    envelope_parser.set_defaults(func=migrate_envelopes)
+    
+    # migrate-blobs command
+    blobs_parser = subparsers.add_parser('migrate-blobs', help='Move inline payloads from the database into the blob store')
+    blobs_parser.add_argument('--batch-size', type=int, default=50, help='Files moved per transaction (default: 50)')
+    blobs_parser.add_argument('--vacuum', action='store_true', help='Compact the SQLite database afterwards')
+    blobs_parser.set_defaults(func=migrate_blobs)
+    
     args = parser.parse_args()
     
     if hasattr(args, 'func'):
@@ -1,11 +1,8 @@
 from flask import Flask, request, url_for
 import os
 import logging
-from .config import Config
-from .routes import main as main_routes
-from .tor_service import TorService
-from .models import db
-from .db_init import setup_database
+import secrets
+from .config import Config, load_secret_key
 
 # Setup logging
 logging.basicConfig(
@@ -15,13 +12,29 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 def create_app(config_class=Config):
+    # Imported here so that importing this module stays cheap (ORM, crypto, Tor)
+    from .routes import main as main_routes
+    from . import database, storage, keypool, executor, metrics
+    
     app = Flask(__name__, 
                 template_folder='../templates',
                 static_folder='../static')
     app.config.from_object(config_class)
+    app.config['SECRET_KEY'] = _secret_key(app.config)
+    
+    # Set by the serve master once its Tor hidden service is up
+    if os.environ.get('ONION_DOMAIN'):
+        app.config['ONION_DOMAIN'] = os.environ['ONION_DOMAIN']
+    # Set by the serve master: where the workers share their metrics
+    if os.environ.get('METRICS_DIR'):
+        app.config['METRICS_DIR'] = os.environ['METRICS_DIR']
     
-    # Initialize database
-    db.init_app(app)
+    # Initialize database and payload storage
+    database.init_app(app)
+    storage.init_app(app)
+    keypool.init_app(app)
+    executor.init_app(app)
+    metrics.init_app(app)
     
     # Register routes
     app.register_blueprint(main_routes)
@@ -40,8 +53,28 @@ def create_app(config_class=Config):
     
     return app
 
-def main():
-    app = create_app()
+def _secret_key(config):
+    """
+    The configured secret key, else the one a serve master passed down, else the key
+    in SECRET_KEY_FILE; without any of them a random key that lasts until the server stops.
+    """
+    secret_key = config.get('SECRET_KEY') or os.environ.get('SECRET_KEY')
+    if secret_key:
+        return secret_key
+    if config.get('SECRET_KEY_FILE'):
+        return load_secret_key(config['SECRET_KEY_FILE'])
+    logger.warning("Neither SECRET_KEY nor SECRET_KEY_FILE is set; using a random secret key. "
+                   "Sessions and flash messages will not survive a restart.")
+    return secrets.token_hex(32)
+
+def prepare_server(app):
+    """
+    One-time startup work: set up the database and start the Tor hidden service.
+    
+    Returns the running TorService, or None if Tor is disabled or unavailable.
+    """
+    from .db_init import setup_database
+    from .tor_service import TorService
     
     # Initialize the database and load RSA keys
     logger.info("Initializing database...")
@@ -62,38 +95,57 @@ def main():
         logger.info(f"{available_keys} RSA public keys available for encryption")
     
     # Initialize Tor service
-    if app.config.get('USE_TOR', True):
-        logger.info("Initializing Tor service...")
-        tor_service = TorService(
-            tor_control_port=app.config.get('TOR_CONTROL_PORT', 9051),
-            web_port=app.config.get('PORT', 5000),
-            hidden_service_dir=app.config.get('HIDDEN_SERVICE_DIR')
-        )
-        
-        try:
-            # Start the Tor hidden service
-            onion_address = tor_service.start()
-            if onion_address:
-                app.config['ONION_DOMAIN'] = f"{onion_address}.onion"
-                logger.info(f"WhistleDrop is available at: http://{onion_address}.onion")
-            else:
-                logger.warning("Failed to start Tor hidden service. Running in clearnet mode.")
-        except Exception as e:
-            logger.error(f"Error starting Tor service: {e}")
-            logger.warning("Running in clearnet mode only")
-    else:
+    if not app.config.get('USE_TOR', True):
         logger.info("Tor integration disabled. Running in clearnet mode.")
+        return None
+    
+    logger.info("Initializing Tor service...")
+    tor_service = TorService(
+        tor_control_port=app.config.get('TOR_CONTROL_PORT', 9051),
+        web_port=app.config.get('PORT', 5000),
+        hidden_service_dir=app.config.get('HIDDEN_SERVICE_DIR')
+    )
+    
+    try:
+        # Start the Tor hidden service
+        onion_address = tor_service.start()
+        if onion_address:
+            app.config['ONION_DOMAIN'] = f"{onion_address}.onion"
+            logger.info(f"WhistleDrop is available at: http://{onion_address}.onion")
+            return tor_service
+        logger.warning("Failed to start Tor hidden service. Running in clearnet mode.")
+    except Exception as e:
+        logger.error(f"Error starting Tor service: {e}")
+        logger.warning("Running in clearnet mode only")
+    return None
+
+def main():
+    # Production: multi-process server, see server/serve.py (builds its own app)
+    if not Config.DEBUG:
+        from .serve import run
+        run()
+        return
+    
+    from .keypool import start_lease_expiry
+    
+    app = create_app()
+    prepare_server(app)
+    start_lease_expiry(app)
     
-    # Run the Flask app
+    # Run Flask's development server
     host = app.config.get('HOST', '127.0.0.1')
     port = app.config.get('PORT', 5000)
-    debug = app.config.get('DEBUG', False)
     
-    logger.info(f"Starting WhistleDrop server on {host}:{port}")
-    app.run(host=host, port=port, debug=debug)
+    logger.info(f"Starting WhistleDrop development server on {host}:{port}")
+    app.run(host=host, port=port, debug=True)
 
-# Make the app importable
-app = create_app()
+def __getattr__(name):
+    """Build the module-level app on first access (e.g. `from server.app import app`)."""
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
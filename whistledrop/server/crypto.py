@@ -4,38 +4,326 @@ from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
 import base64
 import json
+import io
+import math
+import struct
+import zlib
+from collections import Counter
+
+# Plaintext is read and encrypted in chunks of this size (a multiple of the AES block size)
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Binary envelope: magic, format version, cipher mode, compression, IV length and
+# key id, followed by the IV and the raw ciphertext
+ENVELOPE_MAGIC = b'WDRP'
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct('>4sBBBBI')
+MODE_AES_CBC = 1
+MODE_AES_GCM_STREAM = 2
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+# Mode names accepted in Config.ENCRYPTION_MODE
+CIPHER_MODES = {'aes-cbc': MODE_AES_CBC, 'aes-gcm-stream': MODE_AES_GCM_STREAM}
+
+# Compression names accepted in Config.COMPRESSION
+COMPRESSION_MODES = {'none': COMPRESSION_NONE, 'zlib': COMPRESSION_ZLIB}
+
+# Compression sniffing: the start of an upload is checked for the signature of
+# an already compressed format, and for near-random bytes (bits per byte)
+SNIFF_SIZE = 64 * 1024
+ENTROPY_THRESHOLD = 7.5
+COMPRESSED_SIGNATURES = (
+    b'\xff\xd8\xff',            # JPEG
+    b'\x89PNG\r\n\x1a\n',       # PNG
+    b'GIF87a', b'GIF89a',       # GIF
+    b'PK\x03\x04',              # ZIP, including DOCX/XLSX/PPTX/ODF
+    b'\x1f\x8b',                # gzip
+    b'BZh',                     # bzip2
+    b'\xfd7zXZ\x00',            # xz
+    b'7z\xbc\xaf\x27\x1c',      # 7-Zip
+    b'Rar!\x1a\x07',            # RAR
+    b'\x28\xb5\x2f\xfd',        # Zstandard
+    b'OggS',                    # Ogg audio/video
+    b'\x1aE\xdf\xa3',           # Matroska/WebM
+    b'ID3',                     # MP3
+)
+
+# AES-GCM STREAM mode: the plaintext is split into fixed-size segments, each sealed
+# with its own tag. The IV field of the envelope holds the random nonce prefix and
+# the segment size; a segment's nonce is prefix || segment index || last-segment flag,
+# and the whole envelope header is authenticated with every segment.
+STREAM_PARAMS = struct.Struct('>7sI')
+STREAM_NONCE_PREFIX_SIZE = 7
+STREAM_TAG_SIZE = 16
+
+class EncryptionCancelled(Exception):
+    """Raised when encryption is stopped through its cancel flag."""
 
 def generate_aes_key():
     """Generate a random AES key."""
     return get_random_bytes(16)  # AES-128
 
-def encrypt_file(file_data, aes_key):
-    """Encrypt the file data using AES encryption."""
-    cipher = AES.new(aes_key, AES.MODE_CBC)
-    padded_data = pad(file_data, AES.block_size)
-    ct_bytes = cipher.encrypt(padded_data)
+def _entropy(sample):
+    """Shannon entropy of sample in bits per byte."""
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in Counter(sample).values())
+
+def is_compressible(sample):
+    """
+    Guess from the start of a file whether compressing it is worthwhile.
+    
+    Known compressed formats (images, archives, Office documents, media) are
+    skipped by their signature; anything else whose bytes look random is
+    assumed to be compressed or encrypted already.
+    """
+    if not sample:
+        return False
+    if sample.startswith(COMPRESSED_SIGNATURES) or sample[4:12] in (b'ftypisom', b'ftypmp42', b'ftypqt  '):
+        return False
+    return _entropy(sample) < ENTROPY_THRESHOLD
+
+def choose_compression(source, compression):
+    """
+    Decide the compression for an upload stream by sniffing its first bytes.
+    
+    Returns (source, compression); source is rewound after the sniff, or
+    wrapped so the sniffed bytes are read again if it cannot seek.
+    """
+    if compression == COMPRESSION_NONE:
+        return source, compression
+    if compression not in COMPRESSION_MODES.values():
+        raise ValueError(f"Unsupported compression {compression}")
+    
+    sample = _read_full(source, SNIFF_SIZE)
+    if hasattr(source, 'seekable') and source.seekable():
+        source.seek(-len(sample), io.SEEK_CUR)
+    else:
+        source = _PrefixedReader(sample, source)
+    return source, (compression if is_compressible(sample) else COMPRESSION_NONE)
+
+class _PrefixedReader:
+    """Reads prefix, then the rest of source."""
+    
+    def __init__(self, prefix, source):
+        self.prefix = prefix
+        self.source = source
+    
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.source.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.source.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+class _CompressingReader:
+    """Reads source through a zlib compressor, so the compressed data can be encrypted as a stream."""
+    
+    def __init__(self, source, level=6, read_size=DEFAULT_CHUNK_SIZE):
+        self.source = source
+        self.read_size = read_size
+        self._compressor = zlib.compressobj(level)
+        self._buffer = bytearray()
+        self._done = False
+    
+    def read(self, size=-1):
+        while not self._done and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self.source.read(self.read_size)
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._done = True
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+def build_envelope_header(iv, key_id, mode=MODE_AES_CBC, compression=COMPRESSION_NONE):
+    """Build the binary envelope header that precedes the raw ciphertext."""
+    return ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, mode, compression, len(iv), key_id or 0) + iv
+
+def parse_envelope_header(data):
+    """
+    Parse an envelope header from the start of data.
     
-    # Return IV and ciphertext for storage
-    result = {
-        'iv': base64.b64encode(cipher.iv).decode('utf-8'),
-        'ciphertext': base64.b64encode(ct_bytes).decode('utf-8')
+    Returns a dict with the header fields and 'header_size', the offset at which
+    the ciphertext starts. Raises ValueError for anything that is not an envelope.
+    """
+    if len(data) < ENVELOPE_HEADER.size:
+        raise ValueError("Data too short for an envelope header")
+    magic, version, mode, compression, iv_length, key_id = ENVELOPE_HEADER.unpack_from(data)
+    if magic != ENVELOPE_MAGIC:
+        raise ValueError("Not a WhistleDrop envelope")
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported envelope version {version}")
+    header_size = ENVELOPE_HEADER.size + iv_length
+    if len(data) < header_size:
+        raise ValueError("Truncated envelope header")
+    return {
+        'version': version,
+        'mode': mode,
+        'compression': compression,
+        'key_id': key_id,
+        'iv': bytes(data[ENVELOPE_HEADER.size:header_size]),
+        'header_size': header_size
     }
-    return json.dumps(result)
 
-def decrypt_file(encrypted_data_json, aes_key):
-    """Decrypt the file data using AES encryption."""
-    data = json.loads(encrypted_data_json)
-    iv = base64.b64decode(data['iv'])
-    ct = base64.b64decode(data['ciphertext'])
+def stream_nonce(prefix, index, last):
+    """Nonce of segment index in AES-GCM STREAM mode."""
+    return prefix + struct.pack('>IB', index, 1 if last else 0)
+
+def parse_stream_params(header):
+    """Return (nonce prefix, segment size) of an AES-GCM STREAM envelope header."""
+    if len(header['iv']) != STREAM_PARAMS.size:
+        raise ValueError("Invalid stream parameters in envelope header")
+    return STREAM_PARAMS.unpack(header['iv'])
+
+def is_legacy_blob(data):
+    """Check whether stored data is a legacy base64-in-JSON blob."""
+    return isinstance(data, str) or bytes(data[:1]) == b'{'
+
+def legacy_blob_to_envelope(data, key_id):
+    """Re-frame a legacy JSON blob as a binary envelope without decrypting it."""
+    legacy = json.loads(data)
+    iv = base64.b64decode(legacy['iv'])
+    return build_envelope_header(iv, key_id) + base64.b64decode(legacy['ciphertext'])
+
+def encrypt_file(file_data, aes_key, key_id=0, mode=MODE_AES_CBC, compression=COMPRESSION_NONE):
+    """Encrypt the file data using AES encryption and return the binary envelope."""
+    output = io.BytesIO()
+    encrypt_stream(io.BytesIO(file_data), output, aes_key, key_id=key_id, mode=mode, compression=compression)
+    return output.getvalue()
+
+def encrypt_stream(source, destination, aes_key, key_id=0, chunk_size=DEFAULT_CHUNK_SIZE, mode=MODE_AES_CBC,
+                   cancel=None, compression=COMPRESSION_NONE, compression_level=6):
+    """
+    Encrypt a readable stream chunk by chunk and write the envelope to destination.
+    
+    Never holds more than one chunk of plaintext (plus its ciphertext) in memory.
+    In AES-GCM STREAM mode chunk_size is the segment size recorded in the header.
+    With COMPRESSION_ZLIB the plaintext is deflated on the way in and the
+    envelope header records it. If cancel (a threading.Event) is set,
+    EncryptionCancelled is raised before the next chunk.
+    
+    Returns the number of bytes written to destination.
+    """
+    if compression == COMPRESSION_ZLIB:
+        source = _CompressingReader(source, compression_level, chunk_size)
+    elif compression != COMPRESSION_NONE:
+        raise ValueError(f"Unsupported compression {compression}")
+    
+    if mode == MODE_AES_GCM_STREAM:
+        return _encrypt_stream_gcm(source, destination, aes_key, key_id, chunk_size, cancel, compression)
+    if mode != MODE_AES_CBC:
+        raise ValueError(f"Unsupported cipher mode {mode}")
+    
+    cipher = AES.new(aes_key, AES.MODE_CBC)
+    written = destination.write(build_envelope_header(cipher.iv, key_id, compression=compression))
+    
+    pending = b''  # plaintext tail shorter than one AES block
+    while True:
+        _check_cancel(cancel)
+        chunk = source.read(chunk_size)
+        if not chunk:
+            written += destination.write(cipher.encrypt(pad(pending, AES.block_size)))
+            break
+        
+        pending += chunk
+        full_blocks = len(pending) - len(pending) % AES.block_size
+        if full_blocks:
+            written += destination.write(cipher.encrypt(pending[:full_blocks]))
+            pending = pending[full_blocks:]
+    
+    return written
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise EncryptionCancelled()
+
+def _encrypt_stream_gcm(source, destination, aes_key, key_id, segment_size, cancel=None, compression=COMPRESSION_NONE):
+    prefix = get_random_bytes(STREAM_NONCE_PREFIX_SIZE)
+    header = build_envelope_header(STREAM_PARAMS.pack(prefix, segment_size), key_id, mode=MODE_AES_GCM_STREAM,
+                                   compression=compression)
+    written = destination.write(header)
+    
+    # Read one segment ahead: only then is it known whether a segment is the last one
+    index = 0
+    segment = _read_full(source, segment_size)
+    while True:
+        _check_cancel(cancel)
+        following = _read_full(source, segment_size) if len(segment) == segment_size else b''
+        last = not following
+        cipher = AES.new(aes_key, AES.MODE_GCM, nonce=stream_nonce(prefix, index, last))
+        cipher.update(header)
+        ciphertext, tag = cipher.encrypt_and_digest(segment)
+        written += destination.write(ciphertext)
+        written += destination.write(tag)
+        if last:
+            return written
+        segment = following
+        index += 1
+
+def _read_full(source, size):
+    """Read size bytes from source, fewer only at the end of the stream."""
+    data = source.read(size)
+    while data and len(data) < size:
+        more = source.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def decrypt_file(encrypted_data, aes_key):
+    """Decrypt an envelope (or a legacy JSON blob) using AES encryption."""
+    if is_legacy_blob(encrypted_data):
+        data = json.loads(encrypted_data)
+        iv = base64.b64decode(data['iv'])
+        ct = base64.b64decode(data['ciphertext'])
+    else:
+        header = parse_envelope_header(encrypted_data)
+        if header['compression'] not in COMPRESSION_MODES.values():
+            raise ValueError(f"Unsupported compression {header['compression']}")
+        if header['mode'] == MODE_AES_GCM_STREAM:
+            pt = _decrypt_gcm(encrypted_data, header, aes_key)
+        elif header['mode'] == MODE_AES_CBC:
+            cipher = AES.new(aes_key, AES.MODE_CBC, header['iv'])
+            pt = unpad(cipher.decrypt(encrypted_data[header['header_size']:]), AES.block_size)
+        else:
+            raise ValueError(f"Unsupported cipher mode {header['mode']}")
+        return zlib.decompress(pt) if header['compression'] == COMPRESSION_ZLIB else pt
     
     cipher = AES.new(aes_key, AES.MODE_CBC, iv)
     pt = unpad(cipher.decrypt(ct), AES.block_size)
     return pt
 
-def encrypt_aes_key(aes_key, public_key_str):
-    """Encrypt the AES key using the journalist's public RSA key."""
-    public_key = RSA.import_key(public_key_str)
-    cipher_rsa = PKCS1_OAEP.new(public_key)
+def _decrypt_gcm(encrypted_data, header, aes_key):
+    prefix, segment_size = parse_stream_params(header)
+    aad = bytes(encrypted_data[:header['header_size']])
+    stored = segment_size + STREAM_TAG_SIZE
+    body = encrypted_data[header['header_size']:]
+    count = max(1, -(-len(body) // stored))
+    
+    plaintext = []
+    for index in range(count):
+        segment = body[index * stored:(index + 1) * stored]
+        if len(segment) < STREAM_TAG_SIZE:
+            raise ValueError("Truncated segment")
+        cipher = AES.new(aes_key, AES.MODE_GCM, nonce=stream_nonce(prefix, index, index == count - 1))
+        cipher.update(aad)
+        plaintext.append(cipher.decrypt_and_verify(segment[:-STREAM_TAG_SIZE], segment[-STREAM_TAG_SIZE:]))
+    return b''.join(plaintext)
+
+def prepare_public_key(public_key_str):
+    """Parse a PEM public key into a ready-to-use PKCS1_OAEP cipher."""
+    return PKCS1_OAEP.new(RSA.import_key(public_key_str))
+
+def encrypt_aes_key(aes_key, public_key):
+    """Encrypt the AES key using the journalist's public RSA key (PEM string or prepared cipher)."""
+    cipher_rsa = public_key if hasattr(public_key, 'encrypt') else prepare_public_key(public_key)
     encrypted_key = cipher_rsa.encrypt(aes_key)
     # Rückgabe als Bytes
     return encrypted_key
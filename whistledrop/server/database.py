@@ -0,0 +1,66 @@
+import logging
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+def is_sqlite(config):
+    """Check whether the configured database is SQLite."""
+    return make_url(config['SQLALCHEMY_DATABASE_URI']).get_backend_name() == 'sqlite'
+
+def engine_options(config):
+    """
+    SQLAlchemy engine options for the configured database.
+
+    SQLite files get a real connection pool (SQLAlchemy 1.4 would otherwise
+    open a new connection, and re-run the PRAGMAs, on every checkout) with the
+    driver's own lock timeout matching busy_timeout. PostgreSQL connections are
+    pinged before use so ones dropped by the server are replaced transparently.
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    pool = {
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800)
+    }
+
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return {}
+        return dict(pool, poolclass=QueuePool, connect_args={
+            'check_same_thread': False,
+            'timeout': config.get('SQLITE_BUSY_TIMEOUT', 5000) / 1000
+        })
+
+    return dict(pool, pool_pre_ping=True)
+
+def _sqlite_pragmas(config):
+    """Return a connect listener that applies the SQLite PRAGMAs from config."""
+    statements = [
+        f"PRAGMA journal_mode={config.get('SQLITE_JOURNAL_MODE', 'WAL')}",
+        f"PRAGMA synchronous={config.get('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+        f"PRAGMA busy_timeout={int(config.get('SQLITE_BUSY_TIMEOUT', 5000))}",
+        f"PRAGMA mmap_size={int(config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}"
+    ]
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    return on_connect
+
+def init_app(app):
+    """Configure the engine for the app's database and attach Flask-SQLAlchemy."""
+    options = engine_options(app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    db.init_app(app)
+
+    if is_sqlite(app.config):
+        with app.app_context():
+            event.listen(db.engine, 'connect', _sqlite_pragmas(app.config))
@@ -1,6 +1,8 @@
 import os
 import logging
 from flask import Flask
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateTable
 from .models import db, RSAKey
 from .config import Config
 
@@ -11,54 +13,108 @@ def init_db(app):
     with app.app_context():
         # Create all tables defined in models.py
         db.create_all()
+        upgrade_schema(app)
         logger.info("Database tables created")
+    
+    # Keys stored before fingerprints existed need one for duplicate checks
+    from .keyimport import backfill_fingerprints
+    backfill_fingerprints(app)
+
+def upgrade_schema(app):
+    """
+    Bring tables created by older versions in line with the models.
+    
+    Adds missing nullable columns, relaxes NOT NULL constraints that the models no
+    longer require and creates missing indexes. SQLite cannot alter a column in
+    place, so affected tables are rebuilt there.
+    """
+    with app.app_context():
+        engine = db.engine
+        inspector = inspect(engine)
+        
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name']: column for column in inspector.get_columns(table.name)}
+            
+            relaxed = [column for column in table.columns
+                       if column.name in existing and column.nullable and not existing[column.name]['nullable']]
+            if relaxed and engine.dialect.name == 'sqlite':
+                _rebuild_sqlite_table(engine, table, existing)
+                logger.info(f"Rebuilt table {table.name} to match the current schema")
+                continue
+            
+            with engine.begin() as connection:
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    if not column.nullable:
+                        raise RuntimeError(f"Cannot add NOT NULL column {table.name}.{column.name} automatically")
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                    logger.info(f"Added column {table.name}.{column.name}")
+                
+                for column in relaxed:
+                    connection.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP NOT NULL'))
+                    logger.info(f"Column {table.name}.{column.name} is now nullable")
+                
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+
+def _rebuild_sqlite_table(engine, table, existing_columns):
+    """Recreate a SQLite table from its model definition and copy the rows over."""
+    new_name = f'_new_{table.name}'
+    copied = ', '.join(column.name for column in table.columns if column.name in existing_columns)
+    create_sql = str(CreateTable(table).compile(dialect=engine.dialect))
+    create_sql = create_sql.replace(f'CREATE TABLE {table.name}', f'CREATE TABLE {new_name}', 1)
+    
+    with engine.begin() as connection:
+        connection.execute(text(create_sql))
+        connection.execute(text(f'INSERT INTO {new_name} ({copied}) SELECT {copied} FROM {table.name}'))
+        connection.execute(text(f'DROP TABLE {table.name}'))
+        connection.execute(text(f'ALTER TABLE {new_name} RENAME TO {table.name}'))
+        for index in table.indexes:
+            index.create(connection)
 
 def add_public_key(app, public_key_data):
     """Add a new RSA public key to the database."""
+    from .keyimport import validate_public_key
+    
+    validated = validate_public_key(public_key_data)
+    if validated is None:
+        logger.warning("Not a valid RSA public key")
+        return False
+    public_key, fingerprint = validated
+    
     with app.app_context():
         # Check if the key already exists
-        existing_key = RSAKey.query.filter_by(public_key=public_key_data).first()
+        existing_key = RSAKey.query.filter_by(fingerprint=fingerprint).first()
         if existing_key:
             logger.warning("Public key already exists in database")
             return False
             
         # Add the new key
-        new_key = RSAKey(public_key=public_key_data)
+        new_key = RSAKey(public_key=public_key, fingerprint=fingerprint)
         db.session.add(new_key)
         db.session.commit()
+        if 'key_pool' in app.extensions:
+            app.extensions['key_pool'].stats.record_import()
         logger.info(f"Added new RSA public key (ID: {new_key.id})")
         return True
 
 def load_keys_from_file(app, key_file_path):
-    """Load RSA public keys from a file."""
+    """Load RSA public keys from a file (JSON list, {"public_keys": [...]} or PEM bundle)."""
+    from .keyimport import import_keys
+    
     if not os.path.exists(key_file_path):
         logger.error(f"Key file not found: {key_file_path}")
         return 0
         
-    count = 0
     try:
-        with open(key_file_path, 'r') as f:
-            import json
-            keys_data = json.load(f)
-            
-            if isinstance(keys_data, dict) and 'public_keys' in keys_data:
-                # Format: {"public_keys": ["-----BEGIN PUBLIC KEY-----...", "..."]}
-                keys = keys_data['public_keys']
-            elif isinstance(keys_data, list):
-                # Format: ["-----BEGIN PUBLIC KEY-----...", "..."]
-                keys = keys_data
-            else:
-                # Try to parse as a single key
-                keys = [keys_data]
-                
-            with app.app_context():
-                for key_data in keys:
-                    if add_public_key(app, key_data.strip()):
-                        count += 1
-                        
-            logger.info(f"Loaded {count} RSA public keys from {key_file_path}")
-            return count
-            
+        result = import_keys(app, key_file_path)
+        logger.info(f"Loaded {result.imported} RSA public keys from {key_file_path} "
+                    f"({result.duplicates} duplicates, {result.invalid} invalid)")
+        return result.imported
     except Exception as e:
         logger.error(f"Error loading keys from {key_file_path}: {str(e)}")
         return 0
@@ -114,6 +170,13 @@ def setup_database(app, key_file=None, generate_keys=False, key_count=5):
     if key_file and os.path.exists(key_file):
         load_keys_from_file(app, key_file)
         
+    # Return keys leased by worker processes of a previous run
+    from .keypool import release_leases
+    with app.app_context():
+        released = release_leases()
+    if released:
+        logger.info(f"Returned {released} RSA keys leased by a previous run to the pool")
+    
     # Check if we have any keys
     available_keys = check_keys_available(app)
     
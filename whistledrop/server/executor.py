@@ -0,0 +1,124 @@
+import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+class Saturated(Exception):
+    """Raised when the crypto executor has no room for another task."""
+
+class StageTimeout(Exception):
+    """Raised when a stage of an upload did not finish within its timeout."""
+
+class CryptoExecutor:
+    """
+    Size-limited thread pool for the CPU-bound part of uploads.
+
+    At most CRYPTO_WORKERS tasks run at once and at most CRYPTO_QUEUE_SIZE more
+    wait for a worker; anything beyond that is rejected right away with
+    Saturated instead of piling up. Request threads only wait on the result,
+    so light endpoints keep being served during an upload burst (PyCryptodome
+    releases the GIL while it encrypts).
+    """
+
+    def __init__(self, app):
+        self.workers = app.config.get('CRYPTO_WORKERS', os.cpu_count() or 1)
+        self.queue_size = app.config.get('CRYPTO_QUEUE_SIZE', 16)
+        self.on_stage = None  # Called with (stage, seconds) for each stage's queue wait and run time
+        self._lock = threading.Lock()
+        self._pid = None
+        self._depth = 0
+
+    def _ensure_pool(self):
+        """Create the pool in the process that uses it (worker processes are forked)."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='crypto')
+                self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+                self._depth = 0
+                self._pid = os.getpid()
+
+    def saturated(self):
+        """Check whether a new task would currently be rejected."""
+        self._ensure_pool()
+        if not self._slots.acquire(blocking=False):
+            return True
+        self._slots.release()
+        return False
+
+    def depth(self):
+        """Number of tasks running or waiting in this process."""
+        return self._depth if self._pid == os.getpid() else 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs). Raises Saturated if the queue is full."""
+        self._ensure_pool()
+        if not self._slots.acquire(blocking=False):
+            raise Saturated()
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        self._adjust_depth(1)
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _adjust_depth(self, delta):
+        with self._lock:
+            self._depth += delta
+
+    def _task_done(self, future):
+        self._adjust_depth(-1)
+        self._slots.release()
+
+    def run(self, stage, timeout, fn, *args, on_late_result=None, **kwargs):
+        """
+        Run one stage of an upload on the pool and wait for its result.
+
+        fn receives a threading.Event as its cancel keyword argument, which is
+        set when the stage times out; long-running stages should check it and
+        stop early. If the stage still finishes after the timeout, its result is
+        passed to on_late_result so it can be cleaned up.
+
+        Raises:
+            Saturated: If the queue is full
+            StageTimeout: If the stage did not finish within timeout seconds
+        """
+        cancel = threading.Event()
+        future = self.submit(self._timed, stage, time.perf_counter(), fn, *args, cancel=cancel, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            cancel.set()
+            if on_late_result:
+                future.add_done_callback(lambda f: _deliver_late_result(f, stage, on_late_result))
+            raise StageTimeout(f"Stage '{stage}' timed out after {timeout} seconds")
+
+    def _timed(self, stage, submitted, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if self.on_stage:
+                self.on_stage(f'{stage}_wait', started - submitted)
+                self.on_stage(stage, time.perf_counter() - started)
+
+def _deliver_late_result(future, stage, callback):
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        callback(future.result())
+    except Exception as e:
+        logger.error(f"Error cleaning up after timed-out stage '{stage}': {e}")
+
+def init_app(app):
+    """Attach a crypto executor to the app."""
+    app.extensions['crypto_executor'] = CryptoExecutor(app)
+
+def get_crypto_executor():
+    """Return the crypto executor of the current app."""
+    return current_app.extensions['crypto_executor']
@@ -0,0 +1,245 @@
+import os
+import json
+import hashlib
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from Crypto.PublicKey import RSA
+from sqlalchemy.exc import IntegrityError
+from .models import db, RSAKey
+
+logger = logging.getLogger(__name__)
+
+# Keys validated and inserted per transaction
+DEFAULT_BATCH_SIZE = 1000
+
+# Batches smaller than this are validated in-process; a process pool does not pay off
+PARALLEL_THRESHOLD = 256
+
+# Bytes read from the key file at a time
+READ_SIZE = 64 * 1024
+
+PEM_BEGIN = '-----BEGIN'
+PEM_END = '-----END'
+
+# Outcome of an import run
+ImportResult = namedtuple('ImportResult', ['imported', 'duplicates', 'invalid'])
+
+def public_key_fingerprint(public_key):
+    """
+    Return the SHA-256 fingerprint of a public key.
+
+    The fingerprint is taken over the key's DER encoding, so the same key in
+    differently formatted PEM text still has the same fingerprint.
+    """
+    if isinstance(public_key, str):
+        public_key = RSA.import_key(public_key)
+    return hashlib.sha256(public_key.export_key(format='DER')).hexdigest()
+
+def validate_public_key(public_key_data):
+    """
+    Parse one public key.
+
+    Returns (normalized PEM, fingerprint), or None if the data is not an RSA
+    public key. Private keys are rejected so they never end up on the server.
+    """
+    if not isinstance(public_key_data, (str, bytes)):
+        # e.g. a number, null or object in a JSON key file
+        return None
+    try:
+        key = RSA.import_key(public_key_data.strip())
+        if key.has_private():
+            return None
+        return key.export_key().decode('utf-8'), public_key_fingerprint(key)
+    except (ValueError, IndexError, TypeError):
+        return None
+
+def iter_key_file(path):
+    """
+    Stream the public keys in a key file one at a time.
+
+    Supports a JSON array of PEM strings, the {"public_keys": [...]} format and a
+    plain bundle of concatenated PEM blocks. JSON arrays and PEM bundles are read
+    incrementally, so the whole file is never held in memory.
+    """
+    with open(path, 'r') as f:
+        head = f.read(READ_SIZE)
+        start = head.lstrip()[:1]
+        if start == '[':
+            yield from _iter_json_array(f, head)
+        elif start == '{':
+            keys_data = json.loads(head + f.read())
+            if 'public_keys' in keys_data:
+                yield from keys_data['public_keys']
+            else:
+                raise ValueError("JSON key file has no 'public_keys' list")
+        else:
+            yield from _iter_pem_bundle(f, head)
+
+def _iter_json_array(f, buffer):
+    decoder = json.JSONDecoder()
+    position = buffer.index('[') + 1
+    eof = False
+
+    while True:
+        # Skip separators between elements
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+            # A number ending at the end of the buffer may continue in the next chunk
+            complete = end < len(buffer) or eof
+        except json.JSONDecodeError:
+            if eof:
+                raise ValueError("Truncated JSON key file")
+            complete = False
+        if not complete:
+            chunk = f.read(READ_SIZE)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield value
+        position = end
+        # Drop consumed text once it dominates the buffer
+        if position > READ_SIZE:
+            buffer = buffer[position:]
+            position = 0
+
+def _iter_pem_bundle(f, head):
+    lines = []
+    pending = ''
+    chunk = head
+    while chunk:
+        pending += chunk
+        *complete, pending = pending.split('\n')
+        for line in complete:
+            lines, key = _add_pem_line(lines, line)
+            if key:
+                yield key
+        chunk = f.read(READ_SIZE)
+    lines, key = _add_pem_line(lines, pending)
+    if key:
+        yield key
+
+def _add_pem_line(lines, line):
+    """Collect one line of a PEM bundle; returns the open block and a finished key, if any."""
+    line = line.strip()
+    if line.startswith(PEM_BEGIN):
+        lines = [line]
+    elif lines:
+        lines.append(line)
+        if line.startswith(PEM_END):
+            return [], '\n'.join(lines)
+    return lines, None
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def backfill_fingerprints(app, batch_size=DEFAULT_BATCH_SIZE):
+    """Compute fingerprints for keys stored before the fingerprint column existed."""
+    filled = 0
+    last_id = 0
+    with app.app_context():
+        while True:
+            rows = (db.session.query(RSAKey.id, RSAKey.public_key)
+                    .filter(RSAKey.fingerprint.is_(None), RSAKey.id > last_id)
+                    .order_by(RSAKey.id).limit(batch_size).all())
+            if not rows:
+                break
+            for key_id, public_key in rows:
+                validated = validate_public_key(public_key)
+                if validated:
+                    db.session.query(RSAKey).filter_by(id=key_id).update({'fingerprint': validated[1]})
+                    filled += 1
+                else:
+                    logger.warning(f"Stored RSA key {key_id} could not be parsed")
+            db.session.commit()
+            last_id = rows[-1].id
+    if filled:
+        logger.info(f"Computed fingerprints for {filled} existing RSA keys")
+    return filled
+
+def import_keys(app, path, batch_size=DEFAULT_BATCH_SIZE, workers=None):
+    """
+    Import the public keys in a key file in batched transactions.
+
+    Keys are validated in parallel and deduplicated by fingerprint, both within
+    the file and against the keys already stored.
+
+    Returns:
+        ImportResult with the imported, duplicate and invalid counts
+    """
+    backfill_fingerprints(app)
+    imported = duplicates = invalid = 0
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+
+    try:
+        with app.app_context():
+            for batch in _batches(iter_key_file(path), batch_size):
+                if executor and len(batch) >= PARALLEL_THRESHOLD:
+                    chunksize = max(1, len(batch) // (4 * (workers or os.cpu_count() or 1)))
+                    results = list(executor.map(validate_public_key, batch, chunksize=chunksize))
+                else:
+                    results = [validate_public_key(key_data) for key_data in batch]
+
+                # Deduplicate within the batch first, then against the database
+                candidates = {}
+                for result in results:
+                    if result is None:
+                        invalid += 1
+                    elif result[1] in candidates:
+                        duplicates += 1
+                    else:
+                        candidates[result[1]] = result[0]
+
+                existing = {row.fingerprint for row in db.session.query(RSAKey.fingerprint)
+                            .filter(RSAKey.fingerprint.in_(list(candidates)))}
+                duplicates += len(existing)
+                rows = [{'public_key': public_key, 'fingerprint': fingerprint, 'is_used': False}
+                        for fingerprint, public_key in candidates.items() if fingerprint not in existing]
+
+                added = _insert_keys(rows)
+                imported += added
+                duplicates += len(rows) - added
+                logger.info(f"Imported {imported} keys so far ({duplicates} duplicates, {invalid} invalid)")
+    finally:
+        if executor:
+            executor.shutdown()
+
+    if imported and 'key_pool' in app.extensions:
+        app.extensions['key_pool'].stats.record_import(imported)
+    return ImportResult(imported, duplicates, invalid)
+
+def _insert_keys(rows):
+    """Insert a batch of keys in one transaction. Returns the number inserted."""
+    if not rows:
+        return 0
+    try:
+        db.session.execute(RSAKey.__table__.insert(), rows)
+        db.session.commit()
+        return len(rows)
+    except IntegrityError:
+        # Another import added some of these keys meanwhile; insert one by one
+        db.session.rollback()
+
+    inserted = 0
+    for row in rows:
+        try:
+            db.session.execute(RSAKey.__table__.insert(), [row])
+            db.session.commit()
+            inserted += 1
+        except IntegrityError:
+            db.session.rollback()
+    return inserted
@@ -0,0 +1,513 @@
+import os
+import atexit
+import socket
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import text, func, case
+from .models import db, RSAKey
+
+logger = logging.getLogger(__name__)
+
+# A one-time RSA key taken from the pool; cipher is set if the key was pre-parsed
+ClaimedKey = namedtuple('ClaimedKey', ['id', 'public_key', 'cipher'], defaults=(None,))
+
+# Key pool counters
+KeyCounts = namedtuple('KeyCounts', ['total', 'available', 'used'])
+
+# Candidate selection for claims and leases. The predicate matches the partial
+# index ix_rsa_keys_available, so the lookup stays cheap however many keys are used.
+_AVAILABLE = {
+    'sqlite': "is_used = 0 AND lease_owner IS NULL",
+    'postgresql': "is_used = false AND lease_owner IS NULL"
+}
+_TRUE = {'sqlite': '1', 'postgresql': 'true'}
+_FALSE = {'sqlite': '0', 'postgresql': 'false'}
+
+def _dialect():
+    name = db.engine.dialect.name
+    return name if name in _AVAILABLE else 'sqlite'
+
+def _supports_returning():
+    """UPDATE ... RETURNING is available on PostgreSQL and SQLite 3.35+."""
+    name = db.engine.dialect.name
+    return name == 'postgresql' or (name == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35, 0))
+
+def _candidates(dialect, limit, available=None):
+    """Subquery selecting the next available key ids."""
+    lock = " FOR UPDATE SKIP LOCKED" if dialect == 'postgresql' else ""
+    return f"SELECT id FROM rsa_keys WHERE {available or _AVAILABLE[dialect]} ORDER BY id LIMIT {limit}{lock}"
+
+# Keys the compare-and-set fallback tries per lookup, so concurrent claimers
+# do not all retry on the same id
+CLAIM_CANDIDATES = 16
+
+# Clears the lease of a key that is claimed or returned
+_NO_LEASE = "lease_owner = NULL, leased_at = NULL"
+
+def claim_key(include_leased=False):
+    """
+    Atomically mark the next available key as used and return it.
+
+    Uses a single conditional UPDATE ... RETURNING, so two concurrent uploads can
+    never receive the same key. The claim is committed immediately.
+
+    With include_leased, keys leased by other processes may be taken too. Their
+    owner's claim_leased_key then fails and it moves on to its next key, so this
+    is safe; it is meant for when a nearly empty pool is all leased elsewhere.
+
+    Returns:
+        ClaimedKey or None if the pool is empty
+    """
+    dialect = _dialect()
+    now = datetime.now()
+    available = f"is_used = {_FALSE[dialect]}" if include_leased else _AVAILABLE[dialect]
+
+    if _supports_returning():
+        rows = db.session.execute(text(
+            f"UPDATE rsa_keys SET is_used = {_TRUE[dialect]}, used_at = :now, {_NO_LEASE} "
+            f"WHERE id = ({_candidates(dialect, 1, available)}) RETURNING id, public_key"
+        ), {'now': now}).fetchall()
+        db.session.commit()
+        return ClaimedKey(*rows[0]) if rows else None
+
+    # Fallback: pick a batch of candidates, then claim the first one nobody else
+    # took meanwhile. Every failed attempt means another claim went through.
+    for _ in range(100):
+        rows = db.session.execute(text(
+            f"SELECT id, public_key FROM rsa_keys WHERE {available} ORDER BY id LIMIT {CLAIM_CANDIDATES}"
+        )).fetchall()
+        if not rows:
+            db.session.commit()
+            return None
+        for row in rows:
+            result = db.session.execute(text(
+                f"UPDATE rsa_keys SET is_used = {_TRUE[dialect]}, used_at = :now, {_NO_LEASE} "
+                f"WHERE id = :id AND {available}"
+            ), {'now': now, 'id': row[0]})
+            db.session.commit()
+            if result.rowcount == 1:
+                return ClaimedKey(*row)
+    raise RuntimeError("Could not claim an RSA key under contention")
+
+def lease_keys(owner, count):
+    """
+    Reserve up to count available keys for owner in one round trip.
+
+    Leased keys are still unused but are skipped by other claimers until they are
+    claimed with claim_leased_key, returned with release_leases or, if owner
+    stops renewing them, expired by expire_leases.
+
+    Returns:
+        list of ClaimedKey
+    """
+    dialect = _dialect()
+    now = datetime.now()
+
+    if _supports_returning():
+        rows = db.session.execute(text(
+            f"UPDATE rsa_keys SET lease_owner = :owner, leased_at = :now "
+            f"WHERE id IN ({_candidates(dialect, int(count))}) RETURNING id, public_key"
+        ), {'owner': owner, 'now': now}).fetchall()
+        db.session.commit()
+        return sorted(ClaimedKey(*row) for row in rows)
+
+    # Fallback: lease candidates one by one, skipping any taken meanwhile
+    candidates = db.session.execute(text(
+        f"SELECT id, public_key FROM rsa_keys WHERE {_AVAILABLE[dialect]} ORDER BY id LIMIT {int(count)}"
+    )).fetchall()
+    leased = []
+    for row in candidates:
+        result = db.session.execute(text(
+            f"UPDATE rsa_keys SET lease_owner = :owner, leased_at = :now WHERE id = :id AND {_AVAILABLE[dialect]}"
+        ), {'owner': owner, 'now': now, 'id': row[0]})
+        if result.rowcount == 1:
+            leased.append(ClaimedKey(*row))
+    db.session.commit()
+    return leased
+
+def claim_leased_key(key_id, owner):
+    """Mark a key leased by owner as used. Returns True if the claim succeeded."""
+    dialect = _dialect()
+    result = db.session.execute(text(
+        f"UPDATE rsa_keys SET is_used = {_TRUE[dialect]}, used_at = :now, {_NO_LEASE} "
+        f"WHERE id = :id AND lease_owner = :owner AND is_used = {_FALSE[dialect]}"
+    ), {'now': datetime.now(), 'id': key_id, 'owner': owner})
+    db.session.commit()
+    return result.rowcount == 1
+
+def release_key(key_id):
+    """Return a claimed key to the pool after an upload failed before it was used."""
+    dialect = _dialect()
+    db.session.execute(text(
+        f"UPDATE rsa_keys SET is_used = {_FALSE[dialect]}, used_at = NULL, {_NO_LEASE} WHERE id = :id"
+    ), {'id': key_id})
+    db.session.commit()
+
+def release_leases(owner=None):
+    """Return unused leased keys of owner (or of every owner) to the pool."""
+    dialect = _dialect()
+    condition = "lease_owner = :owner" if owner else "lease_owner IS NOT NULL"
+    result = db.session.execute(text(
+        f"UPDATE rsa_keys SET {_NO_LEASE} WHERE {condition} AND is_used = {_FALSE[dialect]}"
+    ), {'owner': owner})
+    db.session.commit()
+    return result.rowcount
+
+def renew_leases(owner):
+    """Mark the unused keys leased by owner as still held."""
+    dialect = _dialect()
+    result = db.session.execute(text(
+        f"UPDATE rsa_keys SET leased_at = :now WHERE lease_owner = :owner AND is_used = {_FALSE[dialect]}"
+    ), {'now': datetime.now(), 'owner': owner})
+    db.session.commit()
+    return result.rowcount
+
+def expire_leases(ttl):
+    """
+    Return keys whose lease was not renewed for ttl seconds to the pool.
+
+    Catches leases of worker processes that died without running their exit
+    hook (e.g. SIGKILL). Should an owner still be alive, its claim_leased_key
+    for an expired key simply fails and it moves on to its next key.
+    """
+    dialect = _dialect()
+    result = db.session.execute(text(
+        f"UPDATE rsa_keys SET {_NO_LEASE} WHERE lease_owner IS NOT NULL AND is_used = {_FALSE[dialect]} "
+        f"AND (leased_at IS NULL OR leased_at < :cutoff)"
+    ), {'cutoff': datetime.now() - timedelta(seconds=ttl)})
+    db.session.commit()
+    return result.rowcount
+
+def count_keys():
+    """Count total, available and used keys with a single aggregate query."""
+    total, available = db.session.query(
+        func.count(RSAKey.id),
+        func.coalesce(func.sum(case((RSAKey.is_used == False, 1), else_=0)), 0)
+    ).one()
+    return KeyCounts(total, available, total - available)
+
+class KeyPoolStats:
+    """
+    Key pool counters served from memory.
+
+    Claims, releases and imports made by this process adjust the counts right
+    away. Changes made elsewhere (other worker processes, manage.py) are picked
+    up by reconciling against the database: snapshot() does it itself if the
+    counts are older than KEY_STATS_MAX_AGE, and a background thread does it every
+    KEY_STATS_RECONCILE_INTERVAL seconds. Every worker runs that thread, so the
+    interval is kept long. Expiring leases is left to one LeaseExpirer per server.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_age = app.config.get('KEY_STATS_MAX_AGE', 10.0)
+        self.reconcile_interval = app.config.get('KEY_STATS_RECONCILE_INTERVAL', 60.0)
+        self._counts = None
+        self._updated = 0.0
+        self._lock = threading.Lock()
+        self._reconciler_pid = None
+
+    def snapshot(self):
+        """Return the current KeyCounts, reconciling first only if they are stale."""
+        self._ensure_reconciler()
+        with self._lock:
+            if self._counts is not None and time.monotonic() - self._updated <= self.max_age:
+                return self._counts
+        return self.reconcile()
+
+    def reconcile(self):
+        """Replace the in-memory counts with fresh ones from the database."""
+        if has_app_context():
+            counts = count_keys()
+        else:
+            with self.app.app_context():
+                counts = count_keys()
+                db.session.remove()
+        with self._lock:
+            self._counts = counts
+            self._updated = time.monotonic()
+        return counts
+
+    def _adjust(self, total=0, available=0):
+        with self._lock:
+            if self._counts is not None:
+                total = self._counts.total + total
+                available = max(0, self._counts.available + available)
+                self._counts = KeyCounts(total, available, total - available)
+
+    def record_claim(self, count=1):
+        """Account for keys claimed by this process."""
+        self._adjust(available=-count)
+
+    def record_release(self, count=1):
+        """Account for claimed keys returned to the pool."""
+        self._adjust(available=count)
+
+    def record_import(self, count=1):
+        """Account for new keys added to the pool."""
+        self._adjust(total=count, available=count)
+
+    def _ensure_reconciler(self):
+        """Start the background reconciliation thread once per process."""
+        if not self.reconcile_interval or self._reconciler_pid == os.getpid():
+            return
+        with self._lock:
+            if self._reconciler_pid == os.getpid():
+                return
+            self._reconciler_pid = os.getpid()
+        thread = threading.Thread(target=self._reconcile_loop, name='key-stats-reconciler', daemon=True)
+        thread.start()
+
+    def _reconcile_loop(self):
+        while True:
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.error(f"Error reconciling key pool counters: {e}")
+            time.sleep(self.reconcile_interval)
+
+def leasing_enabled(config):
+    """Whether workers lease keys (KEY_LEASE_SIZE or KEY_PREPARE_QUEUE_SIZE > 0), so leases can expire."""
+    return bool(config.get('KEY_LEASE_SIZE') or config.get('KEY_PREPARE_QUEUE_SIZE'))
+
+class LeaseExpirer:
+    """
+    Returns keys whose lease was not renewed within KEY_LEASE_TTL to the pool.
+
+    Leases only exist when leasing or the prepare queue is enabled, and one
+    process per server is enough to expire them: the serve master (or the
+    development server) runs this every KEY_LEASE_TTL / 2 seconds. Its
+    connections are closed after every round, so workers forked meanwhile
+    inherit none of them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.ttl = app.config.get('KEY_LEASE_TTL', 600.0)
+        self._stop = threading.Event()
+
+    def expire(self):
+        """Expire stale leases once; returns the number of keys returned to the pool."""
+        with self.app.app_context():
+            try:
+                expired = expire_leases(self.ttl)
+            finally:
+                db.session.remove()
+                db.engine.dispose()
+        if expired:
+            logger.warning(f"Returned {expired} RSA keys with expired leases to the pool")
+        return expired
+
+    def start(self):
+        thread = threading.Thread(target=self._expire_loop, name='lease-expirer', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def _expire_loop(self):
+        while not self._stop.wait(self.ttl / 2):
+            try:
+                self.expire()
+            except Exception as e:
+                logger.error(f"Error expiring key leases: {e}")
+
+def start_lease_expiry(app):
+    """Start a LeaseExpirer if workers lease keys; returns it, or None."""
+    if not app.config.get('KEY_LEASE_TTL') or not leasing_enabled(app.config):
+        return None
+    expirer = LeaseExpirer(app)
+    expirer.start()
+    return expirer
+
+class KeyPool:
+    """
+    Hands out one-time RSA keys to uploads.
+
+    With KEY_PREPARE_QUEUE_SIZE > 0 a background thread keeps a queue of keys
+    leased to this process with their public keys already parsed, so PEM parsing
+    and the lease round trip stay off the request path. Claims that find the
+    queue empty (misses) fall back to the paths below.
+
+    With KEY_LEASE_SIZE > 0 each worker process reserves a block of keys per
+    database round trip and claims from that block. Otherwise every claim is a
+    single atomic statement. Leased keys are returned when the process exits;
+    while it runs, their leases are renewed every KEY_LEASE_TTL / 2 seconds.
+    """
+
+    # Seconds the preparer waits between refill attempts when nothing wakes it up
+    PREPARE_POLL_INTERVAL = 5.0
+
+    def __init__(self, app):
+        self.app = app
+        self.lease_size = app.config.get('KEY_LEASE_SIZE', 0)
+        self.prepare_size = app.config.get('KEY_PREPARE_QUEUE_SIZE', 0)
+        self.lease_ttl = app.config.get('KEY_LEASE_TTL', 600.0)
+        self.stats = KeyPoolStats(app)
+        self._lock = threading.Lock()
+        self._preparing = threading.Lock()  # held by the preparer from leasing keys until they are queued
+        self._reset()
+        if self.lease_size or self.prepare_size:
+            atexit.register(self.shutdown)
+
+    def _reset(self):
+        """Start with empty blocks under an owner name unique to this process."""
+        self._pid = os.getpid()
+        self.owner = f"{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}"
+        self._leased = deque()
+        self._prepared = deque()
+        self._renewed = time.monotonic()
+        self._refill = threading.Event()
+        self._preparer_started = False
+        self.hits = 0
+        self.misses = 0
+
+    def _check_fork(self):
+        """Forked worker: the inherited blocks belong to the parent process."""
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def claim(self):
+        """Claim a key for an upload. Returns ClaimedKey or None if none is left."""
+        key = self._claim_prepared() if self.prepare_size else None
+        if key is None:
+            key = self._claim()
+        if key is None and self.prepare_size:
+            # The preparer may have leased the last free keys meanwhile
+            with self._preparing:
+                key = self._claim_prepared(count_miss=False)
+        if key is None and (self.prepare_size or self.lease_size):
+            # What is left of the pool may all be leased by other workers
+            key = claim_key(include_leased=True)
+        if key is not None:
+            self.stats.record_claim()
+        return key
+
+    def _claim_prepared(self, count_miss=True):
+        """Claim a key from the queue of pre-parsed keys, or return None on a miss."""
+        while True:
+            with self._lock:
+                self._check_fork()
+                self._ensure_preparer()
+                key = self._prepared.popleft() if self._prepared else None
+                self._refill.set()
+                if key is None:
+                    if count_miss:
+                        self.misses += 1
+                    return None
+            if claim_leased_key(key.id, self.owner):
+                with self._lock:
+                    self.hits += 1
+                return key
+
+    def _claim(self):
+        if not self.lease_size:
+            return claim_key()
+
+        with self._lock:
+            self._check_fork()
+            if self._renewal_due():
+                renew_leases(self.owner)
+            while True:
+                if not self._leased:
+                    self._leased.extend(lease_keys(self.owner, self.lease_size))
+                    if not self._leased:
+                        return None
+                key = self._leased.popleft()
+                if claim_leased_key(key.id, self.owner):
+                    return key
+
+    def _renewal_due(self):
+        """Whether this process holds leases last renewed half a KEY_LEASE_TTL ago (call with the lock held)."""
+        if not self.lease_ttl or time.monotonic() - self._renewed < self.lease_ttl / 2:
+            return False
+        self._renewed = time.monotonic()
+        return bool(self._leased or self._prepared)
+
+    def _ensure_preparer(self):
+        """Start the background preparer thread once per process (call with the lock held)."""
+        if self._preparer_started:
+            return
+        self._preparer_started = True
+        thread = threading.Thread(target=self._prepare_loop, args=(self._pid,), name='key-preparer', daemon=True)
+        thread.start()
+
+    def _prepare_loop(self, pid):
+        while os.getpid() == pid:
+            try:
+                with self._lock:
+                    renew = self._renewal_due()
+                    missing = self.prepare_size - len(self._prepared)
+                if renew:
+                    with self.app.app_context():
+                        renew_leases(self.owner)
+                        db.session.remove()
+                if missing > 0:
+                    self._fill_queue(missing)
+            except Exception as e:
+                logger.error(f"Error preparing RSA keys: {e}")
+            self._refill.wait(self.PREPARE_POLL_INTERVAL)
+            self._refill.clear()
+
+    def _fill_queue(self, missing):
+        """Lease up to missing keys, parse them and add them to the queue."""
+        from .crypto import prepare_public_key
+
+        with self._preparing:
+            with self.app.app_context():
+                keys = lease_keys(self.owner, missing)
+                db.session.remove()
+            prepared = []
+            for key in keys:
+                try:
+                    prepared.append(key._replace(cipher=prepare_public_key(key.public_key)))
+                except Exception as e:
+                    # Hand it out unparsed; the upload will report the bad key
+                    logger.error(f"Error parsing RSA key {key.id}: {e}")
+                    prepared.append(key)
+            with self._lock:
+                self._prepared.extend(prepared)
+
+    def queue_stats(self):
+        """Size, capacity and hit/miss counters of the pre-parsed key queue."""
+        with self._lock:
+            return {
+                'size': len(self._prepared),
+                'capacity': self.prepare_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def release(self, key_id):
+        """Return a claimed key that ended up unused."""
+        release_key(key_id)
+        self.stats.record_release()
+
+    def shutdown(self):
+        """Return this process's unused leased keys to the pool."""
+        with self._lock:
+            if os.getpid() != self._pid or not (self._leased or self._prepared):
+                return
+            self._leased.clear()
+            self._prepared.clear()
+        try:
+            with self.app.app_context():
+                released = release_leases(self.owner)
+            logger.info(f"Returned {released} leased RSA keys to the pool")
+        except Exception as e:
+            logger.error(f"Error returning leased RSA keys: {e}")
+
+def init_app(app):
+    """Attach a key pool to the app."""
+    app.extensions['key_pool'] = KeyPool(app)
+
+def get_key_pool():
+    """Return the key pool of the current app."""
+    return current_app.extensions['key_pool']
@@ -0,0 +1,394 @@
+import os
+import hmac
+import json
+import time
+import secrets
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket bounds. Only these aggregates are kept: no per-request
+# records, filenames, key ids or client addresses are ever stored.
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+FILE_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+# The metrics listener only ever binds to the loopback interface
+METRICS_HOST = '127.0.0.1'
+
+class Histogram:
+    """Cumulative Prometheus histogram, optionally split by one label."""
+
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label = label
+        self._lock = threading.Lock()
+        self._series = {}  # label value -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        """The series as JSON-compatible [label value, series] pairs."""
+        with self._lock:
+            return [[label_value, list(series)] for label_value, series in self._series.items()]
+
+    def merge(self, snapshot):
+        """Add the series of a snapshot (of another worker) to this histogram."""
+        with self._lock:
+            for label_value, series in snapshot:
+                current = self._series.get(label_value) or [0] * (len(self.buckets) + 1) + [0.0]
+                self._series[label_value] = [a + b for a, b in zip(current, series)]
+
+    def render(self, labels):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: list(series) for key, series in self._series.items()}
+        for label_value, series in sorted(snapshot.items(), key=lambda item: str(item[0])):
+            series_labels = dict(labels, **({self.label: label_value} if self.label else {}))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(series_labels, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(series_labels)} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{_labels(series_labels)} {cumulative}")
+        return lines
+
+class Counter:
+    """Prometheus counter, optionally split by one label."""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, label_value=None, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def snapshot(self):
+        """The values as JSON-compatible [label value, value] pairs."""
+        with self._lock:
+            return [[label_value, value] for label_value, value in self._values.items()]
+
+    def merge(self, snapshot):
+        """Add the values of a snapshot (of another worker) to this counter."""
+        for label_value, value in snapshot:
+            self.inc(label_value, value)
+
+    def render(self, labels):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for label_value, value in sorted(snapshot.items(), key=lambda item: str(item[0])):
+            series_labels = dict(labels, **({self.label: label_value} if self.label else {}))
+            lines.append(f"{self.name}{_labels(series_labels)} {value}")
+        return lines
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+# Gauges each worker reports for itself; /metrics shows their sum over all workers
+WORKER_GAUGES = {
+    'whistledrop_key_queue_size': 'Pre-parsed keys ready in all workers.',
+    'whistledrop_crypto_queue_depth': 'Crypto tasks running or waiting in all workers.',
+    'whistledrop_crypto_queue_capacity': 'Crypto tasks accepted before uploads get a 503, over all workers.'
+}
+
+class Metrics:
+    """
+    In-memory performance metrics of one worker process.
+
+    Upload stages, payload sizes, files per submission, request durations and database queries per
+    request are aggregated into histograms; key pool level and crypto queue
+    depth are read when the metrics are rendered.
+
+    Under serve every worker also writes a snapshot of its metrics to a shared
+    MetricsStore, every METRICS_FLUSH_INTERVAL seconds and when it exits.
+    Whichever worker answers /metrics renders the sum of all snapshots, so the
+    endpoint covers the whole server no matter which worker accepted the
+    scrape. Counts of exited workers are kept until the server restarts.
+    """
+
+    def __init__(self, store=None, flush_interval=0):
+        self.stages = Histogram('whistledrop_upload_stage_seconds', 'Time spent in each upload stage.',
+                                STAGE_BUCKETS, label='stage')
+        self.sizes = Histogram('whistledrop_upload_size_bytes', 'Size of stored upload ciphertexts.', SIZE_BUCKETS)
+        self.files = Histogram('whistledrop_submission_files', 'Files per stored submission.', FILE_COUNT_BUCKETS)
+        self.uploads = Counter('whistledrop_uploads_total', 'Upload attempts by outcome.', label='outcome')
+        self.requests = Histogram('whistledrop_request_seconds', 'Request duration by endpoint.',
+                                  STAGE_BUCKETS, label='endpoint')
+        self.queries = Histogram('whistledrop_request_db_queries', 'Database queries per request by endpoint.',
+                                 QUERY_BUCKETS, label='endpoint')
+        self.store = store
+        self.flush_interval = flush_interval
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._flusher_pid = None
+
+    @property
+    def families(self):
+        return (self.stages, self.sizes, self.files, self.uploads, self.requests, self.queries)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as an upload stage."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.observe(time.perf_counter() - started, name)
+
+    def observe_stage(self, name, seconds):
+        self.stages.observe(seconds, name)
+
+    def observe_upload(self, outcome, sizes=()):
+        """Count one upload request by outcome ('ok', 'busy', 'no_key', 'invalid' or 'error') with the sizes of its stored files."""
+        self.uploads.inc(outcome)
+        if sizes:
+            self.files.observe(len(sizes))
+        for size in sizes:
+            self.sizes.observe(size)
+
+    def snapshot(self, app, final=False):
+        """This worker's metrics as JSON-compatible data; an exiting worker (final) reports no gauges."""
+        gauges = {}
+        key_pool = app.extensions.get('key_pool')
+        if key_pool and not final:
+            gauges['whistledrop_key_queue_size'] = key_pool.queue_stats()['size']
+        executor = app.extensions.get('crypto_executor')
+        if executor and not final:
+            gauges['whistledrop_crypto_queue_depth'] = executor.depth()
+            gauges['whistledrop_crypto_queue_capacity'] = executor.workers + executor.queue_size
+        return {'metrics': {metric.name: metric.snapshot() for metric in self.families}, 'gauges': gauges}
+
+    def flush(self, app, final=False):
+        """Write this worker's snapshot to the store; after the final flush nothing is written any more."""
+        if not self.store:
+            return
+        with self._flush_lock:
+            if self._closed:
+                return
+            self.store.write(self.snapshot(app, final=final))
+            self._closed = final
+
+    def start_flusher(self, app):
+        """Start the background thread writing snapshots to the store, once per process."""
+        if not self.store or not self.flush_interval or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        thread = threading.Thread(target=self._flush_loop, args=(app,), name='metrics-flusher', daemon=True)
+        thread.start()
+
+    def _flush_loop(self, app):
+        while not self._closed:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush(app)
+            except Exception as e:
+                logger.error(f"Error writing metrics snapshot: {e}")
+
+    def render(self, app):
+        """The metrics of all workers in the Prometheus text exposition format."""
+        if self.store:
+            self.flush(app)
+            snapshots = self.store.read_all()
+        else:
+            snapshots = [self.snapshot(app)]
+
+        total = Metrics()
+        gauges = {name: 0 for name in WORKER_GAUGES}
+        for snapshot in snapshots:
+            for metric in total.families:
+                metric.merge(snapshot['metrics'].get(metric.name, []))
+            for name, value in snapshot['gauges'].items():
+                gauges[name] = gauges.get(name, 0) + value
+
+        lines = []
+        for metric in total.families:
+            lines.extend(metric.render({}))
+
+        key_pool = app.extensions.get('key_pool')
+        if key_pool:
+            # Counted in the database, the same for every worker
+            counts = key_pool.stats.snapshot()
+            lines.extend(_gauge('whistledrop_keys_available', 'RSA keys not used yet.', counts.available))
+            lines.extend(_gauge('whistledrop_keys_used', 'RSA keys used for uploads.', counts.used))
+        for name, help_text in WORKER_GAUGES.items():
+            lines.extend(_gauge(name, help_text, gauges[name]))
+        return '\n'.join(lines) + '\n'
+
+def _gauge(name, help_text, value):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+
+class MetricsStore:
+    """
+    Directory shared by the workers of one server, holding one metrics snapshot file per worker.
+
+    The serve master creates it (see prepare_metrics_dir) and passes it to the
+    workers in METRICS_DIR. Files are replaced atomically, so readers always see
+    a complete snapshot.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, f"{os.getpid()}-{secrets.token_hex(4)}.json")
+
+    def write(self, snapshot):
+        _write_snapshot(self.path, snapshot)
+
+    def read_all(self):
+        """The snapshots of all workers, running or exited."""
+        return [snapshot for _, snapshot in _snapshots(self.directory)]
+
+def _write_snapshot(path, snapshot):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temp_path, path)
+
+def _snapshots(directory):
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path, 'r') as f:
+                yield path, json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable metrics snapshot {name}: {e}")
+
+def prepare_metrics_dir(directory=None):
+    """
+    Empty the metrics directory of a previous run, or create a private temporary one.
+
+    Returns (directory, created) where created tells whether the directory is
+    temporary and should be removed with remove_metrics_dir.
+    """
+    if not directory:
+        return tempfile.mkdtemp(prefix='whistledrop-metrics-'), True
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    for path, _ in list(_snapshots(directory)):
+        os.remove(path)
+    return directory, False
+
+def remove_metrics_dir(directory):
+    """Remove a temporary metrics directory created by prepare_metrics_dir."""
+    shutil.rmtree(directory, ignore_errors=True)
+
+def retire_worker(directory, pid):
+    """
+    Drop the gauges of an exited worker, keeping its counts.
+
+    Called by the serve master for every worker that exits, including workers
+    that were killed before they could write a final snapshot.
+    """
+    for path, snapshot in list(_snapshots(directory)):
+        if os.path.basename(path).startswith(f"{pid}-") and snapshot['gauges']:
+            _write_snapshot(path, dict(snapshot, gauges={}))
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.db_queries = 0
+
+def _teardown_request(exc):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    # Route names only; URLs would carry file ids
+    endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    metrics = current_app.extensions['metrics']
+    metrics.requests.observe(time.perf_counter() - started, endpoint)
+    metrics.queries.observe(g.pop('db_queries', 0), endpoint)
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+
+def metrics_enabled(config):
+    """Whether the metrics listener is configured (it needs both METRICS_PORT and METRICS_TOKEN)."""
+    return bool(config.get('METRICS_PORT') and config.get('METRICS_TOKEN'))
+
+class MetricsListener:
+    """
+    WSGI middleware answering the requests that arrive on the metrics listener.
+
+    The metrics listener is an extra bind on METRICS_HOST:METRICS_PORT (see
+    server.serve); Tor forwards visitors to PORT only. Requests are told apart
+    by SERVER_PORT, which gunicorn and werkzeug take from the socket that
+    accepted the connection, never from a header. The metrics listener serves
+    nothing but /metrics, with the token as a bearer token, and no other
+    listener serves /metrics at all.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, app, wsgi_app):
+        if app.config['METRICS_PORT'] == app.config.get('PORT', 5000):
+            raise ValueError("METRICS_PORT must differ from PORT, the port Tor forwards to")
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.port = str(app.config['METRICS_PORT'])
+        self.token = f"Bearer {app.config['METRICS_TOKEN']}".encode('utf-8')
+
+    def __call__(self, environ, start_response):
+        if environ.get('SERVER_PORT') != self.port:
+            return self.wsgi_app(environ, start_response)
+
+        supplied = environ.get('HTTP_AUTHORIZATION', '').encode('utf-8')
+        if environ.get('PATH_INFO') != '/metrics' or environ.get('REQUEST_METHOD') not in ('GET', 'HEAD') \
+                or not hmac.compare_digest(supplied, self.token):
+            return self._respond(start_response, '404 Not Found', 'text/plain; charset=utf-8', b'Not found\n')
+
+        with self.app.app_context():
+            body = self.app.extensions['metrics'].render(self.app).encode('utf-8')
+        return self._respond(start_response, '200 OK', self.CONTENT_TYPE, body)
+
+    @staticmethod
+    def _respond(start_response, status, content_type, body):
+        start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+        return [body]
+
+def init_app(app):
+    """Attach the metrics registry, the request and query hooks and, if configured, the metrics listener to the app."""
+    store = None
+    if metrics_enabled(app.config) and app.config.get('METRICS_DIR'):
+        store = MetricsStore(app.config['METRICS_DIR'])
+    metrics = Metrics(store, app.config.get('METRICS_FLUSH_INTERVAL', 5.0))
+    app.extensions['metrics'] = metrics
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    app.extensions['crypto_executor'].on_stage = metrics.observe_stage
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _count_query)
+    if metrics_enabled(app.config):
+        app.wsgi_app = MetricsListener(app, app.wsgi_app)
+
+def get_metrics():
+    """Return the metrics registry of the current app."""
+    return current_app.extensions['metrics']
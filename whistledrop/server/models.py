@@ -1,28 +1,70 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import deferred
 from datetime import datetime
 
 db = SQLAlchemy()
 
+class Submission(db.Model):
+    __tablename__ = 'submissions'
+    
+    # Files uploaded together; all of their AES keys are wrapped with the one RSA key claimed for the submission
+    id = db.Column(db.Integer, primary_key=True)
+    key_id = db.Column(db.Integer, db.ForeignKey('rsa_keys.id'), nullable=False, index=True)
+    file_count = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    
+    def __init__(self, key_id, file_count, created_at=None):
+        self.key_id = key_id
+        self.file_count = file_count
+        self.created_at = created_at or datetime.now()
+        
+    def __repr__(self):
+        return f'<Submission {self.id} ({self.file_count} files)>'
+
 class UploadedFile(db.Model):
     __tablename__ = 'uploaded_files'
+    __table_args__ = (
+        # Keyset pagination of /files walks this index in (created_at, id) order
+        db.Index('ix_uploaded_files_created_at_id', 'created_at', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
-    encrypted_data = db.Column(db.LargeBinary, nullable=False)
-    aes_key = db.Column(db.LargeBinary, nullable=False)
-    key_id = db.Column(db.Integer, db.ForeignKey('rsa_keys.id'), nullable=False)
+    # Payload columns are deferred so metadata queries never pull them into memory
+    encrypted_data = deferred(db.Column(db.LargeBinary, nullable=True))  # Only set for rows stored inline by older versions
+    aes_key = deferred(db.Column(db.LargeBinary, nullable=False))
+    key_id = db.Column(db.Integer, db.ForeignKey('rsa_keys.id'), nullable=False, index=True)  # PostgreSQL does not index foreign keys itself
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    
+    # Reference to the payload in the blob store
+    blob_ref = db.Column(db.String(255), nullable=True)
+    blob_size = db.Column(db.BigInteger, nullable=True)
+    blob_digest = db.Column(db.String(64), nullable=True)  # SHA-256 hex digest of the stored payload
+    # Envelope cipher mode (see server.crypto); NULL for rows written before it was recorded, which are AES-CBC
+    cipher_mode = db.Column(db.SmallInteger, nullable=True)
+    # Submission the file was uploaded in; NULL for files uploaded one per request by older versions
+    submission_id = db.Column(db.Integer, db.ForeignKey('submissions.id'), nullable=True, index=True)
 
-    def __init__(self, filename, encrypted_data, aes_key, key_id, created_at=None):
+    def __init__(self, filename, encrypted_data, aes_key, key_id, created_at=None,
+                 blob_ref=None, blob_size=None, blob_digest=None, cipher_mode=None, submission_id=None):
         self.filename = filename
         self.encrypted_data = encrypted_data
         self.aes_key = aes_key
         self.key_id = key_id
         self.created_at = created_at or datetime.now()
+        self.blob_ref = blob_ref
+        self.blob_size = blob_size
+        self.blob_digest = blob_digest
+        self.cipher_mode = cipher_mode
+        self.submission_id = submission_id
         
     def __repr__(self):
         return f'<UploadedFile {self.filename}>'
 
+# Columns needed for file listings; query these instead of whole UploadedFile objects
+FILE_METADATA_COLUMNS = (UploadedFile.id, UploadedFile.filename, UploadedFile.key_id, UploadedFile.created_at,
+                         UploadedFile.submission_id)
+
 class RSAKey(db.Model):
     __tablename__ = 'rsa_keys'
     
@@ -31,11 +73,22 @@ class RSAKey(db.Model):
     is_used = db.Column(db.Boolean, default=False, nullable=False)
     used_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    lease_owner = db.Column(db.String(128), nullable=True)  # Worker process holding the key in its lease block
+    leased_at = db.Column(db.DateTime, nullable=True)  # Last lease renewal; leases older than KEY_LEASE_TTL are expired
+    # SHA-256 over the key's DER encoding; duplicate checks use this instead of the PEM text
+    fingerprint = db.Column(db.String(64), nullable=True, unique=True, index=True)
     
-    def __init__(self, public_key, is_used=False, used_at=None):
+    def __init__(self, public_key, is_used=False, used_at=None, fingerprint=None):
         self.public_key = public_key
+        self.fingerprint = fingerprint
         self.is_used = is_used
         self.used_at = used_at
         
     def __repr__(self):
-        return f'<RSAKey {self.id} {"used" if self.is_used else "available"}>'
\ No newline at end of file
+        return f'<RSAKey {self.id} {"used" if self.is_used else "available"}>'
+
+# Partial index over the keys that can still be claimed; key claims only ever
+# look at this small set, however many keys have been used
+db.Index('ix_rsa_keys_available', RSAKey.id,
+         sqlite_where=db.and_(RSAKey.is_used == False, RSAKey.lease_owner.is_(None)),
+         postgresql_where=db.and_(RSAKey.is_used == False, RSAKey.lease_owner.is_(None)))
@@ -0,0 +1,191 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, case, cast, Date, and_
+from .models import db, RSAKey, UploadedFile
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip when streaming long result sets (server-side cursor on PostgreSQL)
+STREAM_BATCH_SIZE = 1000
+
+# Key consumption over this many days is used to project when the pool runs out
+DEFAULT_WINDOW_DAYS = 7
+
+PERIODS = ('day', 'week')
+
+# Stored ciphertext size; rows written before the blob store only have the inline payload
+_SIZE = func.coalesce(UploadedFile.blob_size, func.length(UploadedFile.encrypted_data))
+
+def _stream(statement):
+    """Execute statement and yield its rows without loading the whole result."""
+    result = db.session.execute(statement.execution_options(stream_results=True,
+                                                            max_row_buffer=STREAM_BATCH_SIZE))
+    try:
+        yield from result
+    finally:
+        result.close()
+
+def _period_start(period):
+    """SQL expression for the first day of the day/week a file was uploaded in (weeks start on Monday)."""
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period: {period}")
+    if db.engine.dialect.name == 'postgresql':
+        if period == 'week':
+            return cast(func.date_trunc('week', UploadedFile.created_at), Date)
+        return cast(UploadedFile.created_at, Date)
+    if period == 'week':
+        return func.date(UploadedFile.created_at, 'weekday 0', '-6 days')
+    return func.date(UploadedFile.created_at)
+
+def key_summary(window_days=DEFAULT_WINDOW_DAYS, now=None):
+    """
+    Key pool counts and the projected exhaustion time, from one aggregate query.
+
+    The projection assumes keys keep being used at the average rate of the last
+    window_days days; it is None when no key was used in that window.
+    """
+    now = now or datetime.now()
+    since = now - timedelta(days=window_days)
+    total, available, leased, recently_used = db.session.query(
+        func.count(RSAKey.id),
+        func.coalesce(func.sum(case((RSAKey.is_used == False, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((and_(RSAKey.is_used == False, RSAKey.lease_owner.isnot(None)), 1), else_=0)), 0),
+        func.coalesce(func.sum(case((RSAKey.used_at >= since, 1), else_=0)), 0)
+    ).one()
+
+    per_day = recently_used / window_days
+    days_left = available / per_day if per_day else None
+    return {
+        'total': total,
+        'available': available,
+        'leased': leased,
+        'used': total - available,
+        'used_per_day': round(per_day, 2),
+        'window_days': window_days,
+        'days_until_exhausted': round(days_left, 1) if days_left is not None else None,
+        'exhausted_at': (now + timedelta(days=days_left)).isoformat(timespec='minutes')
+                        if days_left is not None else None
+    }
+
+def file_summary():
+    """Upload and submission counts and ciphertext sizes, from one aggregate query."""
+    count, submissions, total_bytes, average_bytes, first, last = db.session.query(
+        func.count(UploadedFile.id),
+        func.count(func.distinct(UploadedFile.submission_id)),
+        func.coalesce(func.sum(_SIZE), 0),
+        func.avg(_SIZE),
+        func.min(UploadedFile.created_at),
+        func.max(UploadedFile.created_at)
+    ).one()
+    return {
+        'count': count,
+        'submissions': submissions,  # Files uploaded before submissions existed are not counted here
+        'total_bytes': int(total_bytes),
+        'average_bytes': round(float(average_bytes)) if average_bytes is not None else None,
+        'first_upload': first.isoformat(timespec='seconds') if first else None,
+        'last_upload': last.isoformat(timespec='seconds') if last else None
+    }
+
+def uploads_per_period(period='day'):
+    """Yield {'period', 'files', 'bytes'} per day or week with uploads, oldest first."""
+    start = _period_start(period).label('period')
+    statement = (select(start, func.count(UploadedFile.id), func.coalesce(func.sum(_SIZE), 0))
+                 .group_by(start).order_by(start))
+    for period_start, files, total_bytes in _stream(statement):
+        yield {'period': str(period_start), 'files': files, 'bytes': int(total_bytes)}
+
+def orphaned_keys():
+    """Yield keys marked as used that no file refers to (e.g. uploads that failed after the claim)."""
+    has_file = select(UploadedFile.id).where(UploadedFile.key_id == RSAKey.id).exists()
+    statement = (select(RSAKey.id, RSAKey.used_at)
+                 .where(RSAKey.is_used == True, ~has_file)
+                 .order_by(RSAKey.id))
+    for key_id, used_at in _stream(statement):
+        yield {'key_id': key_id, 'used_at': used_at.isoformat(timespec='seconds') if used_at else None}
+
+def key_usage():
+    """Yield the file each used key was used for, in one join."""
+    statement = (select(RSAKey.id, UploadedFile.id, UploadedFile.filename, UploadedFile.created_at)
+                 .join(UploadedFile, UploadedFile.key_id == RSAKey.id)
+                 .order_by(RSAKey.id, UploadedFile.id))
+    for key_id, file_id, filename, created_at in _stream(statement):
+        yield {'key_id': key_id, 'file_id': file_id, 'filename': filename,
+               'created_at': created_at.isoformat(timespec='seconds')}
+
+def status_report(period='day', window_days=DEFAULT_WINDOW_DAYS, include_keys=False):
+    """
+    Collect the status report.
+
+    The summaries are computed right away; the per-period counts, orphaned keys
+    and (with include_keys) the key usage are generators, so they are only
+    queried, and streamed, when the report is written.
+    """
+    sections = {
+        'keys': key_summary(window_days),
+        'files': file_summary(),
+        'uploads_per_' + period: uploads_per_period(period),
+        'orphaned_keys': orphaned_keys()
+    }
+    if include_keys:
+        sections['key_usage'] = key_usage()
+    return sections
+
+def write_json(report, out):
+    """Write a report as a JSON object, streaming generator sections element by element."""
+    out.write('{')
+    for i, (name, value) in enumerate(report.items()):
+        out.write(f'{"," if i else ""}\n  {json.dumps(name)}: ')
+        if not hasattr(value, '__next__'):
+            out.write(json.dumps(value))
+            continue
+        out.write('[')
+        for j, item in enumerate(value):
+            out.write(f'{"," if j else ""}\n    {json.dumps(item)}')
+        out.write('\n  ]')
+    out.write('\n}\n')
+
+def write_text(report, out):
+    """Write a report in human-readable form."""
+    keys = report['keys']
+    files = report['files']
+    out.write("\n=== WhistleDrop Status ===\n")
+    out.write(f"Total RSA keys: {keys['total']}\n")
+    out.write(f"Available keys: {keys['available']} ({keys['leased']} leased by server workers)\n")
+    out.write(f"Used keys: {keys['used']}\n")
+    submissions = f" in {files['submissions']} submissions" if files['submissions'] else ''
+    out.write(f"Uploaded files: {files['count']}{submissions}\n")
+    out.write(f"Ciphertext: {files['total_bytes']} bytes total, "
+              f"{files['average_bytes'] if files['average_bytes'] is not None else '-'} bytes average\n")
+    if files['count']:
+        out.write(f"First/last upload: {files['first_upload']} / {files['last_upload']}\n")
+
+    if keys['total'] == 0:
+        out.write("\nWARNING: No RSA keys in database. Run 'python manage.py generate' to add keys.\n")
+    elif keys['available'] == 0:
+        out.write("\nWARNING: No available RSA keys! Uploads will fail until keys are added.\n")
+    elif keys['days_until_exhausted'] is not None:
+        out.write(f"\nKey pool: {keys['used_per_day']} keys/day over the last {keys['window_days']} days, "
+                  f"exhausted in about {keys['days_until_exhausted']} days ({keys['exhausted_at']})\n")
+    else:
+        out.write(f"\nKey pool: no keys used in the last {keys['window_days']} days\n")
+
+    for name, rows in report.items():
+        if name.startswith('uploads_per_'):
+            out.write(f"\nUploads per {name[len('uploads_per_'):]}:\n")
+            for row in rows:
+                out.write(f"  {row['period']}  {row['files']:>8} files  {row['bytes']:>14} bytes\n")
+
+    orphaned = 0
+    for row in report['orphaned_keys']:
+        if not orphaned:
+            out.write("\nKeys marked as used but no file found:\n")
+        out.write(f"  Key ID {row['key_id']} (used {row['used_at'] or 'at unknown time'})\n")
+        orphaned += 1
+    if orphaned:
+        out.write(f"  {orphaned} orphaned keys\n")
+
+    if 'key_usage' in report:
+        out.write("\nKey usage:\n")
+        for row in report['key_usage']:
+            out.write(f"  Key ID {row['key_id']}: Used for file '{row['filename']}' on {row['created_at']}\n")
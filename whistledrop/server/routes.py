@@ -1,10 +1,20 @@
 from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify, current_app, send_file
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import undefer
 from datetime import datetime
 import os
 import io
+import hashlib
 import logging
-from .crypto import generate_aes_key, encrypt_file, encrypt_aes_key
-from .models import db, UploadedFile, RSAKey
+from urllib.parse import quote
+from .crypto import generate_aes_key, encrypt_stream, encrypt_aes_key, prepare_public_key, is_legacy_blob, \
+    choose_compression, EncryptionCancelled, CIPHER_MODES, COMPRESSION_MODES, MODE_AES_CBC
+from .models import db, UploadedFile, RSAKey, Submission, FILE_METADATA_COLUMNS
+from .storage import get_blob_store, load_payload
+from .keypool import get_key_pool
+from .executor import get_crypto_executor, Saturated
+from .metrics import get_metrics
 import base64
 
 main = Blueprint('main', __name__)
@@ -18,95 +28,177 @@ def index():
 @main.route('/upload', methods=['GET'])
 def upload():
     """File upload form page."""
-    # Check if there are available keys first
-    available_keys = RSAKey.query.filter_by(is_used=False).first()
-    if not available_keys:
+    # Check if there are available keys first (served from the cached counters)
+    if get_key_pool().stats.snapshot().available == 0:
         return render_template('error.html', 
                               message="The service is currently unable to accept new uploads. Please try again later.")
     
     return render_template('upload.html')
 
+def _encrypt_upload(store, stream, aes_key, key_id, chunk_size, mode, compression, compression_level, cancel=None):
+    """Encrypt an upload into the blob store (runs on the crypto executor)."""
+    # Already compressed uploads (images, Office documents, archives) are stored as they are
+    stream, compression = choose_compression(stream, compression)
+    with store.writer() as blob:
+        encrypt_stream(stream, blob, aes_key, key_id=key_id, chunk_size=chunk_size, mode=mode, cancel=cancel,
+                       compression=compression, compression_level=compression_level)
+        return blob.commit()
+
+def _wrap_keys(aes_keys, public_key, cancel=None):
+    """
+    Encrypt the AES keys of a submission with its one RSA public key (runs on the crypto executor).
+
+    Stops with EncryptionCancelled between keys once cancel is set, e.g. after the wrap stage timed out.
+    """
+    # Parse a PEM key once for the whole submission
+    cipher = public_key if hasattr(public_key, 'encrypt') else prepare_public_key(public_key)
+    wrapped = []
+    for aes_key in aes_keys:
+        if cancel is not None and cancel.is_set():
+            raise EncryptionCancelled()
+        wrapped.append(encrypt_aes_key(aes_key, cipher))
+    return wrapped
+
+def _busy():
+    """Fast rejection while the crypto executor is saturated."""
+    logger.warning("Upload rejected: crypto executor saturated")
+    retry_after = current_app.config.get('CRYPTO_RETRY_AFTER', 5)
+    message = "The service is busy right now. Please try again in a moment."
+    return render_template('error.html', message=message), 503, {'Retry-After': str(retry_after)}
+
 @main.route('/upload_file', methods=['POST'])
 def upload_file():
-    """Handle file uploads from whistleblowers."""
-    # Check if a file was uploaded
-    if 'file' not in request.files:
+    """
+    Handle file uploads from whistleblowers.
+    
+    All files of one request form a submission: each file gets its own AES key,
+    all AES keys are wrapped with a single claimed RSA key, and the files are
+    stored in one transaction, so either the whole submission is kept or none
+    of it.
+    """
+    metrics = get_metrics()
+    
+    # Reject before the upload body is even parsed if encryption is backed up
+    executor = get_crypto_executor()
+    if executor.saturated():
+        metrics.observe_upload('busy')
+        return _busy()
+    
+    # Check if files were uploaded (parsing the form reads the whole request body)
+    with metrics.stage('parse'):
+        files = request.files
+    if 'file' not in files:
+        metrics.observe_upload('invalid')
         flash('No file part')
         return redirect(request.url)
     
-    file = request.files['file']
-    if file.filename == '':
+    uploads = [file for file in files.getlist('file') if file.filename != '']
+    if not uploads:
+        metrics.observe_upload('invalid')
         flash('No file selected')
         return redirect(request.url)
     
-    # Check if the file is allowed
+    max_files = current_app.config.get('MAX_FILES_PER_SUBMISSION', 50)
+    if len(uploads) > max_files:
+        metrics.observe_upload('invalid')
+        flash(f'Too many files (at most {max_files} per upload)')
+        return redirect(request.url)
+    
+    # Check if the files are allowed
     def allowed_file(filename):
         return '.' in filename and \
                filename.rsplit('.', 1)[1].lower() in current_app.config.get('ALLOWED_EXTENSIONS', 
                                                                             {'pdf', 'txt', 'docx', 'xlsx', 'png', 'jpg'})
     
-    if not allowed_file(file.filename):
+    if not all(allowed_file(file.filename) for file in uploads):
+        metrics.observe_upload('invalid')
         flash('File type not allowed')
         return redirect(request.url)
     
+    unused_key = None
+    stored = []  # blob infos of the files encrypted so far, deleted again if the submission fails
+    store = get_blob_store()
     try:
-        # Get an unused RSA public key
-        unused_key = RSAKey.query.filter_by(is_used=False).first()
+        # Atomically claim one unused RSA public key for the whole submission
+        with metrics.stage('claim'):
+            unused_key = get_key_pool().claim()
         if unused_key is None:
+            metrics.observe_upload('no_key')
             flash('No available keys for encryption')
             return redirect(request.url)
         
-        # Read the file content first
-        file_contents = file.read()
+        # Generate a random AES key per file and encrypt each upload stream
+        # chunk by chunk straight into the blob store
+        cipher_mode = CIPHER_MODES[current_app.config.get('ENCRYPTION_MODE', 'aes-gcm-stream')]
+        compression = COMPRESSION_MODES[current_app.config.get('COMPRESSION', 'none')]
+        aes_keys = []
+        for file in uploads:
+            aes_key = generate_aes_key()
+            stored.append(executor.run('encrypt', current_app.config.get('CRYPTO_ENCRYPT_TIMEOUT', 120.0),
+                                       _encrypt_upload, store, file.stream, aes_key, unused_key.id,
+                                       current_app.config.get('ENCRYPTION_CHUNK_SIZE', 64 * 1024), cipher_mode,
+                                       compression, current_app.config.get('COMPRESSION_LEVEL', 6),
+                                       on_late_result=lambda info: store.delete(info.ref)))
+            aes_keys.append(aes_key)
         
-        # Generate a random AES key for file encryption
-        # Encrypt the file
-        aes_key = generate_aes_key()
-        encrypted_data = encrypt_file(file_contents, aes_key)
+        # Encrypt the AES keys with the RSA public key
+        encrypted_aes_keys = executor.run('wrap', current_app.config.get('CRYPTO_WRAP_TIMEOUT', 10.0),
+                                          _wrap_keys, aes_keys, unused_key.cipher or unused_key.public_key)
         
-        # Ensure encrypted_data is a proper JSON string, then encode to bytes
-        if isinstance(encrypted_data, bytes):
-            # If it's already bytes, decode it to string first so we can ensure consistent format
-            encrypted_data = encrypted_data.decode('utf-8')
-        
-        # Convert to bytes before storing in the database
-        encrypted_data_bytes = encrypted_data.encode('utf-8')
-        
-        # Encrypt the AES key with the RSA public key
-        encrypted_aes_key = encrypt_aes_key(aes_key, unused_key.public_key)
-        
-        # Save to database - with encrypted_data as bytes
-        new_file = UploadedFile(
+        # Save to database - the submission and a reference to each stored payload
+        now = datetime.now()
+        submission = Submission(key_id=unused_key.id, file_count=len(uploads), created_at=now)
+        db.session.add(submission)
+        db.session.flush()
+        db.session.add_all([UploadedFile(
             filename=file.filename,
-            encrypted_data=encrypted_data_bytes,  # Now this is bytes
+            encrypted_data=None,
             aes_key=encrypted_aes_key,            # This should already be bytes
             key_id=unused_key.id,
-            created_at=datetime.now()
-        )
-        
-        # Mark the RSA key as used
-        unused_key.is_used = True
-        unused_key.used_at = datetime.now()
+            created_at=now,
+            blob_ref=blob_info.ref,
+            blob_size=blob_info.size,
+            blob_digest=blob_info.digest,
+            cipher_mode=cipher_mode,
+            submission_id=submission.id
+        ) for file, blob_info, encrypted_aes_key in zip(uploads, stored, encrypted_aes_keys)])
         
         # Commit changes to the database
-        db.session.add(new_file)
-        db.session.commit()
+        with metrics.stage('commit'):
+            db.session.commit()
+        sizes = [blob_info.size for blob_info in stored]
+        # The submission is stored; neither its blobs nor its key may be given back from here on
+        stored, unused_key = [], None
         
-        logger.info(f"File '{file.filename}' uploaded and encrypted successfully")
-        return render_template('success.html')
+        # No filenames or ids in the log: the log must not help link uploads to people
+        logger.info(f"Submission of {len(uploads)} files encrypted and stored successfully")
+        metrics.observe_upload('ok', sizes)
+        with metrics.stage('render'):
+            return render_template('success.html', file_count=len(uploads))
     
     except Exception as e:
-        logger.error(f"Error during file upload: {e}")
+        if isinstance(e, Saturated):
+            metrics.observe_upload('busy')
+            response = _busy()
+        else:
+            metrics.observe_upload('error')
+            logger.error(f"Error during file upload: {e}")
+            flash('An error occurred during upload. Please try again.')
+            response = redirect(url_for('main.upload'))
         db.session.rollback()
-        flash('An error occurred during upload. Please try again.')
-        return redirect(url_for('main.upload'))
+        for blob_info in stored:
+            store.delete(blob_info.ref)
+        if unused_key is not None:
+            # Nothing was stored under this key, so it can go back to the pool
+            get_key_pool().release(unused_key.id)
+        return response
 
 @main.route('/retrieve/<int:file_id>', methods=['GET'])
 def retrieve_file(file_id):
     """API endpoint for journalists to retrieve encrypted files."""
     try:
-        # Get the file from the database
-        file = UploadedFile.query.get_or_404(file_id)
+        # Get the file from the database, including the wrapped AES key
+        file = UploadedFile.query.options(undefer(UploadedFile.aes_key)).filter_by(id=file_id).first_or_404()
         
         # Get the corresponding key
         key = RSAKey.query.get_or_404(file.key_id)
@@ -116,14 +208,22 @@ def retrieve_file(file_id):
             'id': file.id,
             'filename': file.filename,
             'key_id': file.key_id,
-            'created_at': file.created_at.isoformat() if file.created_at else None
+            'submission_id': file.submission_id,
+            'created_at': file.created_at.isoformat() if file.created_at else None,
+            'cipher_mode': file.cipher_mode or MODE_AES_CBC
         }
         
-        # Handle encrypted_data based on its type
-        if isinstance(file.encrypted_data, bytes):
-            response_data['encrypted_data'] = file.encrypted_data.decode('utf-8')
+        # Legacy rows hold a JSON document, newer rows a binary envelope
+        encrypted_data = load_payload(file)
+        if is_legacy_blob(encrypted_data):
+            response_data['format'] = 'json'
+            if isinstance(encrypted_data, bytes):
+                response_data['encrypted_data'] = encrypted_data.decode('utf-8')
+            else:
+                response_data['encrypted_data'] = encrypted_data
         else:
-            response_data['encrypted_data'] = file.encrypted_data
+            response_data['format'] = 'envelope'
+            response_data['encrypted_data'] = base64.b64encode(encrypted_data).decode('utf-8')
             
         # Handle aes_key based on its type
         if isinstance(file.aes_key, bytes):
@@ -137,27 +237,157 @@ def retrieve_file(file_id):
         logger.error(f"Error retrieving file {file_id}: {e}")
         return jsonify({'error': 'File not found or error retrieving file'}), 404
 
+@main.route('/download/<int:file_id>', methods=['GET'])
+def download_file(file_id):
+    """
+    API endpoint for journalists to download the stored ciphertext as a binary stream.
+    
+    Supports Range requests so interrupted downloads can be resumed. File metadata
+    and the wrapped AES key are sent in X-WhistleDrop-* headers, so a HEAD request
+    fetches them without the payload.
+    """
+    try:
+        file = UploadedFile.query.options(undefer(UploadedFile.aes_key)).filter_by(id=file_id).first()
+        if file is None:
+            return jsonify({'error': 'File not found'}), 404
+        
+        store = get_blob_store()
+        if file.blob_ref:
+            with store.open(file.blob_ref) as f:
+                legacy = is_legacy_blob(f.read(1))
+            payload = store.local_path(file.blob_ref) or store.open(file.blob_ref)
+            digest = file.blob_digest
+        else:
+            # Legacy row stored inline in the database
+            legacy = is_legacy_blob(file.encrypted_data)
+            payload = io.BytesIO(file.encrypted_data)
+            digest = hashlib.sha256(file.encrypted_data).hexdigest()
+        
+        response = send_file(payload, mimetype='application/octet-stream', conditional=True,
+                             etag=digest, max_age=0)
+        
+        response.headers['X-WhistleDrop-File-Id'] = str(file.id)
+        response.headers['X-WhistleDrop-Key-Id'] = str(file.key_id)
+        response.headers['X-WhistleDrop-Filename'] = quote(file.filename)
+        response.headers['X-WhistleDrop-Created-At'] = file.created_at.isoformat() if file.created_at else ''
+        response.headers['X-WhistleDrop-Wrapped-Key'] = base64.b64encode(file.aes_key).decode('utf-8')
+        response.headers['X-WhistleDrop-Digest'] = digest
+        response.headers['X-WhistleDrop-Format'] = 'json' if legacy else 'envelope'
+        response.headers['X-WhistleDrop-Cipher-Mode'] = str(file.cipher_mode or MODE_AES_CBC)
+        response.headers['X-WhistleDrop-Submission-Id'] = str(file.submission_id or '')
+        return response
+    
+    except HTTPException:
+        # e.g. 416 for a Range beyond the end of the payload
+        raise
+    except Exception as e:
+        logger.error(f"Error downloading file {file_id}: {e}")
+        return jsonify({'error': 'File not found or error retrieving file'}), 404
+
+@main.route('/submissions/<int:submission_id>', methods=['GET'])
+def get_submission(submission_id):
+    """
+    API endpoint for journalists to fetch a submission as a unit.
+    
+    Returns the metadata of every file in the submission with its wrapped AES
+    key and payload digest, all wrapped with the submission's one RSA key. The
+    payloads themselves are fetched through /download/<id>.
+    """
+    try:
+        submission = Submission.query.get(submission_id)
+        if submission is None:
+            return jsonify({'error': 'Submission not found'}), 404
+        
+        files = (UploadedFile.query.options(undefer(UploadedFile.aes_key))
+                 .filter_by(submission_id=submission_id).order_by(UploadedFile.id).all())
+        return jsonify({
+            'id': submission.id,
+            'key_id': submission.key_id,
+            'created_at': submission.created_at.isoformat() if submission.created_at else None,
+            'file_count': submission.file_count,
+            'files': [{
+                'id': file.id,
+                'filename': file.filename,
+                'size': file.blob_size,
+                'digest': file.blob_digest,
+                'cipher_mode': file.cipher_mode or MODE_AES_CBC,
+                'encrypted_aes_key': base64.b64encode(file.aes_key).decode('utf-8')
+            } for file in files]
+        })
+    
+    except Exception as e:
+        logger.error(f"Error retrieving submission {submission_id}: {e}")
+        return jsonify({'error': 'Submission not found or error retrieving submission'}), 404
+
+def _encode_cursor(created_at, file_id):
+    """Encode the position after a listed file as an opaque cursor."""
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{file_id}".encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor):
+    """Decode a cursor from _encode_cursor into (created_at, id)."""
+    created_at, file_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+    return datetime.fromisoformat(created_at), int(file_id)
+
 @main.route('/files', methods=['GET'])
 def list_files():
     """
-    API endpoint for journalists to list all available files.
+    API endpoint for journalists to list available files.
     This should only be accessed through the journalist client.
+    
+    Files are returned oldest first, one page at a time. Query parameters:
+    limit (page size), after (cursor from the previous page's 'next') and
+    since (ISO timestamp, only files uploaded at or after it). Without limit
+    and after, all files are returned in one response, as clients written
+    before pagination expect; 'total' is kept for them as well (and only for them).
+    Responses carry a weak ETag; an unchanged page answers If-None-Match with 304.
     """
     # Basic authentication could be added here
     
     try:
-        files = UploadedFile.query.all()
+        paginated = 'limit' in request.args or 'after' in request.args
+        limit = request.args.get('limit', current_app.config.get('FILES_PAGE_SIZE', 100), type=int)
+        limit = max(1, min(limit, current_app.config.get('FILES_MAX_PAGE_SIZE', 500)))
+        
+        query = db.session.query(*FILE_METADATA_COLUMNS)
+        try:
+            if request.args.get('since'):
+                query = query.filter(UploadedFile.created_at >= datetime.fromisoformat(request.args['since']))
+            if request.args.get('after'):
+                created_at, file_id = _decode_cursor(request.args['after'])
+                query = query.filter(or_(UploadedFile.created_at > created_at,
+                                         and_(UploadedFile.created_at == created_at, UploadedFile.id > file_id)))
+        except (ValueError, UnicodeDecodeError):
+            return jsonify({'error': 'Invalid since or after parameter'}), 400
+        
+        query = query.order_by(UploadedFile.created_at, UploadedFile.id)
+        if paginated:
+            # Fetch one extra row to find out whether there is a next page
+            files = query.limit(limit + 1).all()
+            has_more = len(files) > limit
+            files = files[:limit]
+        else:
+            files = query.all()
+            has_more = False
+        
         file_list = [{
             'id': file.id,
             'filename': file.filename,
             'key_id': file.key_id,
-            'created_at': file.created_at.isoformat() if file.created_at else None
+            'created_at': file.created_at.isoformat() if file.created_at else None,
+            'submission_id': file.submission_id
         } for file in files]
         
-        return jsonify({
-            'total': len(file_list),
-            'files': file_list
-        })
+        result = {
+            'count': len(file_list),
+            'files': file_list,
+            'next': _encode_cursor(files[-1].created_at, files[-1].id) if has_more else None
+        }
+        if not paginated:
+            # Name used before pagination; a page has no cheap total, so paginated responses omit it
+            result['total'] = len(file_list)
+        response = jsonify(result)
+        response.add_etag(weak=True)
+        return response.make_conditional(request)
     
     except Exception as e:
         logger.error(f"Error listing files: {e}")
@@ -170,14 +400,14 @@ def key_status():
     This is used by both the web interface and journalist client.
     """
     try:
-        total_keys = RSAKey.query.count()
-        available_keys = RSAKey.query.filter_by(is_used=False).count()
+        counts = get_key_pool().stats.snapshot()
         
         return jsonify({
-            'total': total_keys,
-            'available': available_keys,
-            'used': total_keys - available_keys,
-            'accepting_uploads': available_keys > 0
+            'total': counts.total,
+            'available': counts.available,
+            'used': counts.used,
+            'accepting_uploads': counts.available > 0,
+            'prepared_keys': get_key_pool().queue_stats()
         })
     
     except Exception as e:
@@ -188,7 +418,7 @@ def key_status():
 def status():
     """General service status endpoint."""
     try:
-        available_keys = RSAKey.query.filter_by(is_used=False).count()
+        available_keys = get_key_pool().stats.snapshot().available
         
         # Get the onion address if available
         onion_address = current_app.config.get('ONION_DOMAIN', 'Not available as Tor hidden service')
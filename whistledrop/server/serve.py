@@ -0,0 +1,112 @@
+import os
+import logging
+from gunicorn.app.base import BaseApplication
+from .app import create_app, prepare_server
+from .keypool import start_lease_expiry
+from .models import db
+from .metrics import metrics_enabled, prepare_metrics_dir, remove_metrics_dir, retire_worker, METRICS_HOST
+
+logger = logging.getLogger(__name__)
+
+class WhistleDropServer(BaseApplication):
+    """
+    Runs WhistleDrop under gunicorn's pre-fork server.
+
+    The master process does the one-time startup work (database setup, Tor),
+    expires stale key leases and then forks the workers. Each worker builds its own app, so database
+    connections and key pool threads are never shared across a fork. Sending
+    SIGHUP to the master starts fresh workers and lets the old ones finish their
+    in-flight requests within SERVER_GRACEFUL_TIMEOUT.
+    """
+
+    def __init__(self, options, tor_service=None, metrics_dir=None, temporary_metrics_dir=False):
+        self.options = options
+        self.tor_service = tor_service
+        self.metrics_dir = metrics_dir
+        self.temporary_metrics_dir = temporary_metrics_dir
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('post_worker_init', _worker_init)
+        self.cfg.set('worker_exit', _worker_exit)
+        self.cfg.set('child_exit', self._child_exit)
+        self.cfg.set('on_exit', self._on_exit)
+
+    def load(self):
+        return create_app()
+
+    def _child_exit(self, server, worker):
+        # Runs in the master, also for workers that were killed before their final snapshot
+        if self.metrics_dir:
+            retire_worker(self.metrics_dir, worker.pid)
+
+    def _on_exit(self, server):
+        if self.tor_service:
+            self.tor_service.close()
+        if self.metrics_dir and self.temporary_metrics_dir:
+            remove_metrics_dir(self.metrics_dir)
+
+def _worker_init(worker):
+    """Start writing the new worker's metrics snapshots for the /metrics listener."""
+    metrics = worker.wsgi.extensions.get('metrics')
+    if metrics:
+        metrics.flush(worker.wsgi)
+        metrics.start_flusher(worker.wsgi)
+
+def _worker_exit(server, worker):
+    """Return the exiting worker's leased RSA keys to the pool and write its final metrics."""
+    app = getattr(worker, 'wsgi', None)
+    if not app:
+        return
+    key_pool = app.extensions.get('key_pool')
+    if key_pool:
+        key_pool.shutdown()
+    metrics = app.extensions.get('metrics')
+    if metrics:
+        metrics.flush(app, final=True)
+
+def server_options(config, workers=None, threads=None):
+    """gunicorn settings derived from the app configuration."""
+    bind = [f"{config.get('HOST', '127.0.0.1')}:{config.get('PORT', 5000)}"]
+    if metrics_enabled(config):
+        # Separate listener for the scraper, never reachable through Tor
+        bind.append(f"{METRICS_HOST}:{config['METRICS_PORT']}")
+    return {
+        'bind': bind,
+        'workers': workers or config.get('SERVER_WORKERS', 1),
+        'threads': threads or config.get('SERVER_THREADS', 1),
+        'worker_class': 'gthread',
+        'keepalive': config.get('SERVER_KEEPALIVE', 5),
+        'timeout': config.get('SERVER_TIMEOUT', 120),
+        'graceful_timeout': config.get('SERVER_GRACEFUL_TIMEOUT', 120),
+        'proc_name': 'whistledrop'
+    }
+
+def run(workers=None, threads=None):
+    """Set up the database and Tor once, then serve with multiple worker processes."""
+    app = create_app()
+    tor_service = prepare_server(app)
+    with app.app_context():
+        # Connections opened during setup must not be inherited by the workers
+        db.engine.dispose()
+    # Expire leases of workers that died without returning their keys; one process is enough
+    start_lease_expiry(app)
+
+    # Workers are forked after this point and read the onion domain and secret key from the environment
+    if app.config.get('ONION_DOMAIN'):
+        os.environ['ONION_DOMAIN'] = app.config['ONION_DOMAIN']
+    os.environ['SECRET_KEY'] = app.config['SECRET_KEY']
+    metrics_dir, temporary = None, False
+    if metrics_enabled(app.config):
+        metrics_dir, temporary = prepare_metrics_dir(app.config.get('METRICS_DIR'))
+        os.environ['METRICS_DIR'] = metrics_dir
+
+    options = server_options(app.config, workers=workers, threads=threads)
+    logger.info(f"Starting WhistleDrop server on {', '.join(options['bind'])} "
+                f"({options['workers']} workers x {options['threads']} threads)")
+    WhistleDropServer(options, tor_service, metrics_dir, temporary).run()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,173 @@
+import os
+import hashlib
+import logging
+import tempfile
+from collections import namedtuple
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# Reference, size in bytes and SHA-256 hex digest of a stored payload
+BlobInfo = namedtuple('BlobInfo', ['ref', 'size', 'digest'])
+
+class BlobWriter:
+    """
+    Write handle for a new payload.
+
+    Data is hashed while it is written. Nothing becomes visible in the store until
+    commit() is called; leaving the context manager without committing discards it.
+    """
+
+    def __init__(self, store, fileobj, temp_path):
+        self.store = store
+        self.fileobj = fileobj
+        self.temp_path = temp_path
+        self.size = 0
+        self.info = None
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self._hash.update(data)
+        self.fileobj.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def commit(self):
+        """Make the payload durable and return its BlobInfo."""
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        self.fileobj.close()
+        self.info = self.store._commit(self.temp_path, BlobInfo(None, self.size, self._hash.hexdigest()))
+        return self.info
+
+    def abort(self):
+        """Discard the payload written so far."""
+        if not self.fileobj.closed:
+            self.fileobj.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.info is None:
+            self.abort()
+        return False
+
+class BlobStore:
+    """Interface for encrypted payload storage backends."""
+
+    def writer(self):
+        """Return a BlobWriter for a new payload."""
+        raise NotImplementedError
+
+    def open(self, ref):
+        """Open a stored payload for binary reading."""
+        raise NotImplementedError
+
+    def delete(self, ref):
+        """Remove a stored payload. Returns True if it existed."""
+        raise NotImplementedError
+
+    def exists(self, ref):
+        """Check whether a payload is stored under ref."""
+        raise NotImplementedError
+
+    def local_path(self, ref):
+        """Return a local filesystem path for ref, or None if the backend has none."""
+        return None
+
+class FilesystemBlobStore(BlobStore):
+    """
+    Content-addressed payload store on the local filesystem.
+
+    Payloads are stored under their SHA-256 digest and sharded into nested
+    directories (ab/cd/abcd...) so no single directory grows too large. Writes go
+    to a temporary file that is fsynced and atomically renamed into place.
+    """
+
+    def __init__(self, root, shard_depth=2, shard_width=2):
+        self.root = os.path.abspath(root)
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        self.temp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def _path(self, ref):
+        if len(ref) < self.shard_depth * self.shard_width or not all(c in '0123456789abcdef' for c in ref):
+            raise ValueError(f"Invalid blob reference: {ref!r}")
+        shards = [ref[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_depth)]
+        return os.path.join(self.root, *shards, ref)
+
+    def writer(self):
+        fd, temp_path = tempfile.mkstemp(dir=self.temp_dir, suffix='.part')
+        return BlobWriter(self, os.fdopen(fd, 'wb'), temp_path)
+
+    def _commit(self, temp_path, info):
+        ref = info.digest
+        path = self._path(ref)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        if os.path.exists(path):
+            # Identical content is already stored
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+            _fsync_directory(directory)
+
+        return info._replace(ref=ref)
+
+    def open(self, ref):
+        return open(self._path(ref), 'rb')
+
+    def delete(self, ref):
+        try:
+            os.remove(self._path(ref))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def exists(self, ref):
+        return os.path.exists(self._path(ref))
+
+    def local_path(self, ref):
+        return self._path(ref)
+
+def _fsync_directory(path):
+    """Persist a rename by syncing its directory (not supported on Windows)."""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Available storage backends, selected with Config.STORAGE_BACKEND
+BACKENDS = {
+    'filesystem': lambda config: FilesystemBlobStore(config['UPLOAD_FOLDER'])
+}
+
+def create_blob_store(config):
+    """Create the storage backend configured in config."""
+    backend = config.get('STORAGE_BACKEND', 'filesystem')
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return BACKENDS[backend](config)
+
+def init_app(app):
+    """Attach the configured storage backend to the app."""
+    app.extensions['blob_store'] = create_blob_store(app.config)
+
+def get_blob_store():
+    """Return the storage backend of the current app."""
+    return current_app.extensions['blob_store']
+
+def load_payload(uploaded_file):
+    """Read the full encrypted payload of an UploadedFile, wherever it is stored."""
+    if uploaded_file.blob_ref:
+        with get_blob_store().open(uploaded_file.blob_ref) as f:
+            return f.read()
+    return uploaded_file.encrypted_data
@@ -1,11 +1,12 @@
 // Basic client-side functionality for WhistleDrop
 
 document.addEventListener('DOMContentLoaded', function() {
-    // Show file name when selected
+    // Show file names when selected
     const fileInput = document.getElementById('file');
     if (fileInput) {
         fileInput.addEventListener('change', function() {
-            const fileName = this.files[0] ? this.files[0].name : 'No file selected';
+            const fileName = this.files.length > 1 ? `${this.files.length} files selected` :
+                             this.files[0] ? this.files[0].name : 'No file selected';
             const fileLabel = document.querySelector('.file-name');
             if (!fileLabel) {
                 const label = document.createElement('span');
@@ -0,0 +1,120 @@
+"""
+Shared fixtures: apps on a fresh database for every supported backend.
+
+SQLite always runs. PostgreSQL runs when WHISTLEDROP_TEST_POSTGRES_URI points at
+a database whose tables the tests may drop and recreate, e.g.
+    WHISTLEDROP_TEST_POSTGRES_URI=postgresql://postgres@localhost/whistledrop_test python -m pytest
+"""
+import os
+from datetime import datetime
+
+import pytest
+from sqlalchemy import MetaData, Table, Column, Integer, String, Text, Boolean, DateTime, LargeBinary, ForeignKey
+
+from server.app import create_app
+from server.config import Config
+from server.models import db, RSAKey
+
+POSTGRES_URI = os.environ.get('WHISTLEDROP_TEST_POSTGRES_URI')
+
+BACKENDS = [
+    'sqlite',
+    pytest.param('postgresql', marks=pytest.mark.skipif(not POSTGRES_URI, reason='WHISTLEDROP_TEST_POSTGRES_URI not set'))
+]
+
+@pytest.fixture(params=BACKENDS)
+def database_uri(request, tmp_path):
+    """URI of an empty test database."""
+    if request.param == 'sqlite':
+        return f"sqlite:///{tmp_path / 'test.db'}"
+    return POSTGRES_URI
+
+@pytest.fixture
+def make_app(database_uri, tmp_path):
+    """
+    Factory for apps on the test database; keyword arguments override config settings.
+
+    Several apps on the same database stand in for several worker processes.
+    Background key pool threads are off unless enabled through the settings.
+    """
+    apps = []
+
+    def factory(**settings):
+        config = type('TestConfig', (Config,), dict({
+            'SECRET_KEY': 'test',
+            'SQLALCHEMY_DATABASE_URI': database_uri,
+            'DATABASE_URI': database_uri,
+            'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+            'HIDDEN_SERVICE_DIR': str(tmp_path / 'hidden_service'),
+            'USE_TOR': False,
+            'GENERATE_TEST_KEYS': False,
+            'RSA_PUBLIC_KEYS_FILE': None,
+            'KEY_PREPARE_QUEUE_SIZE': 0,
+            'KEY_STATS_RECONCILE_INTERVAL': 0
+        }, **settings))
+        app = create_app(config)
+        apps.append(app)
+        return app
+
+    yield factory
+
+    for app in apps:
+        app.extensions['key_pool'].shutdown()
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+
+@pytest.fixture
+def app(make_app):
+    """An app on a test database with freshly created tables."""
+    app = make_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+@pytest.fixture
+def add_keys(app):
+    """Insert placeholder public keys (enough for code that never parses them); returns their ids."""
+    def add(count):
+        with app.app_context():
+            db.session.execute(RSAKey.__table__.insert(), [
+                {'public_key': f'test-key-{os.urandom(8).hex()}', 'is_used': False, 'created_at': datetime.now()}
+                for _ in range(count)])
+            db.session.commit()
+            return [key_id for key_id, in db.session.query(RSAKey.id).order_by(RSAKey.id)]
+    return add
+
+# The tables as the first release created them
+legacy = MetaData()
+Table('rsa_keys', legacy,
+      Column('id', Integer, primary_key=True),
+      Column('public_key', Text, nullable=False, unique=True),
+      Column('is_used', Boolean, nullable=False),
+      Column('used_at', DateTime),
+      Column('created_at', DateTime, nullable=False))
+Table('uploaded_files', legacy,
+      Column('id', Integer, primary_key=True),
+      Column('filename', String(255), nullable=False),
+      Column('encrypted_data', LargeBinary, nullable=False),
+      Column('aes_key', LargeBinary, nullable=False),
+      Column('key_id', Integer, ForeignKey('rsa_keys.id'), nullable=False),
+      Column('created_at', DateTime, nullable=False))
+
+UPLOADED_AT = datetime(2024, 5, 6, 7, 8, 9)
+
+@pytest.fixture
+def legacy_app(make_app):
+    """An app on a database with the first release's tables and one stored file."""
+    app = make_app()
+    with app.app_context():
+        db.drop_all()
+        legacy.create_all(db.engine)
+        with db.engine.begin() as connection:
+            connection.execute(legacy.tables['rsa_keys'].insert(), [
+                {'public_key': 'key-1', 'is_used': True, 'used_at': UPLOADED_AT, 'created_at': UPLOADED_AT},
+                {'public_key': 'key-2', 'is_used': False, 'used_at': None, 'created_at': UPLOADED_AT}])
+            connection.execute(legacy.tables['uploaded_files'].insert(), {
+                'filename': 'old.pdf', 'encrypted_data': b'inline payload', 'aes_key': b'wrapped key',
+                'key_id': 1, 'created_at': UPLOADED_AT})
+    return app
@@ -0,0 +1,68 @@
+"""Schema upgrade tests: tables created by the first release are brought in line with the models."""
+from sqlalchemy import inspect
+
+from server.db_init import upgrade_schema
+from server.models import db, RSAKey, UploadedFile
+
+from conftest import UPLOADED_AT
+
+def _schema(app):
+    """Column name -> (type, nullable) per table."""
+    with app.app_context():
+        inspector = inspect(db.engine)
+        return {table: {column['name']: (str(column['type']), column['nullable'])
+                        for column in inspector.get_columns(table)}
+                for table in ('rsa_keys', 'uploaded_files')}
+
+def _indexes(app, table):
+    with app.app_context():
+        return {index['name'] for index in inspect(db.engine).get_indexes(table)}
+
+def test_upgrade_adds_missing_columns_and_indexes(legacy_app):
+    upgrade_schema(legacy_app)
+
+    schema = _schema(legacy_app)
+    for table in (RSAKey.__table__, UploadedFile.__table__):
+        assert set(schema[table.name]) == {column.name for column in table.columns}
+    assert schema['uploaded_files']['encrypted_data'][1]
+    assert not schema['uploaded_files']['aes_key'][1]
+    assert {'ix_rsa_keys_available', 'ix_rsa_keys_fingerprint'} <= _indexes(legacy_app, 'rsa_keys')
+    assert {'ix_uploaded_files_created_at_id', 'ix_uploaded_files_key_id'} <= _indexes(legacy_app, 'uploaded_files')
+
+def test_upgrade_keeps_existing_rows(legacy_app):
+    upgrade_schema(legacy_app)
+
+    with legacy_app.app_context():
+        keys = [(key.id, key.public_key, key.is_used, key.lease_owner, key.leased_at)
+                for key in RSAKey.query.order_by(RSAKey.id)]
+        assert keys == [(1, 'key-1', True, None, None), (2, 'key-2', False, None, None)]
+        stored = UploadedFile.query.one()
+        assert (stored.filename, stored.encrypted_data, stored.aes_key, stored.key_id, stored.created_at) == \
+               ('old.pdf', b'inline payload', b'wrapped key', 1, UPLOADED_AT)
+        assert stored.blob_ref is None and stored.cipher_mode is None and stored.submission_id is None
+
+def test_upgraded_tables_accept_current_rows(legacy_app):
+    upgrade_schema(legacy_app)
+
+    with legacy_app.app_context():
+        db.session.add(UploadedFile(filename='new.pdf', encrypted_data=None, aes_key=b'wrapped key', key_id=2,
+                                    blob_ref='ab/cdef', blob_size=10, blob_digest='0' * 64, cipher_mode=1))
+        db.session.commit()
+        assert UploadedFile.query.filter(UploadedFile.encrypted_data.is_(None)).count() == 1
+
+def test_upgrade_is_idempotent(legacy_app):
+    upgrade_schema(legacy_app)
+    schema = _schema(legacy_app)
+
+    upgrade_schema(legacy_app)
+
+    assert _schema(legacy_app) == schema
+    with legacy_app.app_context():
+        assert RSAKey.query.count() == 2 and UploadedFile.query.count() == 1
+
+def test_upgrade_leaves_current_schema_alone(app):
+    schema = _schema(app)
+
+    upgrade_schema(app)
+
+    assert _schema(app) == schema
@@ -0,0 +1,97 @@
+"""Decompression of payloads compressed before encryption, bounded on the journalist side."""
+import io
+import os
+import zlib
+
+import pytest
+
+from journalist import crypto as journalist_crypto
+from server.crypto import COMPRESSION_ZLIB, MODE_AES_CBC, MODE_AES_GCM_STREAM, encrypt_file, encrypt_stream, generate_aes_key
+
+PLAINTEXT = os.urandom(1000) + b'a' * 300000
+# Compresses to more than SEGMENTS_PER_TASK segments of SEGMENT_SIZE, so decrypt_to_path goes parallel
+STREAM_PLAINTEXT = os.urandom(40 * 1024) + bytes(4 * 1024 ** 2)
+SEGMENT_SIZE = 1024
+
+@pytest.fixture
+def envelope():
+    aes_key = generate_aes_key()
+    return encrypt_file(PLAINTEXT, aes_key, compression=COMPRESSION_ZLIB), aes_key
+
+def test_decrypt_file_inflates_compressed_payload(envelope):
+    data, aes_key = envelope
+
+    assert journalist_crypto.decrypt_file(data, aes_key) == PLAINTEXT
+
+def test_decrypt_file_stops_at_size_limit(envelope, monkeypatch):
+    data, aes_key = envelope
+    monkeypatch.setattr(journalist_crypto, 'MAX_DECOMPRESSED_SIZE', len(PLAINTEXT) - 1)
+
+    assert journalist_crypto.decrypt_file(data, aes_key) is None
+
+def test_inflater_output_is_bounded():
+    # About 64 KiB that inflate to 64 MiB
+    bomb = zlib.compress(bytes(64 * 1024 ** 2), 9)
+    out = io.BytesIO()
+    inflater = journalist_crypto._Inflater(out, limit=1024 ** 2)
+
+    with pytest.raises(ValueError):
+        inflater.write(bomb)
+    assert out.tell() <= 1024 ** 2
+
+@pytest.fixture(params=[MODE_AES_CBC, MODE_AES_GCM_STREAM])
+def encrypted_path(request, tmp_path):
+    aes_key = generate_aes_key()
+    path = tmp_path / 'payload'
+    with open(path, 'wb') as destination:
+        encrypt_stream(io.BytesIO(STREAM_PLAINTEXT), destination, aes_key, chunk_size=SEGMENT_SIZE,
+                       mode=request.param, compression=COMPRESSION_ZLIB)
+    return path, aes_key
+
+def test_decrypt_stream_inflates_compressed_payload(encrypted_path):
+    path, aes_key = encrypted_path
+    out = io.BytesIO()
+
+    with open(path, 'rb') as source:
+        assert journalist_crypto.decrypt_stream(source, out, aes_key) == len(STREAM_PLAINTEXT)
+    assert out.getvalue() == STREAM_PLAINTEXT
+
+@pytest.mark.parametrize('limit_by', ['default', 'argument'])
+def test_decrypt_stream_stops_at_size_limit(encrypted_path, limit_by, monkeypatch):
+    path, aes_key = encrypted_path
+    limit = len(STREAM_PLAINTEXT) // 2
+    kwargs = {'max_size': limit} if limit_by == 'argument' else {}
+    if limit_by == 'default':
+        monkeypatch.setattr(journalist_crypto, 'MAX_DECOMPRESSED_SIZE', limit)
+    out = io.BytesIO()
+
+    with open(path, 'rb') as source, pytest.raises(ValueError, match='exceeds'):
+        journalist_crypto.decrypt_stream(source, out, aes_key, **kwargs)
+    assert out.tell() <= limit
+
+def test_parallel_decrypt_stops_at_size_limit(tmp_path, monkeypatch):
+    aes_key = generate_aes_key()
+    path = tmp_path / 'payload'
+    with open(path, 'wb') as destination:
+        encrypt_stream(io.BytesIO(STREAM_PLAINTEXT), destination, aes_key, chunk_size=SEGMENT_SIZE,
+                       mode=MODE_AES_GCM_STREAM, compression=COMPRESSION_ZLIB)
+    header, _ = journalist_crypto.parse_envelope(path.read_bytes())
+    monkeypatch.setattr(journalist_crypto, 'MAX_DECOMPRESSED_SIZE', len(STREAM_PLAINTEXT) // 2)
+    out = io.BytesIO()
+
+    with pytest.raises(ValueError, match='exceeds'):
+        journalist_crypto._decrypt_segments_parallel(str(path), out, aes_key, header, workers=4)
+    assert out.tell() <= len(STREAM_PLAINTEXT) // 2
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_decrypt_to_path_respects_size_limit(encrypted_path, workers, tmp_path):
+    path, aes_key = encrypted_path
+    output = tmp_path / 'plain'
+
+    assert journalist_crypto.decrypt_to_path(str(path), str(output), aes_key, workers=workers)
+    assert output.read_bytes() == STREAM_PLAINTEXT
+
+    output.unlink()
+    assert not journalist_crypto.decrypt_to_path(str(path), str(output), aes_key, workers=workers,
+                                                 max_size=len(STREAM_PLAINTEXT) - 1)
+    assert sorted(entry.name for entry in tmp_path.iterdir()) == ['payload']
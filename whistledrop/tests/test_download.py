@@ -0,0 +1,193 @@
+"""/download: ranges, metadata headers and conditional requests; the client's resumable download."""
+import base64
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+import pytest
+from werkzeug.serving import make_server
+
+from journalist.client import JournalistClient
+from server.crypto import MODE_AES_GCM_STREAM, encrypt_file, generate_aes_key
+from server.models import db, UploadedFile
+from server.storage import get_blob_store
+
+CREATED_AT = datetime(2025, 3, 4, 5, 6, 7)
+FILENAME = 'Bericht März 2025.pdf'
+
+@pytest.fixture
+def stored(app, add_keys):
+    """A file in the blob store; returns (row id, payload)."""
+    key_id = add_keys(1)[0]
+    payload = encrypt_file(os.urandom(200 * 1024), generate_aes_key(), key_id=key_id, mode=MODE_AES_GCM_STREAM)
+    with app.app_context():
+        with get_blob_store().writer() as writer:
+            writer.write(payload)
+            info = writer.commit()
+        file = UploadedFile(FILENAME, None, b'wrapped key', key_id, created_at=CREATED_AT, blob_ref=info.ref,
+                            blob_size=info.size, blob_digest=info.digest, cipher_mode=MODE_AES_GCM_STREAM)
+        db.session.add(file)
+        db.session.commit()
+        return file.id, payload
+
+def test_download_sends_payload_and_metadata(app, stored):
+    file_id, payload = stored
+
+    response = app.test_client().get(f'/download/{file_id}')
+
+    assert response.status_code == 200
+    assert response.get_data() == payload
+    with app.app_context():
+        key_id = UploadedFile.query.get(file_id).key_id
+    assert response.headers['X-WhistleDrop-File-Id'] == str(file_id)
+    assert response.headers['X-WhistleDrop-Key-Id'] == str(key_id)
+    assert response.headers['X-WhistleDrop-Filename'] == 'Bericht%20M%C3%A4rz%202025.pdf'
+    assert response.headers['X-WhistleDrop-Created-At'] == CREATED_AT.isoformat()
+    assert base64.b64decode(response.headers['X-WhistleDrop-Wrapped-Key']) == b'wrapped key'
+    assert response.headers['X-WhistleDrop-Digest'] == hashlib.sha256(payload).hexdigest()
+    assert response.headers['X-WhistleDrop-Format'] == 'envelope'
+    assert response.headers['X-WhistleDrop-Cipher-Mode'] == str(MODE_AES_GCM_STREAM)
+    assert response.headers['X-WhistleDrop-Submission-Id'] == ''
+
+@pytest.mark.parametrize('byte_range, start, end', [
+    ('bytes=1000-', 1000, None),
+    ('bytes=0-9', 0, 10),
+    ('bytes=-16', -16, None)
+])
+def test_range_request_is_partial(app, stored, byte_range, start, end):
+    file_id, payload = stored
+
+    response = app.test_client().get(f'/download/{file_id}', headers={'Range': byte_range})
+
+    expected = payload[start:end]
+    assert response.status_code == 206
+    assert response.get_data() == expected
+    first = start % len(payload)
+    assert response.headers['Content-Range'] == f'bytes {first}-{first + len(expected) - 1}/{len(payload)}'
+    assert response.headers['X-WhistleDrop-Digest'] == hashlib.sha256(payload).hexdigest()
+
+def test_range_beyond_end_is_not_satisfiable(app, stored):
+    file_id, payload = stored
+
+    response = app.test_client().get(f'/download/{file_id}', headers={'Range': f'bytes={len(payload)}-'})
+
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(payload)}'
+
+def test_head_sends_metadata_without_payload(app, stored):
+    file_id, payload = stored
+
+    response = app.test_client().head(f'/download/{file_id}')
+
+    assert response.status_code == 200
+    assert response.get_data() == b''
+    assert response.headers['Content-Length'] == str(len(payload))
+    assert response.headers['X-WhistleDrop-Digest'] == hashlib.sha256(payload).hexdigest()
+    assert response.headers['X-WhistleDrop-Filename'] == 'Bericht%20M%C3%A4rz%202025.pdf'
+
+def test_matching_etag_is_not_modified(app, stored):
+    file_id, payload = stored
+
+    response = app.test_client().get(f'/download/{file_id}',
+                                     headers={'If-None-Match': f'"{hashlib.sha256(payload).hexdigest()}"'})
+
+    assert response.status_code == 304
+    assert response.get_data() == b''
+
+def test_inline_legacy_row(app, add_keys):
+    key_id = add_keys(1)[0]
+    payload = json.dumps({'iv': 'AAAA', 'ciphertext': 'AAAA'}).encode('utf-8')
+    with app.app_context():
+        file = UploadedFile('old.txt', payload, b'wrapped key', key_id, created_at=CREATED_AT)
+        db.session.add(file)
+        db.session.commit()
+        file_id = file.id
+
+    response = app.test_client().get(f'/download/{file_id}', headers={'Range': 'bytes=2-'})
+
+    assert response.status_code == 206
+    assert response.get_data() == payload[2:]
+    assert response.headers['X-WhistleDrop-Format'] == 'json'
+    assert response.headers['X-WhistleDrop-Digest'] == hashlib.sha256(payload).hexdigest()
+
+def test_unknown_file_is_not_found(app):
+    assert app.test_client().get('/download/12345').status_code == 404
+
+@pytest.fixture
+def client(app):
+    """A journalist client talking to the app over HTTP; records the Range header of every GET."""
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = JournalistClient(f'http://127.0.0.1:{server.server_port}')
+    client.ranges = []
+    get = client.session.get
+
+    def recording_get(url, headers=None, **kwargs):
+        client.ranges.append((headers or {}).get('Range'))
+        return get(url, headers=headers, **kwargs)
+
+    client.session.get = recording_get
+    yield client
+    client.session.close()
+    server.shutdown()
+    thread.join()
+
+def test_client_downloads_and_checks_digest(client, stored, tmp_path):
+    file_id, payload = stored
+    path = tmp_path / 'payload.download'
+
+    metadata = client.download_file(file_id, str(path), chunk_size=4096)
+
+    assert path.read_bytes() == payload
+    assert client.ranges == [None]
+    assert metadata['id'] == file_id
+    assert metadata['filename'] == FILENAME
+    assert metadata['wrapped_key'] == b'wrapped key'
+    assert metadata['digest'] == hashlib.sha256(payload).hexdigest()
+
+def test_client_resumes_partial_download(client, stored, tmp_path):
+    file_id, payload = stored
+    path = tmp_path / 'payload.download'
+    path.write_bytes(payload[:5000])
+
+    client.download_file(file_id, str(path))
+
+    assert path.read_bytes() == payload
+    assert client.ranges == ['bytes=5000-']
+
+def test_client_accepts_complete_partial_download(client, stored, tmp_path):
+    file_id, payload = stored
+    path = tmp_path / 'payload.download'
+    path.write_bytes(payload)
+
+    # The server answers 416; the metadata then comes from a HEAD request
+    metadata = client.download_file(file_id, str(path))
+
+    assert path.read_bytes() == payload
+    assert client.ranges == [f'bytes={len(payload)}-']
+    assert metadata['filename'] == FILENAME
+
+def test_client_restarts_when_resumed_download_is_corrupt(client, stored, tmp_path):
+    file_id, payload = stored
+    path = tmp_path / 'payload.download'
+    path.write_bytes(b'x' * 5000)
+
+    client.download_file(file_id, str(path))
+
+    assert path.read_bytes() == payload
+    assert client.ranges == ['bytes=5000-', None]
+
+def test_client_gives_up_on_persistent_digest_mismatch(client, stored, app, tmp_path):
+    file_id, _ = stored
+    with app.app_context():
+        UploadedFile.query.get(file_id).blob_digest = '0' * 64
+        db.session.commit()
+    path = tmp_path / 'payload.download'
+
+    with pytest.raises(RuntimeError, match='Digest mismatch'):
+        client.download_file(file_id, str(path))
+    assert not path.exists()
+    assert client.ranges == [None, None]
@@ -0,0 +1,102 @@
+"""The WDRP envelope header, as the server writes it and both sides read it."""
+import base64
+import io
+import json
+
+import pytest
+
+from journalist import crypto as journalist_crypto
+from server.crypto import (
+    ENVELOPE_HEADER, ENVELOPE_MAGIC, ENVELOPE_VERSION, MODE_AES_CBC, MODE_AES_GCM_STREAM, COMPRESSION_NONE,
+    COMPRESSION_ZLIB, STREAM_PARAMS, build_envelope_header, parse_envelope_header, is_legacy_blob,
+    legacy_blob_to_envelope, encrypt_file, decrypt_file
+)
+
+AES_KEY = bytes(range(32))
+
+@pytest.mark.parametrize('mode, compression, iv, key_id', [
+    (MODE_AES_CBC, COMPRESSION_NONE, bytes(range(16)), 1),
+    (MODE_AES_CBC, COMPRESSION_ZLIB, bytes(range(16)), 2 ** 32 - 1),
+    (MODE_AES_GCM_STREAM, COMPRESSION_NONE, STREAM_PARAMS.pack(b'prefix7', 65536), 42),
+    (MODE_AES_GCM_STREAM, COMPRESSION_ZLIB, STREAM_PARAMS.pack(b'\x00' * 7, 1), 0)
+])
+def test_header_round_trip(mode, compression, iv, key_id):
+    data = build_envelope_header(iv, key_id, mode=mode, compression=compression) + b'ciphertext'
+
+    assert data[:4] == ENVELOPE_MAGIC
+    assert len(data) == ENVELOPE_HEADER.size + len(iv) + len(b'ciphertext')
+    expected = {'version': ENVELOPE_VERSION, 'mode': mode, 'compression': compression, 'key_id': key_id, 'iv': iv,
+                'header_size': ENVELOPE_HEADER.size + len(iv)}
+    assert parse_envelope_header(data) == expected
+
+    header, ciphertext = journalist_crypto.parse_envelope(data)
+    assert ciphertext == b'ciphertext'
+    assert header['raw'] == data[:expected['header_size']]
+    assert {field: header[field] for field in expected} == expected
+    if mode == MODE_AES_GCM_STREAM:
+        assert (header['nonce_prefix'], header['segment_size']) == STREAM_PARAMS.unpack(iv)
+
+def test_missing_key_id_is_zero():
+    assert parse_envelope_header(build_envelope_header(b'', None))['key_id'] == 0
+
+def test_legacy_blob_detection():
+    legacy = json.dumps({'iv': 'AAAA', 'ciphertext': 'AAAA'})
+
+    assert is_legacy_blob(legacy)
+    assert is_legacy_blob(legacy.encode('utf-8'))
+    assert is_legacy_blob(memoryview(legacy.encode('utf-8')))
+    assert not is_legacy_blob(encrypt_file(b'data', AES_KEY))
+    assert not is_legacy_blob(legacy_blob_to_envelope(legacy, 3))
+    assert not is_legacy_blob(b'')
+
+def test_legacy_blob_to_envelope_keeps_ciphertext():
+    envelope = encrypt_file(b'legacy data', AES_KEY)
+    header = parse_envelope_header(envelope)
+    legacy = json.dumps({'iv': base64.b64encode(header['iv']).decode('ascii'),
+                         'ciphertext': base64.b64encode(envelope[header['header_size']:]).decode('ascii')})
+
+    converted = legacy_blob_to_envelope(legacy, 5)
+
+    assert parse_envelope_header(converted)['key_id'] == 5
+    assert decrypt_file(converted, AES_KEY) == decrypt_file(legacy, AES_KEY) == b'legacy data'
+
+def _header(magic=ENVELOPE_MAGIC, version=ENVELOPE_VERSION, mode=MODE_AES_CBC, compression=COMPRESSION_NONE,
+            iv_length=16, key_id=1):
+    return ENVELOPE_HEADER.pack(magic, version, mode, compression, iv_length, key_id)
+
+MALFORMED = [
+    pytest.param(b'', 'too short', id='empty'),
+    pytest.param(_header()[:-1], 'too short', id='too-short'),
+    pytest.param(_header(magic=b'WDRQ') + bytes(16), 'Not a WhistleDrop envelope', id='bad-magic'),
+    pytest.param(_header(version=2) + bytes(16), 'Unsupported envelope version 2', id='unknown-version'),
+    pytest.param(_header(version=0) + bytes(16), 'Unsupported envelope version 0', id='version-zero'),
+    pytest.param(_header() + bytes(15), 'Truncated envelope header', id='truncated-iv')
+]
+
+@pytest.mark.parametrize('data, message', MALFORMED)
+def test_malformed_header_is_rejected(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_envelope_header(data)
+    with pytest.raises(ValueError, match=message):
+        journalist_crypto.parse_envelope(data)
+
+@pytest.mark.parametrize('iv_length', [0, STREAM_PARAMS.size - 1, STREAM_PARAMS.size + 1])
+def test_stream_header_with_wrong_parameter_size_is_rejected(iv_length):
+    data = _header(mode=MODE_AES_GCM_STREAM, iv_length=iv_length) + bytes(iv_length)
+
+    with pytest.raises(ValueError, match='Invalid stream parameters'):
+        journalist_crypto.parse_envelope(data)
+
+@pytest.mark.parametrize('settings, message', [
+    ({'mode': 3}, 'Unsupported cipher mode'),
+    ({'mode': 0}, 'Unsupported cipher mode'),
+    ({'compression': 2}, 'Unsupported compression')
+])
+def test_unknown_mode_or_compression_is_rejected(settings, message):
+    data = _header(**settings) + bytes(16) + bytes(32)
+
+    with pytest.raises(ValueError, match=message):
+        decrypt_file(data, AES_KEY)
+    assert journalist_crypto.decrypt_file(data, AES_KEY) is None
+    with pytest.raises(ValueError, match=message):
+        journalist_crypto.decrypt_stream(io.BytesIO(data), io.BytesIO(), AES_KEY)
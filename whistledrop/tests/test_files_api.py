@@ -0,0 +1,109 @@
+"""/files: cursor pagination, the unpaginated response of older clients and conditional requests."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from server.models import db, UploadedFile
+
+START = datetime(2025, 1, 2, 3, 4, 5)
+
+@pytest.fixture
+def files(app, add_keys):
+    """Seven file rows, oldest first; some share a timestamp so the id breaks the tie."""
+    key_id = add_keys(1)[0]
+    created = [START, START, START + timedelta(seconds=1), START + timedelta(seconds=2), START + timedelta(seconds=2),
+               START + timedelta(seconds=2), START + timedelta(seconds=3)]
+    with app.app_context():
+        db.session.execute(UploadedFile.__table__.insert(), [
+            {'filename': f'file-{i}.txt', 'aes_key': b'wrapped key', 'key_id': key_id, 'created_at': created_at}
+            for i, created_at in enumerate(created)])
+        db.session.commit()
+        return [file_id for file_id, in db.session.query(UploadedFile.id).order_by(UploadedFile.created_at,
+                                                                                  UploadedFile.id)]
+
+def _pages(client, **params):
+    pages = []
+    while True:
+        response = client.get('/files', query_string=params)
+        assert response.status_code == 200
+        pages.append(response.json)
+        if not response.json['next']:
+            return pages
+        params['after'] = response.json['next']
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 7, 50])
+def test_pages_cover_every_file_once(app, files, limit):
+    pages = _pages(app.test_client(), limit=limit)
+
+    assert [file['id'] for page in pages for file in page['files']] == files
+    assert all(page['count'] == len(page['files']) <= limit for page in pages)
+    assert len(pages) == max(1, -(-len(files) // limit))
+
+def test_paginated_response_has_no_total(app, files):
+    page = app.test_client().get('/files', query_string={'limit': 2}).json
+
+    assert page['count'] == 2
+    assert 'total' not in page
+
+def test_unpaginated_response_keeps_total(app, files):
+    page = app.test_client().get('/files').json
+
+    assert [file['id'] for file in page['files']] == files
+    assert page['total'] == page['count'] == len(files)
+    assert page['next'] is None
+
+def test_page_size_is_capped(make_app, files, app):
+    capped = make_app(FILES_MAX_PAGE_SIZE=3)
+
+    assert capped.test_client().get('/files', query_string={'limit': 1000}).json['count'] == 3
+    assert app.test_client().get('/files', query_string={'limit': 0}).json['count'] == 1
+
+def test_since_filters_and_paginates(app, files):
+    since = (START + timedelta(seconds=2)).isoformat()
+
+    pages = _pages(app.test_client(), limit=2, since=since)
+
+    assert [file['id'] for page in pages for file in page['files']] == files[3:]
+
+@pytest.mark.parametrize('params', [
+    {'after': 'not a cursor'},
+    {'after': '!!!'},
+    {'after': 'bm8tc2VwYXJhdG9y'},  # base64 of 'no-separator'
+    {'after': 'eHx5'},  # base64 of 'x|y'
+    {'after': 'dG9kYXl8MQ=='},  # base64 of 'today|1'
+    {'after': 'w6k='},
+    {'after': 'é'},
+    {'since': 'yesterday'}
+])
+def test_bad_cursor_or_since_is_rejected(app, files, params):
+    response = app.test_client().get('/files', query_string=params)
+
+    assert response.status_code == 400
+    assert response.json == {'error': 'Invalid since or after parameter'}
+
+def test_unchanged_page_is_not_modified(app, files):
+    client = app.test_client()
+    first = client.get('/files', query_string={'limit': 3})
+    etag = first.headers['ETag']
+
+    assert etag.startswith('W/')
+    again = client.get('/files', query_string={'limit': 3}, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    # Another page is another representation
+    other = client.get('/files', query_string={'limit': 3, 'after': first.json['next']},
+                       headers={'If-None-Match': etag})
+    assert other.status_code == 200
+
+def test_new_upload_changes_the_etag(app, files):
+    client = app.test_client()
+    etag = client.get('/files').headers['ETag']
+    with app.app_context():
+        key_id = db.session.query(UploadedFile.key_id).first()[0]
+        db.session.add(UploadedFile('new.txt', None, b'wrapped key', key_id, created_at=START + timedelta(seconds=9)))
+        db.session.commit()
+
+    response = client.get('/files', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.json['files'][-1]['filename'] == 'new.txt'
@@ -0,0 +1,96 @@
+"""Importing journalists' public keys from JSON and PEM key files."""
+import json
+
+import pytest
+from Crypto.PublicKey import RSA
+
+from server import keyimport
+from server.keyimport import ImportResult, import_keys, public_key_fingerprint, validate_public_key
+from server.models import db, RSAKey
+
+@pytest.fixture(scope='module')
+def rsa_keys():
+    """Three small RSA key pairs (the import never looks at the key size)."""
+    return [RSA.generate(1024) for _ in range(3)]
+
+@pytest.fixture
+def public_pems(rsa_keys):
+    return [key.publickey().export_key().decode('utf-8') for key in rsa_keys]
+
+def _stored(app):
+    with app.app_context():
+        return {fingerprint: public_key for fingerprint, public_key in db.session.query(RSAKey.fingerprint,
+                                                                                        RSAKey.public_key)}
+
+@pytest.mark.parametrize('data', [None, 42, 4.2, True, ['nested'], {'pem': 'x'}, '', 'not a key',
+                                  '-----BEGIN PUBLIC KEY-----\nAAAA\n-----END PUBLIC KEY-----'])
+def test_invalid_entries_are_rejected(data):
+    assert validate_public_key(data) is None
+
+def test_private_key_is_rejected(rsa_keys):
+    assert validate_public_key(rsa_keys[0].export_key().decode('utf-8')) is None
+
+def test_fingerprint_ignores_pem_formatting(rsa_keys, public_pems):
+    pkcs1 = rsa_keys[0].publickey().export_key(pkcs=1).decode('utf-8')
+    indented = '\n  ' + public_pems[0].replace('\n', '\r\n') + '\n\n'
+
+    expected = public_key_fingerprint(rsa_keys[0].publickey())
+    assert validate_public_key(pkcs1) == validate_public_key(indented) == (public_pems[0], expected)
+    assert validate_public_key(public_pems[0].encode('ascii'))[1] == expected
+
+@pytest.mark.parametrize('wrap', [lambda keys: keys, lambda keys: {'public_keys': keys}], ids=['array', 'object'])
+@pytest.mark.parametrize('read_size', [keyimport.READ_SIZE, 7])
+def test_json_key_file(app, rsa_keys, public_pems, tmp_path, monkeypatch, wrap, read_size):
+    monkeypatch.setattr(keyimport, 'READ_SIZE', read_size)
+    entries = [public_pems[0], 42, public_pems[1], None, {'pem': public_pems[2]}, 'garbage',
+               rsa_keys[2].publickey().export_key(pkcs=1).decode('utf-8'), public_pems[0],
+               rsa_keys[1].export_key().decode('utf-8')]
+    path = tmp_path / 'keys.json'
+    path.write_text(json.dumps(wrap(entries), indent=2))
+
+    result = import_keys(app, str(path), batch_size=2, workers=1)
+
+    assert result == ImportResult(imported=3, duplicates=1, invalid=5)
+    assert _stored(app) == {public_key_fingerprint(pem): pem for pem in public_pems}
+
+def test_pem_bundle(app, rsa_keys, public_pems, tmp_path, monkeypatch):
+    monkeypatch.setattr(keyimport, 'READ_SIZE', 13)
+    path = tmp_path / 'keys.pem'
+    path.write_text('\n'.join([
+        '# Journalist keys',
+        public_pems[0],
+        'some text between blocks',
+        rsa_keys[1].publickey().export_key(pkcs=1).decode('utf-8'),
+        '-----BEGIN PUBLIC KEY-----\nbroken\n-----END PUBLIC KEY-----',
+        public_pems[0].replace('\n', '\r\n'),
+        public_pems[2]]))  # no newline at the end
+
+    result = import_keys(app, str(path), workers=1)
+
+    assert result == ImportResult(imported=3, duplicates=1, invalid=1)
+    assert _stored(app) == {public_key_fingerprint(pem): pem for pem in public_pems}
+
+def test_reimport_only_counts_duplicates(app, public_pems, tmp_path):
+    path = tmp_path / 'keys.json'
+    path.write_text(json.dumps(public_pems))
+    import_keys(app, str(path), workers=1)
+
+    assert import_keys(app, str(path), batch_size=1, workers=1) == ImportResult(imported=0, duplicates=3, invalid=0)
+    assert len(_stored(app)) == 3
+
+def test_parallel_validation(app, public_pems, tmp_path, monkeypatch):
+    monkeypatch.setattr(keyimport, 'PARALLEL_THRESHOLD', 1)
+    path = tmp_path / 'keys.json'
+    path.write_text(json.dumps(public_pems + [7, public_pems[1]]))
+
+    result = import_keys(app, str(path), workers=2)
+
+    assert result == ImportResult(imported=3, duplicates=1, invalid=1)
+
+@pytest.mark.parametrize('content', ['{"keys": []}', '["-----BEGIN PUBLIC KEY-----", '], ids=['no-list', 'truncated'])
+def test_malformed_json_key_file(app, tmp_path, content):
+    path = tmp_path / 'keys.json'
+    path.write_text(content)
+
+    with pytest.raises(ValueError):
+        import_keys(app, str(path), workers=1)
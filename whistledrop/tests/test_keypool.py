@@ -0,0 +1,204 @@
+"""Concurrency and lease tests for the one-time RSA key pool (server/keypool.py)."""
+import io
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from server import keypool, routes
+from server.models import db, RSAKey, UploadedFile
+
+CLAIMERS = 8  # concurrent threads or processes per test
+KEY_COUNT = 200
+
+def _claim_all(app, claim, start=None):
+    """Claim keys until the pool is empty; returns the claimed ids."""
+    ids = []
+    if start is not None:
+        start.wait()
+    with app.app_context():
+        try:
+            while True:
+                key = claim()
+                if key is None:
+                    return ids
+                ids.append(key.id)
+        finally:
+            db.session.remove()
+
+def _claim_in_threads(app, claim, threads=CLAIMERS):
+    """Run _claim_all in several threads started at the same moment; returns all claimed ids."""
+    start = threading.Barrier(threads)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = [pool.submit(_claim_all, app, claim, start) for _ in range(threads)]
+        return [key_id for result in results for key_id in result.result()]
+
+def _available_ids(app):
+    with app.app_context():
+        return [key_id for key_id, in db.session.query(RSAKey.id).filter(RSAKey.is_used == False).order_by(RSAKey.id)]
+
+def _leased(app):
+    with app.app_context():
+        return db.session.query(RSAKey).filter(RSAKey.lease_owner.isnot(None)).count()
+
+@pytest.fixture(params=['returning', 'compare-and-set'])
+def claim_path(request, monkeypatch):
+    """Run a test on the UPDATE ... RETURNING path and on the fallback for SQLite < 3.35."""
+    if request.param == 'compare-and-set':
+        monkeypatch.setattr(keypool, '_supports_returning', lambda: False)
+    return request.param
+
+def test_concurrent_claims_never_share_a_key(app, add_keys, claim_path):
+    key_ids = add_keys(KEY_COUNT)
+
+    claimed = _claim_in_threads(app, keypool.claim_key)
+
+    assert sorted(claimed) == key_ids
+    assert _available_ids(app) == []
+
+def test_concurrent_claims_across_processes(app, make_app, add_keys, claim_path):
+    key_ids = add_keys(KEY_COUNT)
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    start = context.Barrier(CLAIMERS)
+
+    def worker():
+        # A fresh app per process, like a forked gunicorn worker building its own engine
+        results.put(_claim_all(make_app(), keypool.claim_key, start))
+
+    processes = [context.Process(target=worker) for _ in range(CLAIMERS)]
+    for process in processes:
+        process.start()
+    claimed = [key_id for _ in processes for key_id in results.get(timeout=60)]
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    assert sorted(claimed) == key_ids
+
+def test_leasing_workers_and_leased_key_stealing(app, make_app, add_keys, claim_path):
+    key_ids = add_keys(KEY_COUNT)
+    pools = [make_app(KEY_LEASE_SIZE=7).extensions['key_pool'] for _ in range(3)]
+
+    # Leasing workers, each with its own block, race claimers that may take leased keys
+    start = threading.Barrier(len(pools) + 2)
+    with ThreadPoolExecutor(max_workers=len(pools) + 2) as executor:
+        results = [executor.submit(_claim_all, pool.app, pool.claim, start) for pool in pools]
+        results += [executor.submit(_claim_all, app, lambda: keypool.claim_key(include_leased=True), start)
+                    for _ in range(2)]
+        claimed = [key_id for result in results for key_id in result.result()]
+
+    assert sorted(claimed) == key_ids
+
+def test_release_returns_key_to_pool(app, add_keys):
+    key_ids = add_keys(3)
+    with app.app_context():
+        key = keypool.claim_key()
+        keypool.release_key(key.id)
+
+    assert _available_ids(app) == key_ids
+    assert sorted(_claim_in_threads(app, keypool.claim_key, threads=2)) == key_ids
+
+def test_failed_upload_releases_its_key(app, add_keys, monkeypatch):
+    key_ids = add_keys(2)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("wrap failed")
+    monkeypatch.setattr(routes, '_wrap_keys', fail)
+
+    response = app.test_client().post('/upload_file', data={
+        'file': [(io.BytesIO(b'first'), 'a.txt'), (io.BytesIO(b'second'), 'b.txt')]
+    })
+
+    assert response.status_code == 302
+    assert _available_ids(app) == key_ids
+    with app.app_context():
+        assert UploadedFile.query.count() == 0
+
+def _lease_age(app, owner, age):
+    with app.app_context():
+        db.session.execute(text("UPDATE rsa_keys SET leased_at = :at WHERE lease_owner = :owner"),
+                           {'at': datetime.now() - timedelta(seconds=age), 'owner': owner})
+        db.session.commit()
+
+def test_expire_leases_returns_stale_leases_only(app, add_keys):
+    add_keys(10)
+    with app.app_context():
+        dead = keypool.lease_keys('dead-worker', 4)
+        alive = keypool.lease_keys('live-worker', 4)
+    _lease_age(app, 'dead-worker', 3600)
+
+    with app.app_context():
+        assert keypool.expire_leases(600) == 4
+        # The dead owner can no longer claim its former keys, the live one still can
+        assert not keypool.claim_leased_key(dead[0].id, 'dead-worker')
+        assert keypool.claim_leased_key(alive[0].id, 'live-worker')
+
+    assert _available_ids(app)[:4] == [key.id for key in dead]
+
+def test_expire_leases_covers_leases_without_timestamp(app, add_keys):
+    add_keys(3)
+    with app.app_context():
+        # Leases taken before leased_at existed have no timestamp
+        db.session.execute(text("UPDATE rsa_keys SET lease_owner = 'old-worker'"))
+        db.session.commit()
+        assert keypool.expire_leases(600) == 3
+        assert keypool.claim_key() is not None
+
+def test_renewal_keeps_leases_of_a_live_worker(app, make_app, add_keys):
+    add_keys(10)
+    pool = make_app(KEY_LEASE_SIZE=5, KEY_LEASE_TTL=600).extensions['key_pool']
+    with pool.app.app_context():
+        assert pool.claim() is not None
+    _lease_age(app, pool.owner, 3600)
+
+    # Half a TTL after the last renewal, the next claim renews the remaining leases
+    pool._renewed -= 300
+    with pool.app.app_context():
+        assert pool.claim() is not None
+        assert keypool.expire_leases(600) == 0
+        assert db.session.query(RSAKey).filter(RSAKey.lease_owner == pool.owner).count() == 3
+
+@pytest.mark.parametrize('settings', [
+    {},
+    {'KEY_LEASE_SIZE': 0, 'KEY_PREPARE_QUEUE_SIZE': 0},
+    {'KEY_LEASE_SIZE': 5, 'KEY_LEASE_TTL': 0}
+])
+def test_no_lease_expiry_without_leasing(make_app, settings):
+    assert keypool.start_lease_expiry(make_app(**settings)) is None
+
+@pytest.mark.parametrize('settings', [{'KEY_LEASE_SIZE': 5}, {'KEY_PREPARE_QUEUE_SIZE': 5}])
+def test_lease_expirer_returns_stale_leases(app, make_app, add_keys, settings):
+    add_keys(6)
+    with app.app_context():
+        keypool.lease_keys('dead-worker', 4)
+    _lease_age(app, 'dead-worker', 3600)
+
+    expirer = keypool.start_lease_expiry(make_app(KEY_LEASE_TTL=0.1, **settings))
+    try:
+        deadline = time.monotonic() + 10
+        while _leased(app) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        expirer.stop()
+    assert _leased(app) == 0
+
+class _StopLoop(BaseException):
+    pass
+
+def test_workers_do_not_expire_leases(make_app, monkeypatch):
+    stats = make_app(KEY_LEASE_SIZE=5, KEY_LEASE_TTL=600).extensions['key_pool'].stats
+    expired = []
+    monkeypatch.setattr(keypool, 'expire_leases', expired.append)
+
+    def reconcile():
+        raise _StopLoop()
+
+    monkeypatch.setattr(stats, 'reconcile', reconcile)
+    with pytest.raises(_StopLoop):
+        stats._reconcile_loop()
+    assert expired == []
@@ -0,0 +1,54 @@
+"""manage.py maintenance commands on databases left by older versions."""
+import base64
+import json
+from types import SimpleNamespace
+
+import pytest
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+import manage
+from journalist.crypto import decrypt_file
+from server.crypto import ENVELOPE_MAGIC
+from server.models import db, UploadedFile
+
+from conftest import legacy, UPLOADED_AT
+
+@pytest.fixture
+def command_app(legacy_app, monkeypatch):
+    """Run manage.py commands against the legacy test database."""
+    monkeypatch.setattr(manage, '_app', legacy_app)
+    return legacy_app
+
+def _legacy_json_payload(plaintext, aes_key):
+    """A payload as the first release stored it: base64 IV and ciphertext in a JSON document."""
+    cipher = AES.new(aes_key, AES.MODE_CBC)
+    return json.dumps({
+        'iv': base64.b64encode(cipher.iv).decode('utf-8'),
+        'ciphertext': base64.b64encode(cipher.encrypt(pad(plaintext, AES.block_size))).decode('utf-8')
+    }).encode('utf-8')
+
+def test_migrate_envelopes_on_first_release_database(command_app):
+    aes_key = bytes(range(32))
+    with command_app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(legacy.tables['uploaded_files'].insert(), {
+                'filename': 'legacy.txt', 'encrypted_data': _legacy_json_payload(b'first release', aes_key),
+                'aes_key': b'wrapped key', 'key_id': 2, 'created_at': UPLOADED_AT})
+
+    manage.migrate_envelopes(SimpleNamespace(batch_size=1))
+
+    with command_app.app_context():
+        migrated = UploadedFile.query.filter_by(filename='legacy.txt').one()
+        assert migrated.encrypted_data[:4] == ENVELOPE_MAGIC
+        assert decrypt_file(migrated.encrypted_data, aes_key) == b'first release'
+        # Payloads that are not legacy JSON are left alone
+        assert UploadedFile.query.filter_by(filename='old.pdf').one().encrypted_data == b'inline payload'
+
+def test_migrate_blobs_on_first_release_database(command_app):
+    manage.migrate_blobs(SimpleNamespace(batch_size=1, vacuum=False))
+
+    with command_app.app_context():
+        moved = UploadedFile.query.one()
+        assert moved.encrypted_data is None and moved.blob_ref is not None
+        assert moved.blob_size == len(b'inline payload')
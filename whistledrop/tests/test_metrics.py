@@ -0,0 +1,138 @@
+"""
+The /metrics listener: only reachable on its own port, never on the port Tor forwards to,
+and reporting the metrics of all workers whichever worker answers.
+"""
+import os
+
+import pytest
+
+from server.metrics import prepare_metrics_dir, remove_metrics_dir, retire_worker
+from server.models import db
+from server.serve import server_options
+
+PORT = 5000
+METRICS_PORT = 9101
+TOKEN = 's3cret'
+
+@pytest.fixture
+def metrics_app(make_app):
+    app = make_app(PORT=PORT, METRICS_PORT=METRICS_PORT, METRICS_TOKEN=TOKEN)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+def _get(app, port, path='/metrics', token=TOKEN, **headers):
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    # The test client takes SERVER_PORT from base_url, as servers take it from the accepting socket
+    return app.test_client().get(path, base_url=f'http://127.0.0.1:{port}', headers=headers)
+
+def test_metrics_listener_serves_metrics(metrics_app):
+    response = _get(metrics_app, METRICS_PORT)
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    assert 'whistledrop_keys_available' in response.get_data(as_text=True)
+
+@pytest.mark.parametrize('token', [None, 'wrong'])
+def test_metrics_listener_requires_token(metrics_app, token):
+    assert _get(metrics_app, METRICS_PORT, token=token).status_code == 404
+
+@pytest.mark.parametrize('path', ['/', '/files', '/keys/status', '/upload'])
+def test_metrics_listener_serves_nothing_else(metrics_app, path):
+    assert _get(metrics_app, METRICS_PORT, path).status_code == 404
+
+@pytest.mark.parametrize('headers', [{}, {'Host': f'127.0.0.1:{METRICS_PORT}'}, {'Host': 'localhost'}])
+def test_main_listener_never_serves_metrics(metrics_app, headers):
+    # Whatever the Host header claims, a request Tor forwarded to PORT stays on PORT
+    assert _get(metrics_app, PORT, **headers).status_code == 404
+    assert _get(metrics_app, PORT, '/keys/status').status_code == 200
+
+def test_metrics_port_must_differ_from_port(make_app):
+    with pytest.raises(ValueError):
+        make_app(PORT=PORT, METRICS_PORT=PORT, METRICS_TOKEN=TOKEN)
+
+@pytest.mark.parametrize('settings, binds', [
+    ({}, ['0.0.0.0:5000']),
+    ({'METRICS_PORT': METRICS_PORT}, ['0.0.0.0:5000']),
+    ({'METRICS_PORT': METRICS_PORT, 'METRICS_TOKEN': TOKEN}, ['0.0.0.0:5000', f'127.0.0.1:{METRICS_PORT}'])
+])
+def test_metrics_bind_is_loopback_only(settings, binds):
+    assert server_options(dict({'HOST': '0.0.0.0', 'PORT': PORT}, **settings))['bind'] == binds
+
+@pytest.fixture
+def workers(make_app, tmp_path):
+    """Two apps sharing a metrics directory, standing in for two workers of one server."""
+    directory = str(tmp_path / 'metrics')
+    apps = [make_app(PORT=PORT, METRICS_PORT=METRICS_PORT, METRICS_TOKEN=TOKEN, METRICS_DIR=directory,
+                     METRICS_FLUSH_INTERVAL=0) for _ in range(2)]
+    with apps[0].app_context():
+        db.drop_all()
+        db.create_all()
+    prepare_metrics_dir(directory)
+    return apps
+
+def _value(text, series):
+    values = [line.rsplit(' ', 1)[1] for line in text.splitlines() if line.startswith(series + ' ')]
+    assert len(values) == 1, series
+    return float(values[0])
+
+def test_metrics_cover_all_workers(workers):
+    first, second = workers
+    first.extensions['metrics'].observe_upload('ok', [1000, 2000])
+    second.extensions['metrics'].observe_upload('ok', [3000])
+    second.extensions['metrics'].observe_upload('busy')
+    first.extensions['metrics'].flush(first)
+
+    # Whichever worker accepts the scrape reports the same totals
+    for app in (second, first):
+        text = _get(app, METRICS_PORT).get_data(as_text=True)
+        assert _value(text, 'whistledrop_uploads_total{outcome="ok"}') == 2
+        assert _value(text, 'whistledrop_uploads_total{outcome="busy"}') == 1
+        assert _value(text, 'whistledrop_upload_size_bytes_count') == 3
+        assert _value(text, 'whistledrop_upload_size_bytes_sum') == 6000
+        assert _value(text, 'whistledrop_submission_files_count') == 2
+        capacity = sum(executor.workers + executor.queue_size
+                       for executor in (app.extensions['crypto_executor'] for app in workers))
+        assert _value(text, 'whistledrop_crypto_queue_capacity') == capacity
+        # Every metric family appears once, as the exposition format requires
+        types = [line for line in text.splitlines() if line.startswith('# TYPE')]
+        assert len(types) == len(set(types))
+
+def test_exited_worker_keeps_counts_but_not_gauges(workers):
+    first, second = workers
+    first.extensions['metrics'].observe_upload('ok', [1000])
+    first.extensions['metrics'].flush(first, final=True)
+    # Writes after the final snapshot are ignored
+    first.extensions['metrics'].observe_upload('ok', [1000])
+    first.extensions['metrics'].flush(first)
+
+    text = _get(second, METRICS_PORT).get_data(as_text=True)
+    executor = second.extensions['crypto_executor']
+    assert _value(text, 'whistledrop_uploads_total{outcome="ok"}') == 1
+    assert _value(text, 'whistledrop_crypto_queue_capacity') == executor.workers + executor.queue_size
+
+def test_killed_worker_is_retired_by_master(workers, tmp_path):
+    first, second = workers
+    first.extensions['metrics'].observe_upload('ok', [1000])
+    first.extensions['metrics'].flush(first)
+    retire_worker(str(tmp_path / 'metrics'), os.getpid())
+
+    text = _get(second, METRICS_PORT).get_data(as_text=True)
+    assert _value(text, 'whistledrop_uploads_total{outcome="ok"}') == 1
+    executor = second.extensions['crypto_executor']
+    assert _value(text, 'whistledrop_crypto_queue_capacity') == executor.workers + executor.queue_size
+
+def test_prepare_metrics_dir_drops_previous_run(tmp_path):
+    directory = tmp_path / 'metrics'
+    directory.mkdir()
+    (directory / '123-abcd.json').write_text('{"metrics": {}, "gauges": {}}')
+
+    assert prepare_metrics_dir(str(directory)) == (str(directory), False)
+    assert list(directory.iterdir()) == []
+
+    temporary, created = prepare_metrics_dir()
+    assert created and os.path.isdir(temporary)
+    remove_metrics_dir(temporary)
+    assert not os.path.exists(temporary)
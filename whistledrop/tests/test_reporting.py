@@ -0,0 +1,138 @@
+"""Status report aggregate tests (server/reporting.py)."""
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from server import reporting
+from server.models import db, RSAKey, Submission, UploadedFile
+
+NOW = datetime(2026, 3, 12, 12, 0)  # a Thursday
+
+@pytest.fixture
+def report_app(app):
+    """
+    An app with a small, known history:
+
+    keys 1-3 were used for files, key 4 was used without a file (an orphan),
+    key 5 is leased by a worker and keys 5-10 are available.
+    """
+    with app.app_context():
+        keys = [RSAKey(public_key=f'key-{i}') for i in range(1, 11)]
+        for key, used_days_ago in zip(keys, (1, 2, 30, 1)):
+            key.is_used = True
+            key.used_at = NOW - timedelta(days=used_days_ago)
+        keys[4].lease_owner = 'worker'
+        db.session.add_all(keys)
+        db.session.flush()
+
+        together = Submission(key_id=keys[0].id, file_count=2, created_at=datetime(2026, 3, 9, 10, 0))
+        alone = Submission(key_id=keys[2].id, file_count=1, created_at=datetime(2026, 2, 10, 9, 0))
+        db.session.add_all([together, alone])
+        db.session.flush()
+
+        def uploaded(filename, key, created_at, size=None, inline=None, submission=None):
+            return UploadedFile(filename=filename, encrypted_data=inline, aes_key=b'wrapped', key_id=key.id,
+                                created_at=created_at, blob_ref=f'ref-{filename}' if size else None,
+                                blob_size=size, submission_id=submission.id if submission else None)
+
+        db.session.add_all([
+            uploaded('a.pdf', keys[0], datetime(2026, 3, 9, 10, 0), size=100, submission=together),
+            uploaded('b.pdf', keys[0], datetime(2026, 3, 9, 11, 0), size=300, submission=together),
+            # Stored inline by an older version, before submissions existed
+            uploaded('c.pdf', keys[1], datetime(2026, 3, 11, 8, 30), inline=b'x' * 50),
+            uploaded('d.pdf', keys[2], datetime(2026, 2, 10, 9, 0), size=1050, submission=alone)
+        ])
+        db.session.commit()
+    return app
+
+def test_key_summary(report_app):
+    with report_app.app_context():
+        summary = reporting.key_summary(window_days=7, now=NOW)
+
+    assert summary == {
+        'total': 10,
+        'available': 6,
+        'leased': 1,
+        'used': 4,
+        'used_per_day': 0.43,
+        'window_days': 7,
+        'days_until_exhausted': 14.0,
+        'exhausted_at': (NOW + timedelta(days=14)).isoformat(timespec='minutes')
+    }
+
+def test_key_summary_without_recent_use(report_app):
+    with report_app.app_context():
+        summary = reporting.key_summary(window_days=7, now=NOW + timedelta(days=365))
+
+    assert summary['used_per_day'] == 0
+    assert summary['days_until_exhausted'] is None and summary['exhausted_at'] is None
+
+def test_file_summary(report_app):
+    with report_app.app_context():
+        summary = reporting.file_summary()
+
+    assert summary == {
+        'count': 4,
+        'submissions': 2,
+        'total_bytes': 1500,
+        'average_bytes': 375,
+        'first_upload': '2026-02-10T09:00:00',
+        'last_upload': '2026-03-11T08:30:00'
+    }
+
+def test_file_summary_of_empty_database(app):
+    with app.app_context():
+        summary = reporting.file_summary()
+
+    assert summary == {'count': 0, 'submissions': 0, 'total_bytes': 0, 'average_bytes': None,
+                       'first_upload': None, 'last_upload': None}
+
+@pytest.mark.parametrize('period, expected', [
+    ('day', [{'period': '2026-02-10', 'files': 1, 'bytes': 1050},
+             {'period': '2026-03-09', 'files': 2, 'bytes': 400},
+             {'period': '2026-03-11', 'files': 1, 'bytes': 50}]),
+    ('week', [{'period': '2026-02-09', 'files': 1, 'bytes': 1050},
+              {'period': '2026-03-09', 'files': 3, 'bytes': 450}])
+])
+def test_uploads_per_period(report_app, period, expected):
+    with report_app.app_context():
+        assert list(reporting.uploads_per_period(period)) == expected
+
+def test_uploads_per_unknown_period(report_app):
+    with report_app.app_context(), pytest.raises(ValueError):
+        list(reporting.uploads_per_period('month'))
+
+def test_orphaned_keys_and_key_usage(report_app):
+    with report_app.app_context():
+        ids = [key_id for key_id, in db.session.query(RSAKey.id).order_by(RSAKey.id)]
+        orphaned = list(reporting.orphaned_keys())
+        usage = [(row['key_id'], row['filename']) for row in reporting.key_usage()]
+
+    assert orphaned == [{'key_id': ids[3], 'used_at': (NOW - timedelta(days=1)).isoformat(timespec='seconds')}]
+    assert usage == [(ids[0], 'a.pdf'), (ids[0], 'b.pdf'), (ids[1], 'c.pdf'), (ids[2], 'd.pdf')]
+
+def test_streamed_json_report(report_app, monkeypatch):
+    # Force several round trips through the streamed result sets
+    monkeypatch.setattr(reporting, 'STREAM_BATCH_SIZE', 1)
+    out = io.StringIO()
+    with report_app.app_context():
+        reporting.write_json(reporting.status_report(period='week', include_keys=True), out)
+
+    report = json.loads(out.getvalue())
+    assert set(report) == {'keys', 'files', 'uploads_per_week', 'orphaned_keys', 'key_usage'}
+    assert report['files']['count'] == 4
+    assert len(report['uploads_per_week']) == 2
+    assert len(report['orphaned_keys']) == 1
+    assert len(report['key_usage']) == 4
+
+def test_text_report(report_app):
+    out = io.StringIO()
+    with report_app.app_context():
+        reporting.write_text(reporting.status_report(), out)
+
+    text = out.getvalue()
+    assert "Available keys: 6 (1 leased by server workers)" in text
+    assert "Uploaded files: 4 in 2 submissions" in text
+    assert "1 orphaned keys" in text
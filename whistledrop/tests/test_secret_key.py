@@ -0,0 +1,53 @@
+"""Resolution of the Flask secret key when the app is created."""
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def unset_secret_key(monkeypatch):
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    monkeypatch.delenv('SECRET_KEY_FILE', raising=False)
+
+def test_importing_config_touches_no_files(unset_secret_key):
+    # A read-only install: the process may not write anywhere near the code
+    code = ("import os; os.open = None\n"
+            "from server.config import Config\n"
+            "assert Config.SECRET_KEY is None and Config.SECRET_KEY_FILE is None")
+    env = {key: value for key, value in os.environ.items() if key not in ('SECRET_KEY', 'SECRET_KEY_FILE')}
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=dict(env, PYTHONPATH=ROOT), check=True)
+
+def test_configured_key_wins(make_app, tmp_path):
+    app = make_app(SECRET_KEY='configured', SECRET_KEY_FILE=str(tmp_path / 'secret_key'))
+
+    assert app.config['SECRET_KEY'] == 'configured'
+    assert not (tmp_path / 'secret_key').exists()
+
+def test_key_passed_down_by_serve_master(make_app, unset_secret_key, monkeypatch):
+    monkeypatch.setenv('SECRET_KEY', 'from master')
+
+    assert make_app(SECRET_KEY=None).config['SECRET_KEY'] == 'from master'
+
+def test_key_file_is_created_once_and_shared(make_app, unset_secret_key, tmp_path):
+    path = tmp_path / 'secret_key'
+
+    first = make_app(SECRET_KEY=None, SECRET_KEY_FILE=str(path))
+    second = make_app(SECRET_KEY=None, SECRET_KEY_FILE=str(path))
+
+    assert first.config['SECRET_KEY'] == second.config['SECRET_KEY'] == path.read_text()
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+
+def test_uncreatable_key_file_is_a_clear_error(make_app, unset_secret_key, tmp_path):
+    with pytest.raises(RuntimeError, match='SECRET_KEY_FILE'):
+        make_app(SECRET_KEY=None, SECRET_KEY_FILE=str(tmp_path / 'missing' / 'secret_key'))
+
+def test_random_key_without_configuration(make_app, unset_secret_key, caplog):
+    first = make_app(SECRET_KEY=None)
+    second = make_app(SECRET_KEY=None)
+
+    assert first.config['SECRET_KEY'] and first.config['SECRET_KEY'] != second.config['SECRET_KEY']
+    assert 'random secret key' in caplog.text
@@ -0,0 +1,123 @@
+"""
+AES-GCM STREAM payloads: each segment is sealed under prefix || index || last flag
+with the envelope header as associated data.
+"""
+import io
+
+import pytest
+
+from journalist import crypto as journalist_crypto
+from server import crypto as server_crypto
+from server.crypto import MODE_AES_GCM_STREAM, STREAM_TAG_SIZE
+
+SEGMENT_SIZE = 1024
+STORED_SEGMENT = SEGMENT_SIZE + STREAM_TAG_SIZE
+AES_KEY = bytes(range(32))
+
+def _encrypt(plaintext, segment_size=SEGMENT_SIZE):
+    out = io.BytesIO()
+    server_crypto.encrypt_stream(io.BytesIO(plaintext), out, AES_KEY, key_id=7, chunk_size=segment_size,
+                                 mode=MODE_AES_GCM_STREAM)
+    return out.getvalue()
+
+def _decrypt_stream(envelope):
+    out = io.BytesIO()
+    journalist_crypto.decrypt_stream(io.BytesIO(envelope), out, AES_KEY)
+    return out.getvalue()
+
+def _split(envelope):
+    """Header and list of stored segments of an envelope."""
+    header, body = journalist_crypto.parse_envelope(envelope)
+    return header['raw'], [body[i:i + STORED_SEGMENT] for i in range(0, len(body), STORED_SEGMENT)]
+
+@pytest.mark.parametrize('size, segments', [
+    (0, 1),                      # empty input still yields one (empty, last) segment
+    (100, 1),                    # shorter than one segment
+    (SEGMENT_SIZE, 1),           # exactly one segment, no empty trailer
+    (3 * SEGMENT_SIZE, 3),       # exact multiple of the segment size
+    (3 * SEGMENT_SIZE + 1, 4)
+])
+def test_round_trip(size, segments):
+    plaintext = bytes(i % 251 for i in range(size))
+    envelope = _encrypt(plaintext)
+
+    assert len(_split(envelope)[1]) == segments
+    assert journalist_crypto.decrypt_file(envelope, AES_KEY) == plaintext
+    assert _decrypt_stream(envelope) == plaintext
+    assert server_crypto.decrypt_file(envelope, AES_KEY) == plaintext
+
+def _flip(data, position):
+    data = bytearray(data)
+    data[position] ^= 0x01
+    return bytes(data)
+
+def _tampered(kind):
+    header, segments = _split(_encrypt(bytes(3 * SEGMENT_SIZE + 10)))
+    if kind == 'ciphertext byte':
+        return header + _flip(b''.join(segments), STORED_SEGMENT + 5)
+    if kind == 'tag byte':
+        return header + _flip(b''.join(segments), STORED_SEGMENT - 1)
+    if kind == 'header byte':
+        # The key id: not needed to parse the envelope, but authenticated with every segment
+        return _flip(header, 11) + b''.join(segments)
+    if kind == 'swapped segments':
+        return header + b''.join([segments[1], segments[0]] + segments[2:])
+    if kind == 'truncated at segment boundary':
+        return header + b''.join(segments[:-1])
+    if kind == 'trailing segment appended':
+        return header + b''.join(segments + segments[-1:])
+    raise AssertionError(kind)
+
+TAMPERING = ['ciphertext byte', 'tag byte', 'header byte', 'swapped segments', 'truncated at segment boundary',
+             'trailing segment appended']
+
+@pytest.mark.parametrize('kind', TAMPERING)
+def test_tampering_is_rejected(kind):
+    envelope = _tampered(kind)
+
+    with pytest.raises(ValueError):
+        _decrypt_stream(envelope)
+    assert journalist_crypto.decrypt_file(envelope, AES_KEY) is None
+    with pytest.raises(ValueError):
+        server_crypto.decrypt_file(envelope, AES_KEY)
+
+@pytest.mark.parametrize('kind', TAMPERING)
+def test_tampering_is_rejected_by_parallel_decrypt(kind, tmp_path):
+    path = tmp_path / 'payload'
+    path.write_bytes(_tampered(kind))
+    header, _ = journalist_crypto.parse_envelope(path.read_bytes())
+
+    with pytest.raises(ValueError):
+        journalist_crypto._decrypt_segments_parallel(str(path), io.BytesIO(), AES_KEY, header, workers=4)
+
+@pytest.mark.parametrize('segments', [1, journalist_crypto.SEGMENTS_PER_TASK, 5 * journalist_crypto.SEGMENTS_PER_TASK + 3])
+def test_parallel_decrypt_matches_sequential(segments, tmp_path):
+    plaintext = bytes(i % 253 for i in range(segments * SEGMENT_SIZE - 17))
+    envelope = _encrypt(plaintext)
+    path = tmp_path / 'payload'
+    path.write_bytes(envelope)
+    header, _ = journalist_crypto.parse_envelope(envelope)
+
+    parallel = io.BytesIO()
+    written = journalist_crypto._decrypt_segments_parallel(str(path), parallel, AES_KEY, header, workers=4)
+
+    assert parallel.getvalue() == _decrypt_stream(envelope) == plaintext
+    assert written == len(plaintext)
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_decrypt_to_path(workers, tmp_path):
+    plaintext = bytes(i % 241 for i in range(40 * SEGMENT_SIZE))
+    encrypted = tmp_path / 'payload'
+    encrypted.write_bytes(_encrypt(plaintext))
+    output = tmp_path / 'plain'
+
+    assert journalist_crypto.decrypt_to_path(str(encrypted), str(output), AES_KEY, workers=workers)
+    assert output.read_bytes() == plaintext
+
+def test_decrypt_to_path_leaves_nothing_behind_on_tampering(tmp_path):
+    encrypted = tmp_path / 'payload'
+    encrypted.write_bytes(_tampered('truncated at segment boundary'))
+    output = tmp_path / 'plain'
+
+    assert not journalist_crypto.decrypt_to_path(str(encrypted), str(output), AES_KEY, workers=4)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['payload']
@@ -0,0 +1,139 @@
+"""Multi-file uploads: one RSA key per submission, stored all together or not at all."""
+import io
+import os
+from datetime import datetime
+
+import pytest
+from Crypto.PublicKey import RSA
+
+from journalist.crypto import decrypt_file, decrypt_with_rsa
+from server import routes
+from server.models import db, RSAKey, Submission, UploadedFile
+from server.storage import get_blob_store
+
+DOCUMENTS = [(os.urandom(100 * 1024), 'report.pdf'), (b'Zeile\n' * 20000, 'notes.txt'), (b'', 'empty.txt')]
+
+@pytest.fixture(scope='module')
+def rsa_keys():
+    return [RSA.generate(1024) for _ in range(2)]
+
+@pytest.fixture
+def keys(app, rsa_keys):
+    """Store the public keys; returns {key id: private PEM}."""
+    with app.app_context():
+        db.session.execute(RSAKey.__table__.insert(), [
+            {'public_key': key.publickey().export_key().decode('utf-8'), 'is_used': False, 'created_at': datetime.now()}
+            for key in rsa_keys])
+        db.session.commit()
+        key_ids = [key_id for key_id, in db.session.query(RSAKey.id).order_by(RSAKey.id)]
+    return {key_id: key.export_key().decode('utf-8') for key_id, key in zip(key_ids, rsa_keys)}
+
+def _upload(app, documents=DOCUMENTS):
+    return app.test_client().post('/upload_file', data={'file': [(io.BytesIO(data), name) for data, name in documents]})
+
+def _blobs(app):
+    """Payload files in the blob store (not counting its temporary directory)."""
+    root = app.config['UPLOAD_FOLDER']
+    return sorted(name for directory, _, names in os.walk(root)
+                  if os.path.relpath(directory, root).split(os.sep)[0] != 'tmp' for name in names)
+
+def _used_keys(app):
+    with app.app_context():
+        return [key_id for key_id, in db.session.query(RSAKey.id).filter_by(is_used=True)]
+
+def test_submission_shares_one_key(app, keys):
+    response = _upload(app)
+
+    assert response.status_code == 200
+    assert b'3 files' in response.data
+    used = _used_keys(app)
+    assert len(used) == 1
+    with app.app_context():
+        submission = Submission.query.one()
+        files = UploadedFile.query.order_by(UploadedFile.id).all()
+        assert (submission.key_id, submission.file_count) == (used[0], 3)
+        assert [file.submission_id for file in files] == [submission.id] * 3
+        assert [file.key_id for file in files] == [used[0]] * 3
+        assert [file.filename for file in files] == [name for _, name in DOCUMENTS]
+        assert len({file.aes_key for file in files}) == 3
+        # Every file decrypts with its own AES key, wrapped with the submission's RSA key
+        store = get_blob_store()
+        for file, (data, _) in zip(files, DOCUMENTS):
+            with store.open(file.blob_ref) as f:
+                payload = f.read()
+            assert file.blob_size == len(payload)
+            assert decrypt_file(payload, decrypt_with_rsa(file.aes_key, keys[used[0]])) == data
+    assert len(_blobs(app)) == 3
+
+def test_submission_endpoint(app, keys):
+    _upload(app)
+    with app.app_context():
+        submission = Submission.query.one()
+        files = UploadedFile.query.order_by(UploadedFile.id).all()
+
+    response = app.test_client().get(f'/submissions/{submission.id}')
+
+    assert response.status_code == 200
+    body = response.json
+    assert (body['id'], body['key_id'], body['file_count']) == (submission.id, submission.key_id, 3)
+    assert [file['id'] for file in body['files']] == [file.id for file in files]
+    assert [file['filename'] for file in body['files']] == [name for _, name in DOCUMENTS]
+    assert [file['digest'] for file in body['files']] == [file.blob_digest for file in files]
+    assert [file['size'] for file in body['files']] == [file.blob_size for file in files]
+    assert app.test_client().get(f'/submissions/{submission.id + 1}').status_code == 404
+
+def test_each_submission_claims_a_new_key(app, keys):
+    assert _upload(app).status_code == 200
+    assert _upload(app, DOCUMENTS[:1]).status_code == 200
+
+    assert sorted(_used_keys(app)) == sorted(keys)
+    with app.app_context():
+        assert [submission.file_count for submission in Submission.query.order_by(Submission.id)] == [3, 1]
+    # With every key used, the next upload is turned away and stores nothing
+    assert _upload(app).status_code == 302
+    assert len(_blobs(app)) == 4
+
+def _failing_wrap(*args, **kwargs):
+    raise RuntimeError('wrap failed')
+
+def _failing_on_second_file(encrypt):
+    calls = []
+
+    def encrypt_upload(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError('encryption failed')
+        return encrypt(*args, **kwargs)
+    return encrypt_upload
+
+@pytest.mark.parametrize('stage', ['wrap', 'encrypt'])
+def test_failed_submission_leaves_nothing_behind(app, keys, monkeypatch, stage):
+    if stage == 'wrap':
+        monkeypatch.setattr(routes, '_wrap_keys', _failing_wrap)
+    else:
+        monkeypatch.setattr(routes, '_encrypt_upload', _failing_on_second_file(routes._encrypt_upload))
+
+    response = _upload(app)
+
+    assert response.status_code == 302
+    assert _blobs(app) == []
+    assert _used_keys(app) == []
+    with app.app_context():
+        assert Submission.query.count() == 0
+        assert UploadedFile.query.count() == 0
+
+    # The released key is handed out again
+    monkeypatch.undo()
+    assert _upload(app).status_code == 200
+    assert len(_used_keys(app)) == 1
+
+@pytest.mark.parametrize('documents', [
+    [(b'x', 'ok.txt'), (b'x', 'bad.exe')],
+    [(b'x', f'{i}.txt') for i in range(6)]
+], ids=['disallowed-type', 'too-many-files'])
+def test_rejected_submission_claims_no_key(make_app, keys, documents):
+    app = make_app(MAX_FILES_PER_SUBMISSION=5)
+
+    assert _upload(app, documents).status_code == 302
+    assert _used_keys(app) == []
+    assert _blobs(app) == []